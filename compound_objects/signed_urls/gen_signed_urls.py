@@ -22,11 +22,12 @@ import settings
 import argparse
 
 import binascii
-import collections
+import csv
 import datetime
 import hashlib
 import sys
-from multiprocessing import Process, Queue, Lock, shared_memory
+from functools import lru_cache
+from multiprocessing import Process, Queue, shared_memory
 from queue import Empty
 
 
@@ -36,12 +37,24 @@ from google.oauth2 import service_account
 import six
 from six.moves.urllib.parse import quote
 
+MAX_EXPIRATION = 604800
+# A signer's timestamp is renewed after this many seconds, so that URLs signed late in a
+# long run are still valid for nearly the full expiration
+SIGNER_MAX_AGE = 3600
+# Rows per row group of a Parquet manifest
+PARQUET_ROW_GROUP = 100000
+
+
+@lru_cache(maxsize=None)
+def get_credentials(service_account_file):
+    return service_account.Credentials.from_service_account_file(service_account_file)
+
 
 def generate_signed_url(service_account_file, bucket_name, object_name,
                         subresource=None, expiration=604800, http_method='GET',
                         query_parameters=None, headers=None):
 
-    if expiration > 604800:
+    if expiration > MAX_EXPIRATION:
         print('Expiration Time can\'t be longer than 604800 seconds (7 days).')
         sys.exit(1)
 
@@ -52,8 +65,7 @@ def generate_signed_url(service_account_file, bucket_name, object_name,
     request_timestamp = datetime_now.strftime('%Y%m%dT%H%M%SZ')
     datestamp = datetime_now.strftime('%Y%m%d')
 
-    google_credentials = service_account.Credentials.from_service_account_file(
-        service_account_file)
+    google_credentials = get_credentials(service_account_file)
     client_email = google_credentials.service_account_email
     credential_scope = '{}/auto/storage/goog4_request'.format(datestamp)
     credential = '{}/{}'.format(client_email, credential_scope)
@@ -63,18 +75,7 @@ def generate_signed_url(service_account_file, bucket_name, object_name,
     host = '{}.storage.googleapis.com'.format(bucket_name)
     headers['host'] = host
 
-    canonical_headers = ''
-    ordered_headers = collections.OrderedDict(sorted(headers.items()))
-    for k, v in ordered_headers.items():
-        lower_k = str(k).lower()
-        strip_v = str(v).lower()
-        canonical_headers += '{}:{}\n'.format(lower_k, strip_v)
-
-    signed_headers = ''
-    for k, _ in ordered_headers.items():
-        lower_k = str(k).lower()
-        signed_headers += '{};'.format(lower_k)
-    signed_headers = signed_headers[:-1]  # remove trailing ';'
+    canonical_headers, signed_headers = canonical_header_strings(headers)
 
     if query_parameters is None:
         query_parameters = dict()
@@ -86,14 +87,7 @@ def generate_signed_url(service_account_file, bucket_name, object_name,
     if subresource:
         query_parameters[subresource] = ''
 
-    canonical_query_string = ''
-    ordered_query_parameters = collections.OrderedDict(
-        sorted(query_parameters.items()))
-    for k, v in ordered_query_parameters.items():
-        encoded_k = quote(str(k), safe='')
-        encoded_v = quote(str(v), safe='')
-        canonical_query_string += '{}={}&'.format(encoded_k, encoded_v)
-    canonical_query_string = canonical_query_string[:-1]  # remove trailing '&'
+    canonical_query_string = canonical_query(query_parameters)
 
     canonical_request = '\n'.join([http_method,
                                    canonical_uri,
@@ -121,6 +115,20 @@ def generate_signed_url(service_account_file, bucket_name, object_name,
 
     return signed_url
 
+
+# Return the canonical headers and signed headers strings of a dictionary of headers
+def canonical_header_strings(headers):
+    ordered_headers = sorted((str(k).lower(), str(v).lower()) for k, v in headers.items())
+    canonical_headers = ''.join('{}:{}\n'.format(k, v) for k, v in ordered_headers)
+    signed_headers = ';'.join(k for k, _ in ordered_headers)
+    return canonical_headers, signed_headers
+
+
+def canonical_query(query_parameters):
+    return '&'.join('{}={}'.format(quote(str(k), safe=''), quote(str(v), safe=''))
+                    for k, v in sorted(query_parameters.items()))
+
+
 def generate_download_signed_url_v4(storage_client, bucket, blob):
     """Generates a v4 signed URL for downloading a blob.
 
@@ -142,207 +150,196 @@ def generate_download_signed_url_v4(storage_client, bucket, blob):
     return url
 
 
-def generate_canonical_request(service_account_file, bucket_name,
-                        subresource=None, expiration=604800, http_method='GET',
-                        query_parameters=None, headers=None):
-
-    if expiration > 604800:
-        print('Expiration Time can\'t be longer than 604800 seconds (7 days).')
-        sys.exit(1)
-
-    # escaped_object_name = quote(six.ensure_binary(object_name), safe=b'/~')
-    canonical_uri = '%%%%%%%'
-
-    datetime_now = datetime.datetime.now(tz=datetime.timezone.utc)
-    request_timestamp = datetime_now.strftime('%Y%m%dT%H%M%SZ')
-    datestamp = datetime_now.strftime('%Y%m%d')
+class URL_Signer:
+    """Generates V4 signed URLs for the objects of one bucket.
 
-    google_credentials = service_account.Credentials.from_service_account_file(
-        service_account_file)
-    client_email = google_credentials.service_account_email
-    credential_scope = '{}/auto/storage/goog4_request'.format(datestamp)
-    credential = '{}/{}'.format(client_email, credential_scope)
-
-    if headers is None:
-        headers = dict()
-    host = '{}.storage.googleapis.com'.format(bucket_name)
-    headers['host'] = host
-
-    canonical_headers = ''
-    ordered_headers = collections.OrderedDict(sorted(headers.items()))
-    for k, v in ordered_headers.items():
-        lower_k = str(k).lower()
-        strip_v = str(v).lower()
-        canonical_headers += '{}:{}\n'.format(lower_k, strip_v)
-
-    signed_headers = ''
-    for k, _ in ordered_headers.items():
-        lower_k = str(k).lower()
-        signed_headers += '{};'.format(lower_k)
-    signed_headers = signed_headers[:-1]  # remove trailing ';'
-
-    if query_parameters is None:
-        query_parameters = dict()
-    query_parameters['X-Goog-Algorithm'] = 'GOOG4-RSA-SHA256'
-    query_parameters['X-Goog-Credential'] = credential
-    query_parameters['X-Goog-Date'] = request_timestamp
-    query_parameters['X-Goog-Expires'] = expiration
-    query_parameters['X-Goog-SignedHeaders'] = signed_headers
-    if subresource:
-        query_parameters[subresource] = ''
-
-    canonical_query_string = ''
-    ordered_query_parameters = collections.OrderedDict(
-        sorted(query_parameters.items()))
-    for k, v in ordered_query_parameters.items():
-        encoded_k = quote(str(k), safe='')
-        encoded_v = quote(str(v), safe='')
-        canonical_query_string += '{}={}&'.format(encoded_k, encoded_v)
-    canonical_query_string = canonical_query_string[:-1]  # remove trailing '&'
-
-    canonical_request = '\n'.join([http_method,
-                                   canonical_uri,
-                                   canonical_query_string,
-                                   canonical_headers,
-                                   signed_headers,
-                                   'UNSIGNED-PAYLOAD'])
-
-    return host, google_credentials, canonical_query_string, canonical_request
-
-# def generate_signed_url(host, google_credentials, canonical_query_string, canonical_request, object_name,
-#                             subresource=None, expiration=604800, http_method='GET',
-#                             query_parameters=None, headers=None):
-#
-#     escaped_object_name = quote(six.ensure_binary(object_name), safe=b'/~')
-#     canonical_uri = '/{}'.format(escaped_object_name)
-#     canonical_request = canonical_request.replace('%%%%%%%',canonical_uri)
-#
-#     datetime_now = datetime.datetime.now(tz=datetime.timezone.utc)
-#     request_timestamp = datetime_now.strftime('%Y%m%dT%H%M%SZ')
-#     datestamp = datetime_now.strftime('%Y%m%d')
-#
-#     credential_scope = '{}/auto/storage/goog4_request'.format(datestamp)
-#     canonical_request_hash = hashlib.sha256(
-#         canonical_request.encode()).hexdigest()
-#
-#     string_to_sign = '\n'.join(['GOOG4-RSA-SHA256',
-#                                 request_timestamp,
-#                                 credential_scope,
-#                                 canonical_request_hash])
-#
-#     # signer.sign() signs using RSA-SHA256 with PKCS1v15 padding
-#     signature = binascii.hexlify(
-#         google_credentials.signer.sign(string_to_sign)
-#     ).decode()
-#
-#     scheme_and_host = '{}://{}'.format('https', host)
-#     signed_url = '{}{}?{}&x-goog-signature={}'.format(
-#         scheme_and_host, canonical_uri, canonical_query_string, signature)
-#
-#     return signed_url
-#
-# def generate_download_signed_url_v4(storage_client, bucket, blob):
-#     """Generates a v4 signed URL for downloading a blob.
-#
-#     Note that this method requires a service account key file. You can not use
-#     this if you are using Application Default Credentials from Google Compute
-#     Engine or from the Google Cloud SDK.
-#     """
-#     # bucket_name = 'your-bucket-name'
-#     # blob_name = 'your-object-name'
-#
-#     url = blob.generate_signed_url(
-#         version="v4",
-#         # This URL is valid for 15 minutes
-#         expiration=datetime.timedelta(minutes=15),
-#         # Allow GET requests using this URL.
-#         method="GET",
-#     )
-#
-#     return url
+    Everything in the canonical request except the object's URI is the same for every
+    object of the bucket that is signed at the same timestamp. So the credentials are
+    loaded once, and the canonical query string, headers and credential scope are
+    computed once per timestamp. Only the URI, a sha256 and the RSA signature are
+    computed per object.
+    """
+    def __init__(self, service_account_file, bucket_name, expiration=MAX_EXPIRATION, http_method='GET',
+                 subresource=None, query_parameters=None, headers=None, max_age=SIGNER_MAX_AGE):
+        if expiration > MAX_EXPIRATION:
+            raise ValueError('Expiration Time can\'t be longer than 604800 seconds (7 days).')
+        self.credentials = get_credentials(service_account_file)
+        self.bucket_name = bucket_name
+        self.expiration = expiration
+        self.http_method = http_method
+        self.subresource = subresource
+        self.query_parameters = dict(query_parameters) if query_parameters else {}
+        self.headers = dict(headers) if headers else {}
+        self.max_age = max_age
+        self.host = '{}.storage.googleapis.com'.format(bucket_name)
+        self.headers['host'] = self.host
+        self.canonical_headers, self.signed_headers = canonical_header_strings(self.headers)
+        self.prepare()
+
+    # (Re)compute the parts of the canonical request and string to sign that depend on the timestamp
+    def prepare(self):
+        datetime_now = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.prepared = time.time()
+        request_timestamp = datetime_now.strftime('%Y%m%dT%H%M%SZ')
+        credential_scope = '{}/auto/storage/goog4_request'.format(datetime_now.strftime('%Y%m%d'))
+
+        query_parameters = dict(self.query_parameters)
+        query_parameters['X-Goog-Algorithm'] = 'GOOG4-RSA-SHA256'
+        query_parameters['X-Goog-Credential'] = '{}/{}'.format(self.credentials.service_account_email, credential_scope)
+        query_parameters['X-Goog-Date'] = request_timestamp
+        query_parameters['X-Goog-Expires'] = self.expiration
+        query_parameters['X-Goog-SignedHeaders'] = self.signed_headers
+        if self.subresource:
+            query_parameters[self.subresource] = ''
+        self.canonical_query_string = canonical_query(query_parameters)
+
+        # The canonical request is <method>\n<uri>\n<suffix>
+        self.request_prefix = self.http_method + '\n'
+        self.request_suffix = '\n' + '\n'.join([self.canonical_query_string,
+                                                self.canonical_headers,
+                                                self.signed_headers,
+                                                'UNSIGNED-PAYLOAD'])
+        self.string_to_sign_prefix = '\n'.join(['GOOG4-RSA-SHA256',
+                                                request_timestamp,
+                                                credential_scope]) + '\n'
+        self.url_prefix = 'https://' + self.host
+        self.url_query = '?' + self.canonical_query_string + '&x-goog-signature='
+
+    def sign(self, object_name):
+        if time.time() - self.prepared > self.max_age:
+            self.prepare()
+        canonical_uri = '/' + quote(six.ensure_binary(object_name), safe=b'/~')
+        canonical_request_hash = hashlib.sha256(
+            (self.request_prefix + canonical_uri + self.request_suffix).encode()).hexdigest()
+        # signer.sign() signs using RSA-SHA256 with PKCS1v15 padding
+        signature = binascii.hexlify(
+            self.credentials.signer.sign(self.string_to_sign_prefix + canonical_request_hash)).decode()
+        return self.url_prefix + canonical_uri + self.url_query + signature
+
+
+class Manifest_Writer:
+    """Writes (blob_name, signed_url) rows as they are generated, as CSV or, if the
+    file name ends with .parquet, as Parquet in row groups of PARQUET_ROW_GROUP rows."""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.parquet = file_name.endswith('.parquet')
+        self.rows = []
+        if self.parquet:
+            # pyarrow is only needed for Parquet manifests
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.pa = pa
+            self.schema = pa.schema([('blob_name', pa.string()), ('signed_url', pa.string())])
+            self.writer = pq.ParquetWriter(file_name, self.schema)
+        else:
+            self.f = open(file_name, 'w', newline='')
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(['blob_name', 'signed_url'])
+
+    def write(self, rows):
+        if self.parquet:
+            self.rows.extend(rows)
+            if len(self.rows) >= PARQUET_ROW_GROUP:
+                self.flush()
+        else:
+            self.writer.writerows(rows)
+
+    def flush(self):
+        if self.parquet and self.rows:
+            blob_names, signed_urls = zip(*self.rows)
+            self.writer.write_table(self.pa.table([list(blob_names), list(signed_urls)], schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet:
+            self.writer.close()
+        else:
+            self.f.close()
+
+
+def list_blob_names(args):
+    storage_client = storage.Client(credentials=None)
+    pages = storage_client.list_blobs(args.bucket_name, prefix=args.folder, delimiter='/', page_size=args.batch)
+    for page in pages.pages:
+        yield [blob.name for blob in page if blob.name.endswith('dcm')]
 
 
 def generate_signed_urls(args):
-    storage_client = storage.Client(credentials=None)
-    pages = storage_client.list_blobs(args.bucket_name, prefix=args.folder, delimiter='/', page_size=args.batch )
-    # instance_uids = []
-    # bucket = storage_client.bucket(args.bucket_name)
-    # host, google_credentials, canonical_query_string, canonical_request = \
-    #     generate_canonical_request(args.creds, args.bucket_name,
-    #                            subresource=None, expiration=3600, http_method='GET',
-    #                            query_parameters=None, headers=None)
+    signer = URL_Signer(args.creds, args.bucket_name, expiration=args.expiration)
+    manifest = Manifest_Writer(args.manifest)
 
     start = time.time()
     n=0
-    for page in pages.pages:
-        for blob in page:
-            # url = generate_signed_url(args.creds, bucket, blob)
-            # url = generate_signed_url(host, google_credentials, canonical_query_string, canonical_request, blob.name)
-            url = generate_signed_url(args.creds, args.bucket_name, blob.name)
-            n += 1
-    print(f'Duration: {time.time() - start}, n: {n}')
+    for blob_names in list_blob_names(args):
+        manifest.write([(blob_name, signer.sign(blob_name)) for blob_name in blob_names])
+        n += len(blob_names)
+    manifest.close()
+    duration = time.time() - start
+    print(f'Duration: {duration:.1f}s, n: {n}, {n/duration if duration else 0:.0f} URLs/s')
     return
 
 
-def worker(input, args):
+def worker(input, output, args):
+    # Each process loads the credentials and prepares its signer once
+    signer = URL_Signer(args.creds, args.bucket_name, expiration=args.expiration)
     for blob_names in iter(input.get, 'STOP'):
-        for blob_name in blob_names:
-            # url = generate_signed_url(args.creds, bucket, blob)
-            # url = generate_signed_url(host, google_credentials, canonical_query_string, canonical_request, blob.name)
-            url = generate_signed_url(args.creds, args.bucket_name, blob_name)
+        output.put([(blob_name, signer.sign(blob_name)) for blob_name in blob_names])
+    output.put('STOP')
 
-def generate_signed_urls_mp(args):
-    storage_client = storage.Client(credentials=None)
-    # instance_uids = []
-    # bucket = storage_client.bucket(args.bucket_name)
-    # host, google_credentials, canonical_query_string, canonical_request = \
-    #     generate_canonical_request(args.creds, args.bucket_name,
-    #                            subresource=None, expiration=3600, http_method='GET',
-    #                            query_parameters=None, headers=None)
 
+def generate_signed_urls_mp(args):
     processes = []
-    # Create queues
-    task_queue = Queue()
+    # Create queues. The task queue is bounded so that listing does not run far ahead of signing
+    task_queue = Queue(maxsize=4 * args.num_processes)
     done_queue = Queue()
 
-    # List of patients enqueued
-    enqueued_patients = []
-
     num_processes = args.num_processes
     # Start worker processes
-    lock = Lock()
     for process in range(num_processes):
         args.pid = process + 1
         processes.append(
-            Process(target=worker, args=(task_queue, args)))
+            Process(target=worker, args=(task_queue, done_queue, args)))
         processes[-1].start()
+    args.pid = 0
 
+    manifest = Manifest_Writer(args.manifest)
     start = time.time()
     n=0
-    for i in range(8):
-        pages = storage_client.list_blobs(args.bucket_name, prefix=args.folder, delimiter='/', page_size=args.batch)
-
-        for page in pages.pages:
-            blob_names = [blob.name for blob in page if blob.name.endswith('dcm')]
-            # task_queue.put((blob_names))
-            # for blob_name in blob_names:
-            #     # url = generate_signed_url(args.creds, bucket, blob)
-            #     # url = generate_signed_url(host, google_credentials, canonical_query_string, canonical_request, blob.name)
-            #     url = generate_signed_url(args.creds, args.bucket_name, blob_name)
-
-
-            task_queue.put(blob_names)
-            n += len(blob_names)
+    for blob_names in list_blob_names(args):
+        task_queue.put(blob_names)
+        # Write whatever has been signed so far
+        while True:
+            try:
+                rows = done_queue.get_nowait()
+            except Empty:
+                break
+            manifest.write(rows)
+            n += len(rows)
 
     # Tell child processes to stop
     for process in processes:
         task_queue.put('STOP')
 
+    # Each worker puts STOP after its last result
+    stopped = 0
+    while stopped < num_processes:
+        rows = done_queue.get()
+        if rows == 'STOP':
+            stopped += 1
+        else:
+            manifest.write(rows)
+            n += len(rows)
+            if n % (100 * args.batch) < len(rows):
+                print(f'{n} URLs, {n / (time.time() - start):.0f} URLs/s')
+
     # Wait for them to stop
     for process in processes:
         process.join()
+    manifest.close()
 
-    print(f'Duration: {time.time() - start}, n: {n}')
+    duration = time.time() - start
+    print(f'Duration: {duration:.1f}s, n: {n}, {n/duration if duration else 0:.0f} URLs/s')
 
 
 if __name__ == '__main__':
@@ -351,8 +348,10 @@ if __name__ == '__main__':
     parser.add_argument('--creds', default='/home/bcliffor/cred.json')
     parser.add_argument('--bucket_name', default='whc_dev')
     parser.add_argument('--folder', default='75472328-7a9a-4261-a611-04332f929f14/')
-    parser.add_argument('--batch', default=100)
-    parser.add_argument('--num_processes', default=1)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--num_processes', type=int, default=8, help='Number of signing processes. 0 to sign in this process')
+    parser.add_argument('--expiration', type=int, default=MAX_EXPIRATION, help='Seconds for which URLs are valid')
+    parser.add_argument('--manifest', default='./signed_urls.csv', help='Manifest file. Parquet if it ends with .parquet, else CSV')
     args = parser.parse_args()
 
     # if not os.path.exists('{}'.format(args.log_dir)):
@@ -378,7 +377,10 @@ if __name__ == '__main__':
     # errlogger.addHandler(err_fh)
     # err_fh.setFormatter(errformatter)
 
-    generate_signed_urls_mp(args)
+    if args.num_processes:
+        generate_signed_urls_mp(args)
+    else:
+        generate_signed_urls(args)
 
 
 
@@ -26,22 +26,21 @@
 # Because we may need to rerun this script more than once, we do not
 # empty the staging bucket when we begin.
 
-## Note: This script should typically be run with processes=512 and batch=100.
-## This requires a 16 core machine also will need to up the number of allowed
-## open files, e.g.:
+## Note: Each process has up to --concurrency copies in flight, so this script should
+## typically be run with about two processes per core. Many copies in flight will need
+## the number of allowed open files to be upped, e.g.:
 ## ulimit -n 4000
 
 
 import sys
 import argparse
 from googleapiclient import discovery
-from google.api_core.exceptions import Conflict, TooManyRequests, ServiceUnavailable, NotFound
+from google.api_core.exceptions import Conflict
 #from step2_import_bucket import import_buckets
 from utilities.logging_config import successlogger, progresslogger, errlogger
 import settings
 from google.cloud import storage, bigquery
-from multiprocessing import Process, Queue
-from time import  sleep
+from utilities.gcs_bulk_ops import run_bulk_ops, copy_op
 
 
 def get_gch_client():
@@ -111,80 +110,11 @@ def build_dones_table(args):
     )
     return table.num_rows
 
-# Populate a bucket with instances to be inserted in the DICOM store
-def copy_some_instances(args, client, uids, n):
-    try:
-        done = 0
-        dst_bucket = client.bucket(args.import_bucket_name)
-        for row in uids:
-            blob_id = row['blob_id']
-            BUCKET_TRIES = 10
-            for i in range(BUCKET_TRIES):
-                try:
-                    src_bucket = client.bucket(row['bucket'])
-                    src_blob = src_bucket.blob(blob_id)
-                    break
-                except AttributeError as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Trying to create bucket: {exc}; attempt {i}\n")
-                    sleep(1)
-                except TooManyRequests as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Too many requests: {repr(exc)};  {exc}\n")
-                    sleep(1)
-                except ServiceUnavailable as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Service unavailable: {repr(exc)};  {exc}\n")
-                    sleep(1)
-            if i == BUCKET_TRIES:
-                errlogger.error(
-                    f"p{args.id}: Failed to create bucket)")
-                break
-
-            dst_blob = dst_bucket.blob(blob_id)
-            rewrite_token = False
-            while True:
-                try:
-                    rewrite_token, bytes_rewritten, total_bytes = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        successlogger.info(f'{blob_id}')
-                        break
-                except AttributeError as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Trying to create bucket: {exc}; attempt {i}\n")
-                    sleep(1)
-                except TooManyRequests as exc0:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Too many requests: {repr(exc0)};  {exc0}")
-                    sleep(1)
-                except ServiceUnavailable as exc0:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Service unavailable: {repr(exc0)};  {exc0}")
-                    sleep(1)
-                except NotFound as exc:
-                    errlogger.error(
-                        f"p{args.id}: Blob: Source blob {row['bucket']}/{blob_id} not found")
-                    break
-
-                    break
-            done += 1
-        progresslogger.info(f"p{args.id}: {done + n}of{len(uids) + n}")
-    except Exception as exc2:
-        # breakpoint()
-        errlogger.error(f'p{args.id}: copy: exception type: {repr(exc2)}; {exc2}; row = {row}')
-    return
-
-def worker(input, args):
-    client = storage.Client()
-    for uids, n in iter(input.get, 'STOP'):
-        try:
-            copy_some_instances(args, client, uids, n)
-        except Exception as exc3:
-            # breakpoint()
-            errlogger.error(f'p{args.id}: worker, exception type: {repr(exc3)} exception {exc3}')
-    return
+# Copies of the instances to be inserted in the DICOM store to the import bucket
+def list_copies(args, client, destination):
+    for page in client.list_rows(destination, page_size=1000).pages:
+        for row in page:
+            yield copy_op(row.bucket, row.blob_id, args.import_bucket_name)
 
 
 def populate_import_buckets(args):
@@ -229,33 +159,10 @@ def populate_import_buckets(args):
 
     progresslogger.info(f'p{0}: {dones} of {dones+destination.num_rows} completed')
 
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
-        processes[-1].start()
-
     # Populate the staging bucket
-    n = dones
-    for page in client.list_rows(destination, page_size=args.batch).pages:
-        uuids = [{'blob_id':row.blob_id, 'bucket':row.bucket} \
-            for row in page]
-        if uuids:
-            task_queue.put((uuids,n))
-        n += args.batch
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-    # Wait for process to terminate
-    for process in processes:
-        progresslogger.info(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
+    run_bulk_ops(list_copies(args, client, destination), processes=int(args.processes),
+                 concurrency=int(args.concurrency), batch=int(args.batch),
+                 description=f'Populate {args.import_bucket_name}')
 
 
 def populate_buckets(args):
@@ -277,7 +184,8 @@ if __name__ == '__main__':
     parser.add_argument('--collections', default=(), help='Collections to include. If empty, include all collections')
     parser.add_argument('--bucket_project', default='nci-idc-bigquery-data', help='Project in which to build buckets')
     parser.add_argument('--processes', default=8)
-    parser.add_argument('--batch', default=100)
+    parser.add_argument('--concurrency', default=64, help='Maximum number of copies in flight per process')
+    parser.add_argument('--batch', default=1000)
     parser.add_argument('--dones_table_id', default='idc-dev-etl.whc_dev.step1_dones', help='BQ table from which to import dones')
     parser.add_argument('--log_dir', default=settings.LOG_DIR)
     parser.add_argument('--merged', default=False, help='True if premerge buckets have been merged')
@@ -62,6 +62,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', default=settings.CURRENT_VERSION)
     parser.add_argument('--processes', default=8, help="Number of concurrent processes")
+    parser.add_argument('--concurrency', default=64, help="Maximum number of batched deletes in flight per process")
     parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
     args = parser.parse_args()
 
@@ -57,6 +57,18 @@ def get_undone_series(args: object) -> object:
     return(list(all_series['se_uuid'].unique()), undone_series)
 
 
+# Get the index entries of the series that were packed by zip_prestaging_buckets_to_archive,
+# indexed by se_uuid: {se_uuid: (pack_name, {"se_uuid":..., "offset":..., "length":..., "crc32c":...})}
+def get_packed_series(dst_bucket):
+    packed = {}
+    for blob in dst_bucket.list_blobs(prefix='pack_'):
+        if blob.name.endswith('.pack.json'):
+            index = json.loads(blob.download_as_bytes())
+            for entry in index['series']:
+                packed[entry['se_uuid']] = (index['pack'], entry)
+    return packed
+
+
 def validate_zip(args, se_uuid, src_bucket, dst_bucket):
     chunk_size = pow(2,26)
     start_time = time.time()
@@ -64,6 +76,19 @@ def validate_zip(args, se_uuid, src_bucket, dst_bucket):
     for blob in src_bucket.list_blobs(prefix=se_uuid):
         blobs[blob.name] = blob.crc32c
     def zipped_chunks():
+        if se_uuid in args.packed:
+            # The zip of the series is a byte range of a pack
+            pack_name, entry = args.packed[se_uuid]
+            with dst_bucket.blob(pack_name).open(mode="rb") as archive:
+                archive.seek(entry['offset'])
+                remaining = entry['length']
+                while remaining:
+                    chunk = archive.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            return
         with dst_bucket.blob(f'{se_uuid}.zip').open(mode="rb") as archive:
             # yield from archive.read(chunk_size)
             while True:
@@ -128,6 +153,8 @@ def validate_prestaging_bucket(args):
     # all_series is a list of all series uuids
     # undones is a dataframe of metadata of the series which have not yet been zipped
     all_series, src_bucket_undones = get_undone_series(args)
+    # Series that were packed are validated by a ranged read of their pack
+    args.packed = get_packed_series(dst_client.bucket(args.dst_bucket))
 
     # Zip generation is performed by a pipeline of process
     # Create a queue, one slot for each process
@@ -19,9 +19,9 @@
 import argparse
 import json
 
-import pandas
 import logging
 from utilities.logging_config import successlogger, progresslogger, errlogger, warninglogger
+from utilities.checkpoints import get_checkpoint_store
 from multiprocessing import Queue, Process, Lock, Condition, shared_memory
 import settings
 import sys
@@ -34,9 +34,9 @@ from stream_unzip import stream_unzip
 from datetime import datetime
 from stat import S_IFREG
 import time
-from pandas import Series
 import crc32c
 import base64
+import random
 
 
 # Get a list of the UUIDs of the series which have not been zipped and copied to GCS.
@@ -52,21 +52,37 @@ def get_undone_series(args: object) -> object:
         ORDER BY src_bucket, se_uuid
     """
 
-    done_series = open(successlogger.handlers[0].baseFilename).read().splitlines()
     all_series = client.query(query).to_dataframe()
-    done_uuids = Series(done_series, name='se_uuid')
-    undone_series = pandas.merge(all_series, done_uuids, how='left', on="se_uuid", indicator='_merge').query('_merge == "left_only"')
-    undone_series = undone_series.drop(columns='_merge')
+    undone_uuids = set(get_done_series(args).filter_undone(all_series['se_uuid'].unique()))
+    undone_series = all_series[all_series['se_uuid'].isin(undone_uuids)]
     return(list(all_series['se_uuid'].unique()), undone_series)
 
 
-def validate_zip(args, se_uuid, src_bucket, dst_bucket):
+# The checkpoint store of zipped series. Imported from the success log on the first run
+def get_done_series(args):
+    return get_checkpoint_store(f'zip_prestaging_v{args.version}', settings.LOG_DIR,
+                                successlogger.handlers[0].baseFilename)
+
+
+def validate_zip(args, se_uuid, src_bucket, dst_bucket, pack_name=None, entry=None):
     chunk_size = pow(2,26)
     start_time = time.time()
     blobs = {}
     for blob in src_bucket.list_blobs(prefix=se_uuid):
         blobs[blob.name] = blob.crc32c
     def zipped_chunks():
+        if pack_name:
+            # The zip of the series is the byte range of the pack given by its index entry
+            with dst_bucket.blob(pack_name).open(mode="rb") as archive:
+                archive.seek(entry['offset'])
+                remaining = entry['length']
+                while remaining:
+                    chunk = archive.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            return
         with dst_bucket.blob(f'{se_uuid}.zip').open(mode="rb") as archive:
             # yield from archive.read(chunk_size)
             while True:
@@ -95,20 +111,25 @@ def validate_zip(args, se_uuid, src_bucket, dst_bucket):
         return 1
 
 
-def gen_zip_stream(se_uuid, src_bucket, dst_bucket):
-    # directory = pathlib.Path(src_directory)
-    chunk_size = pow(2,26)
-    blobs = src_bucket.list_blobs(prefix=se_uuid)
+def crc32c_b64(hash):
+    return base64.b64encode(hash.digest()).decode()
 
+
+# Generate the chunks of the zip of a series. The CRC32C of each member is computed as it is
+# streamed, and recorded in member_hashes
+def series_zip_chunks(blobs, member_hashes, chunk_size):
     def local_files(blobs):
         now = datetime.now()
         def contents(blob):
+            hash = crc32c.CRC32CHash()
             with blob.open('rb') as f:
                 while True:
                     chunk = f.read(chunk_size)
                     if not chunk:
                         break
+                    hash.update(chunk)
                     yield chunk
+            member_hashes[blob.name] = crc32c_b64(hash)
 
         def return_value(blob):
             return (blob.name, now, S_IFREG | 0o600, ZIP_64, contents(blob))
@@ -119,18 +140,104 @@ def gen_zip_stream(se_uuid, src_bucket, dst_bucket):
         )
 
     get_compressobj = lambda: zlib.compressobj(wbits=-zlib.MAX_WBITS, level=0)
+    yield from stream_zip(local_files(blobs), chunk_size=chunk_size, get_compressobj=get_compressobj)
+
+
+# Check that each member was zipped with the crc32c of its source blob. Returns 0 if so, else 1
+def validate_members(args, se_uuid, blobs, member_hashes):
+    bad_members = [blob.name for blob in blobs if member_hashes.get(blob.name) != blob.crc32c]
+    if bad_members:
+        errlogger.error(f'p{args.pid:03}: Validation failure on {se_uuid}: crc32c mismatch on {bad_members}')
+        return 1
+    return 0
+
+
+# Check that GCS computed the same crc32c for an uploaded archive as we did. Returns 0 if so, else 1
+def validate_upload(args, archive_name, dst_bucket, archive_hash):
+    uploaded_crc32c = dst_bucket.get_blob(archive_name).crc32c
+    if uploaded_crc32c != crc32c_b64(archive_hash):
+        errlogger.error(f'p{args.pid:03}: Validation failure on {archive_name}: archive crc32c {uploaded_crc32c} != {crc32c_b64(archive_hash)}')
+        return 1
+    return 0
+
+
+# Zip a series into <se_uuid>.zip in the dst_bucket, validating it in the same pass.
+# The CRC32C of each member is computed as it is streamed and compared against the crc32c
+# of its source blob. The CRC32C of the archive is accumulated as it is uploaded and
+# compared against the crc32c that GCS computed for the uploaded object.
+# Returns 0 if the archive is valid, else 1
+def gen_zip_stream(args, se_uuid, src_bucket, dst_bucket):
+    # directory = pathlib.Path(src_directory)
+    chunk_size = pow(2,26)
+    blobs = list(src_bucket.list_blobs(prefix=se_uuid))
+    member_hashes = {}
+
+    archive_hash = crc32c.CRC32CHash()
     with dst_bucket.blob(f'{se_uuid}.zip').open(mode="wb", chunk_size=chunk_size) as archive:
-        for chunk in stream_zip(local_files(blobs), chunk_size=chunk_size, get_compressobj=get_compressobj):
+        for chunk in series_zip_chunks(blobs, member_hashes, chunk_size):
             # print(f'p{args.pid}  Zip: {psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2}')
+            archive_hash.update(chunk)
             archive.write(chunk)
 
+    result = validate_members(args, se_uuid, blobs, member_hashes)
+    return validate_upload(args, f'{se_uuid}.zip', dst_bucket, archive_hash) or result
+
+
+# The name of the pack of a group of series, and of its sidecar index
+def pack_names(se_uuids):
+    pack_name = f'pack_{se_uuids[0]}.pack'
+    return pack_name, f'{pack_name}.json'
+
+
+# Zip each of a group of small series, and write the zips back to back into a single pack object.
+# Each series' zip is a complete zip, so a series can be extracted by a ranged read of the pack.
+# A sidecar index object records the byte offset, length and CRC32C of the zip of each series:
+#   {"pack": <pack name>, "series": [{"se_uuid":..., "offset":..., "length":..., "crc32c":...}, ...]}
+# Returns 0 if the pack is valid, else 1. An invalid pack is deleted.
+def gen_pack_stream(args, se_uuids, src_bucket, dst_bucket):
+    chunk_size = pow(2,26)
+    pack_name, index_name = pack_names(se_uuids)
+    result = 0
+    entries = []
+    offset = 0
+    archive_hash = crc32c.CRC32CHash()
+    with dst_bucket.blob(pack_name).open(mode="wb", chunk_size=chunk_size) as archive:
+        for se_uuid in se_uuids:
+            blobs = list(src_bucket.list_blobs(prefix=se_uuid))
+            member_hashes = {}
+            series_hash = crc32c.CRC32CHash()
+            length = 0
+            for chunk in series_zip_chunks(blobs, member_hashes, chunk_size):
+                archive_hash.update(chunk)
+                series_hash.update(chunk)
+                length += len(chunk)
+                archive.write(chunk)
+            result = validate_members(args, se_uuid, blobs, member_hashes) or result
+            entries.append(dict(se_uuid=se_uuid, offset=offset, length=length, crc32c=crc32c_b64(series_hash)))
+            offset += length
+
+    result = validate_upload(args, pack_name, dst_bucket, archive_hash) or result
+    if result:
+        dst_bucket.blob(pack_name).delete()
+        return result
+    dst_bucket.blob(index_name).upload_from_string(json.dumps(dict(pack=pack_name, series=entries)),
+                                                   content_type='application/json')
+    if args.validate_sample:
+        for entry in entries:
+            if random.random() < args.validate_sample:
+                result = validate_zip(args, entry['se_uuid'], src_bucket, dst_bucket, pack_name, entry) or result
+    return result
+
 
 def zip_worker(zip_queue, args):
 
     client = storage.Client()
     prev_src_bucket_name = ""
+    random.seed(args.pid)
+    done_series = get_done_series(args)
 
     for more_args in iter(zip_queue.get, 'STOP'):
+        # se_uuid is a list of series uuids if the series are to be packed
         series_index, se_uuid, src_bucket_name, dst_bucket_name, se_size = more_args
         try:
             if src_bucket_name != prev_src_bucket_name:
@@ -138,17 +245,33 @@ def zip_worker(zip_queue, args):
                 dst_bucket = client.bucket(dst_bucket_name)
                 prev_src_bucket_name = src_bucket_name
             start_time = time.time()
-            gen_zip_stream(se_uuid, src_bucket, dst_bucket)
+            if isinstance(se_uuid, list):
+                result = gen_pack_stream(args, se_uuid, src_bucket, dst_bucket)
+            else:
+                result = gen_zip_stream(args, se_uuid, src_bucket, dst_bucket)
             elapsed_time = time.time() - start_time
             start_time = time.time()
             rate = round(se_size / elapsed_time / 10 ** 6, 1)
-            if validate_zip(args, se_uuid, src_bucket, dst_bucket) == 0:
-                progresslogger.info(
-                    f'p{args.pid:03}:    {series_index}:{se_uuid}, {round(se_size / pow(10, 6), 2)}MB, {rate}MB/s, zip time:{round(elapsed_time, 2)}s, val time:{round((time.time()-start_time), 2)}s')
-                successlogger.info(se_uuid)
+            # Optionally read back a sample of the archives, and validate them against the source.
+            # Packs sample their series as they are written.
+            if result == 0 and not isinstance(se_uuid, list) and random.random() < args.validate_sample:
+                result = validate_zip(args, se_uuid, src_bucket, dst_bucket)
+            if result == 0:
+                if isinstance(se_uuid, list):
+                    progresslogger.info(
+                        f'p{args.pid:03}:    {series_index}:{pack_names(se_uuid)[0]}, {len(se_uuid)} series, {round(se_size / pow(10, 6), 2)}MB, {rate}MB/s, zip time:{round(elapsed_time, 2)}s, val time:{round((time.time()-start_time), 2)}s')
+                    for uuid in se_uuid:
+                        successlogger.info(uuid)
+                        done_series.mark_done(uuid)
+                else:
+                    progresslogger.info(
+                        f'p{args.pid:03}:    {series_index}:{se_uuid}, {round(se_size / pow(10, 6), 2)}MB, {rate}MB/s, zip time:{round(elapsed_time, 2)}s, val time:{round((time.time()-start_time), 2)}s')
+                    successlogger.info(se_uuid)
+                    done_series.mark_done(se_uuid)
 
         except Exception as exc:
             errlogger.error(f'zip{args.pid:03}:    zip{args.pid}: {se_uuid}: {exc}')
+    done_series.close()
     return
 
 
@@ -218,12 +341,25 @@ def main(args):
             doilogger.info(f'p0:     Processing {src_bucket}, {bucket_size}GB, {series_count} series, {instance_count} instances, {init_index}:{final_index}')
             start_time = time.time()
             # for _, series in src_bucket_undones.iterrows():
+            # Series smaller than pack_size are grouped into packs of about pack_size bytes
+            pack = []
+            pack_size = 0
             for se_uuid in src_bucket_undones['se_uuid'].unique():
                 series_data = src_bucket_undones[src_bucket_undones['se_uuid'] == se_uuid]
                 # series_size = series_data['i_size'].sum()
                 series_size = series_data.at[series_data.index[0],'se_size']
                 series_index = f'{init_index}:{all_series.index(se_uuid)}:{final_index}:{len(all_series)}'
-                zip_queue.put((series_index, se_uuid, src_bucket, dst_bucket_name, series_size))
+                if args.pack_size and series_size < args.pack_size:
+                    pack.append(se_uuid)
+                    pack_size += series_size
+                    if pack_size >= args.pack_size:
+                        zip_queue.put((series_index, pack, src_bucket, dst_bucket_name, pack_size))
+                        pack = []
+                        pack_size = 0
+                else:
+                    zip_queue.put((series_index, se_uuid, src_bucket, dst_bucket_name, series_size))
+            if pack:
+                zip_queue.put((series_index, pack, src_bucket, dst_bucket_name, pack_size))
 
             elapsed_time = time.time() - start_time
             total_gb += bucket_size
@@ -267,6 +403,10 @@ if __name__ == '__main__':
     parser.add_argument('--version', default=settings.CURRENT_VERSION, help='Version to work on')
     parser.add_argument('--num_processes', default=1)
     parser.add_argument('--dst_project', default='idc-archive', help='Project of the dst_bucket')
+    parser.add_argument('--validate_sample', type=float, default=0.0, \
+                        help='Fraction of archives that are also read back and revalidated against the source')
+    parser.add_argument('--pack_size', type=int, default=0, \
+                        help='Target size in bytes of packs of small series. Series smaller than this are packed. 0 to not pack')
     args = parser.parse_args()
 
     print("{}".format(args), file=sys.stdout)
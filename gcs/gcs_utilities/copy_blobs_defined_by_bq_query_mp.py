@@ -18,15 +18,11 @@
 # Copy a set of blobs defined by a BQ query
 
 
-import json
-import os
-import argparse
-import logging
-from logging import INFO
-from google.cloud import bigquery, storage
-import time
-from multiprocessing import Process, Queue
-from utilities.logging_config import successlogger, progresslogger, errlogger
+from google.cloud import bigquery
+from python_settings import settings
+from utilities.logging_config import successlogger
+from utilities.checkpoints import get_checkpoint_store
+from utilities.gcs_bulk_ops import run_bulk_ops, copy_op, DEFAULT_CONCURRENCY
 
 
 # The query should return a table with a single column, 'blob_name'
@@ -40,48 +36,12 @@ def blob_names(args, query):
     return destination
 
 
-TRIES = 3
-def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
-
-    progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
-
-
-def worker(input, args, dones):
-    # proglogger.info('p%s: Worker starting: args: %s', args.id, args )
-    # print(f'p{args.id}: Worker starting: args: {args}')
-
-    RETRIES=3
+def list_copies(args, blobs):
+    client = bigquery.Client()
+    for page in client.list_rows(blobs, page_size=int(args.batch)).pages:
+        for row in page:
+            yield copy_op(args.src_bucket, row.blob_name, args.dst_bucket)
 
-    client = storage.Client()
-    src_bucket = storage.Bucket(client, args.src_bucket)
-    dst_bucket = storage.Bucket(client, args.dst_bucket)
-    for blob_names, n in iter(input.get, 'STOP'):
-        blob_names_todo = sorted(list(set(blob_names) - dones))
-        if blob_names_todo:
-            copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n)
-        else:
-            progresslogger.info(f'p{args.id}: Blobs {n}:{n+len(blob_names)-1} previously copied')
 
 # Copy the blobs resulting from the BQ query
 # args must have the following components:
@@ -90,44 +50,21 @@ def worker(input, args, dones):
 # dst_bucket: Bucket to which to copy)
 # batch: Batch size to workers)
 # processes: Number of processes to run)
+# and optionally:
+# concurrency: Maximum number of copies in flight per process
 
 def copy_all_blobs(args, query):
-    bq_client = bigquery.Client()
     blobs = blob_names(args, query)
-    dones = set(open(f'{successlogger.handlers[0].baseFilename}').read().splitlines())
-
-    strt = time.time()
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args, dones)))
-        processes[-1].start()
-
-    # Distribute the work across the task_queues
-    n = 0
-    for page in bq_client.list_rows(blobs, page_size=args.batch).pages:
-        urls = [row.blob_name for row in page]
-        task_queue.put((urls, n))
-        # print(f'Queued {n}:{n+args.batch-1}')
-        n += page.num_items
-    print('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
+    # Previously copied blobs. Imported from the success log on the first run
+    dones = get_checkpoint_store(f'copy_{args.src_bucket}_to_{args.dst_bucket}', settings.LOG_DIR,
+                                 successlogger.handlers[0].baseFilename)
+
+    metrics = run_bulk_ops(list_copies(args, blobs), processes=int(args.processes),
+                           concurrency=int(getattr(args, 'concurrency', DEFAULT_CONCURRENCY)),
+                           batch=int(args.batch), checkpoint=dones,
+                           description=f'Copy {args.src_bucket} to {args.dst_bucket}')
+    dones.close()
+    return metrics
 
 
 # if __name__ == '__main__':
@@ -22,10 +22,9 @@ that hold all IDC data across all versions (not just the current version)
 to open/public buckets.
 """
 
-from utilities.logging_config import successlogger, progresslogger, errlogger
-import time
-from multiprocessing import Process, Queue
-from google.cloud import storage, bigquery
+from utilities.logging_config import progresslogger, errlogger
+from utilities.gcs_bulk_ops import run_bulk_ops, copy_op, DEFAULT_CONCURRENCY
+from google.cloud import storage
 
 from python_settings import settings
 import settings as etl_settings
@@ -34,110 +33,28 @@ if not settings.configured:
     settings.configure(etl_settings)
 assert settings.configured
 
-TRIES = 3
-
-def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
-
-    progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
-
-
-def worker(input, args, dones):
-    # proglogger.info('p%s: Worker starting: args: %s', args.id, args )
-    # print(f'p{args.id}: Worker starting: args: {args}')
-
-    RETRIES=3
-
-    client = storage.Client()
-    src_bucket = storage.Bucket(client, args.src_bucket)
-    dst_bucket = storage.Bucket(client, args.dst_bucket)
-    for blob_names, n in iter(input.get, 'STOP'):
-        try:
-            blob_names_todo = blob_names - dones
-            if blob_names_todo:
-                copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n)
-            else:
-                progresslogger.info(f'p{args.id}: Blobs {n}:{n+len(blob_names)-1} previously copied')
-        except Exception as exc:
-            errlogger.error(f'p{args.id}: Error {exc}')
 
+def list_copies(args, client):
+    iterator = client.list_blobs(args.src_bucket, page_size=1000)
+    for page in iterator.pages:
+        for blob in page:
+            yield copy_op(args.src_bucket, blob.name, args.dst_bucket)
 
 
+# dones is the Checkpoint_Store of blobs already copied
 def copy_all_instances(args, dones):
     client = storage.Client()
-    src_bucket = storage.Bucket(client, args.src_bucket)
-    n=len(dones)
-
-    progresslogger.info(f"{len(dones)} blobs previously copied")
-
+    progresslogger.info(f"{dones.count()} blobs previously copied")
     progresslogger.info(f'Copying bucket {args.src_bucket} to {args.dst_bucket}, ')
 
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-
-    strt = time.time()
-
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args, dones)))
-        processes[-1].start()
-
-    # Distribute the work across the task_queues
-    n = 0
-    iterator = client.list_blobs(src_bucket,  page_size=args.batch)
-    for page in iterator.pages:
-        if page.num_items:
-            blobs = set([blob.name for blob in page])
-            # blobs = blobs - dones
-            task_queue.put((blobs, n))
-            # print(f'Queued {n}:{n+len(blobs)-1}')
-        else:
-            break
-        n += page.num_items
-    progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
-    errors = open(errlogger.handlers[0].baseFilename).read().splitlines()
-    error_buckets = set([error.split(' ')[1].split('/')[0] for error in errors])
-    if src_bucket in error_buckets:
-        print(f'Bucket {args.src_bucket} had errors')
+    metrics = run_bulk_ops(list_copies(args, client), processes=int(args.processes),
+                           concurrency=int(getattr(args, 'concurrency', DEFAULT_CONCURRENCY)),
+                           batch=int(args.batch), checkpoint=dones,
+                           description=f'Copy {args.src_bucket} to {args.dst_bucket}')
+    if metrics.failed():
+        errlogger.error(f'Bucket {args.src_bucket} had {metrics.failed()} failed copies')
     else:
-        progresslogger.info(f'Completed bucket {args.src_bucket}, {rate} instances/sec, {num_processes} processes')
+        progresslogger.info(f'Completed bucket {args.src_bucket}')
 
 
 # if __name__ == '__main__':
@@ -26,7 +26,7 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 
 import settings
 from google.cloud import storage, bigquery
-from copy_blobs_using_BQ_query.copy_blobs_mp import copy_all_blobs
+from gcs.gcs_utilities.copy_blobs_defined_by_bq_query_mp import copy_all_blobs
 
 
 def preview_copies(args):
@@ -70,7 +70,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', default=settings.CURRENT_VERSION, help='Version to work on')
     parser.add_argument('--processes', default=16, help="Number of concurrent processes")
-    parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
+    parser.add_argument('--concurrency', default=64, help="Maximum number of copies in flight per process")
+    parser.add_argument('--batch', default=1000, help='Size of batch assigned to each process')
     args = parser.parse_args()
     args.id = 0 # Default process ID
 
@@ -20,6 +20,8 @@ The prefix length is the number of hex digits in the prefix. The number of proce
 is separately specified. The number of prefixes is 16^prefix_length.
 Thus, a prefix_length of 2 will create 256 prefixes, and can be efficiently processed
 by 256 processes.
+With --inventory, the blobs are counted from a local inventory of the bucket. The prefixes of
+the inventory that were refreshed less than --inventory_max_age hours ago are not relisted.
 """
 
 import argparse
@@ -27,6 +29,7 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 from multiprocessing import Process, Queue
 from google.cloud import storage
 from python_settings import settings
+from utilities.bucket_inventory import get_bucket_inventory
 
 def worker(input, output, args):
     client = storage.Client()
@@ -43,6 +46,14 @@ def worker(input, output, args):
         successlogger.info(f'Prefix {prefix} has {blobs} blobs')
         output.put(blobs)
 
+def count_all_instances_inventory(args):
+    inventory = get_bucket_inventory(args.bucket, settings.LOG_DIR, int(args.prefix_length))
+    max_age = float(args.inventory_max_age) * 3600 if args.inventory_max_age else None
+    if inventory.refresh(num_processes=int(args.num_processes), max_age=max_age):
+        errlogger.error(f'Some prefixes of bucket {args.bucket} could not be listed')
+    successlogger.info(f'Total blobs in bucket {args.bucket} is {inventory.count()}')
+
+
 def count_all_instances(args):
     all_blobs = 0
     processes = []
@@ -82,7 +93,12 @@ if __name__ == '__main__':
     parser.add_argument('--bucket', default='dicom_store_import_v21_idc-open-idc1_idc-dev-etl', help='Bucket to count')
     parser.add_argument('--num_processes', default=256, help='Number of concurrent processes')
     parser.add_argument('--prefix_length', default=2, help='Prefix length')
+    parser.add_argument('--inventory', default=False, help='Count from a local inventory of the bucket')
+    parser.add_argument('--inventory_max_age', default=None, help='Hours after which a prefix of the inventory is relisted. Relist all prefixes if not set')
     args = parser.parse_args()
 
-    count_all_instances(args)
+    if args.inventory:
+        count_all_instances_inventory(args)
+    else:
+        count_all_instances(args)
 
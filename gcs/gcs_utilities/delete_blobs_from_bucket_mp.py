@@ -15,25 +15,17 @@
 #
 
 """
-Multiprocess bucket emptier. Does not delete the bucket.
-May saturate a small VM, depending on the number of processes.
+Multiprocess deletion of a set of blobs from a bucket.
+Deletes are sent as batch requests of up to 100 deletes, and the outcome of each delete
+in a batch is checked separately. Only the deletes that were throttled or failed transiently
+are retried, with backoff. A blob is only logged as deleted, and checkpointed, after GCS has
+confirmed that it was deleted or that it did not exist, so the deletion can be restarted.
 """
 
 import argparse
-import os
-import logging
-import random
-# from logging import INFO
-# proglogger = logging.getLogger('root.prog')
-# successlogger = logging.getLogger('root.success')
-# errlogger = logging.getLogger('root.err')
-
-from utilities.logging_config import successlogger, progresslogger, errlogger
-
-import time
-from multiprocessing import Process, Queue
-from google.cloud import storage
-from google.api_core.exceptions import ServiceUnavailable, NotFound
+from utilities.logging_config import progresslogger, errlogger
+from utilities.checkpoints import get_checkpoint_store
+from utilities.gcs_bulk_ops import run_bulk_ops, delete_op, DEFAULT_CONCURRENCY
 
 from python_settings import settings
 import settings as etl_settings
@@ -43,85 +35,37 @@ if not settings.configured:
 assert settings.configured
 
 
-def delete_instances(args, client, bucket, blobs, n):
-    TRIES = 3
-    for batch_tries in range(TRIES):
-        try:
-            with client.batch():
-                for blob in blobs:
-                    for i in range(TRIES):
-                        try:
-                            bucket.blob(blob).delete()
-                            successlogger.info(blob)
-                            break
-                        except ServiceUnavailable:
-                            errlogger.error('p%s Delete %s blobs %s:%s failed; Service unavailable', args.id, args.bucket, n, n+len(blobs)-1)
-                            time.sleep(1)
-                        except NotFound:
-                            errlogger.error('p%s Delete %s blobs %s:%s failed, not found', args.id, args.bucket, n, n+len(blobs)-1)
-                            break
-                        except Exception as exc:
-                            errlogger.error('p%s Exception %s %s:%s', args.id, exc, n, n+len(blobs)-1)
-                            time.sleep(1)
-            progresslogger.info('p%s Deleted %s blobs %s:%s ', args.id, args.bucket, n,
-                                n + len(blobs) - 1)
-            break
-        except Exception as exc:
-            errlogger.error('p%s Batch level exception %s %s:%s', args.id, exc, n, n + len(blobs) - 1)
-            time.sleep(1)
-
-
-
-def worker(input, args):
-    client = storage.Client()
-    bucket = storage.Bucket(client, args.bucket)
-    for blobs, n in iter(input.get, 'STOP'):
-        try:
-            delete_instances(args, client, bucket, blobs, n)
-        except Exception as exc:
-            errlogger.error('p%s Exception %s %s:%s', args.id, exc, n, n+len(blobs)-1)
-            time.sleep(1)
-
-def del_instances(args, bucket, blob_list):
-    client = storage.Client()
-    bucket = storage.Bucket(client, bucket)
-
-    progresslogger.info(f'Deleting {len(blob_list)} blobs from bucket {args.bucket}')
-
-    num_processes = args.processes
-    processes = []
-
-    task_queue = Queue()
-
-    strt = time.time()
-
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
-        processes[-1].start()
-
-
-    # Distribute the work across the task_queues
-    n = 0
-    while n < len(blob_list):
-        blobs = blob_list[n:n+args.batch]
-        task_queue.put((blobs, n))
-
-    progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        # print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
-    progresslogger.info(f'Completed bucket {args.bucket}, {rate} instances/sec, {num_processes} processes')
-
+def read_blob_names(file_name):
+    with open(file_name) as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+# Delete an iterable of blob names from bucket
+def del_instances(args, bucket, blob_names):
+    # Blobs already deleted. The success log of earlier versions of this script was written before
+    # each batch was sent, so it is not imported: a blob it names may not have been deleted.
+    dones = get_checkpoint_store(f'delete_{bucket}', settings.LOG_DIR)
+    progresslogger.info(f'Deleting blobs from bucket {bucket}; {dones.count()} previously deleted')
+
+    metrics = run_bulk_ops((delete_op(bucket, blob_name) for blob_name in blob_names),
+                           processes=int(args.processes),
+                           concurrency=int(getattr(args, 'concurrency', DEFAULT_CONCURRENCY)),
+                           batch=int(args.batch), checkpoint=dones, description=f'Delete from {bucket}')
+    dones.close()
+    if metrics.failed():
+        errlogger.error(f'{metrics.failed()} blobs could not be deleted from bucket {bucket}')
+    return metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bucket', required=True, help='Bucket from which to delete blobs')
+    parser.add_argument('--blob_names', required=True, help='File of the names of the blobs to delete, one per line')
+    parser.add_argument('--processes', default=8, help="Number of concurrent processes")
+    parser.add_argument('--concurrency', default=64, help="Maximum number of batched deletes in flight per process")
+    parser.add_argument('--batch', default=1000, help='Size of batch assigned to each process')
+    args = parser.parse_args()
+
+    del_instances(args, args.bucket, read_blob_names(args.blob_names))
@@ -19,21 +19,10 @@ Multiprocess bucket emptier. Does not delete the bucket.
 May saturate a small VM, depending on the number of processes.
 """
 
-import argparse
-import os
-import logging
 import random
-# from logging import INFO
-# proglogger = logging.getLogger('root.prog')
-# successlogger = logging.getLogger('root.success')
-# errlogger = logging.getLogger('root.err')
-
-from utilities.logging_config import successlogger, progresslogger, errlogger
-
-import time
-from multiprocessing import Process, Queue
+from utilities.logging_config import progresslogger
+from utilities.gcs_bulk_ops import run_bulk_ops, delete_op, DEFAULT_CONCURRENCY
 from google.cloud import storage
-from google.api_core.exceptions import ServiceUnavailable, NotFound
 
 from python_settings import settings
 import settings as etl_settings
@@ -42,111 +31,31 @@ if not settings.configured:
     settings.configure(etl_settings)
 assert settings.configured
 
+# Pages of the listing that are shuffled together, so that concurrent deletes are spread
+# across the key range rather than all hitting the same few names
+SHUFFLE_PAGES = 16
 
-def delete_instances(args, client, bucket, blobs, n):
-    TRIES = 3
-    for batch_tries in range(TRIES):
-        try:
-            with client.batch():
-                for blob in blobs:
-                    for i in range(TRIES):
-                        try:
-                            bucket.blob(blob).delete()
-                            successlogger.info(blob)
-                            break
-                        except ServiceUnavailable:
-                            errlogger.error('p%s Delete %s blobs %s:%s failed; Service unavailable', args.id, args.bucket, n, n+len(blobs)-1)
-                            time.sleep(1)
-                        except NotFound:
-                            errlogger.error('p%s Delete %s blobs %s:%s failed, not found', args.id, args.bucket, n, n+len(blobs)-1)
-                            break
-                        except Exception as exc:
-                            errlogger.error('p%s Exception %s %s:%s', args.id, exc, n, n+len(blobs)-1)
-                            time.sleep(1)
-            progresslogger.info('p%s Deleted %s blobs %s:%s ', args.id, args.bucket, n,
-                                n + len(blobs) - 1)
-            break
-        except Exception as exc:
-            errlogger.error('p%s Batch level exception %s %s:%s', args.id, exc, n, n + len(blobs) - 1)
-            time.sleep(1)
-
-
-
-def worker(input, args):
-    client = storage.Client()
-    bucket = storage.Bucket(client, args.bucket)
-    for blobs, n in iter(input.get, 'STOP'):
-        try:
-            delete_instances(args, client, bucket, blobs, n)
-        except Exception as exc:
-            errlogger.error('p%s Exception %s %s:%s', args.id, exc, n, n+len(blobs)-1)
-            time.sleep(1)
-
-def del_all_instances(args):
-    client = storage.Client()
-    bucket = storage.Bucket(client, args.bucket)
-
-    progresslogger.info(f'Deleting bucket {args.bucket}')
-
-    num_processes = args.processes
-    processes = []
 
-    task_queue = Queue()
-
-    strt = time.time()
-
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
-        processes[-1].start()
-
-
-    # Distribute the work across the task_queues
-    n = 0
-    page_token = ""
-    # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
-    # iterator = client.list_blobs(bucket, versions=True, page_token=page_token, page_size=args.batch)
-    iterator = client.list_blobs(bucket, page_size=args.batch)
+def list_deletes(args, client):
+    iterator = client.list_blobs(args.bucket, page_size=1000)
     pages = 0
-    all_blobs = []
+    blob_names = []
     for page in iterator.pages:
-        # blobs = [[blob.name, blob.generation] for blob in page]
-        blobs = [blob.name for blob in page]
-        all_blobs.extend(blobs)
+        blob_names.extend(blob.name for blob in page)
         pages += 1
-        if pages == num_processes:
-            random.shuffle(all_blobs)
-            while all_blobs:
-                blobs = all_blobs[:args.batch]
-                all_blobs = all_blobs[args.batch:]
-                task_queue.put((blobs, n))
-                n += len(blobs)
+        if pages == SHUFFLE_PAGES:
+            random.shuffle(blob_names)
+            yield from (delete_op(args.bucket, blob_name) for blob_name in blob_names)
+            blob_names = []
             pages = 0
-    while all_blobs:
-        blobs = all_blobs[:args.batch]
-        all_blobs = all_blobs[args.batch:]
-        task_queue.put((blobs, n))
-        n += len(blobs)
-
-        # print(f'Queued {n}:{n+len(blobs)-1}')
-        # task_queue.put((page, n))
-
-        n += page.num_items
-    progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
+    random.shuffle(blob_names)
+    yield from (delete_op(args.bucket, blob_name) for blob_name in blob_names)
 
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
 
+def del_all_instances(args):
+    client = storage.Client()
+    progresslogger.info(f'Deleting bucket {args.bucket}')
 
-    # Wait for process to terminate
-    for process in processes:
-        # print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
-    progresslogger.info(f'Completed bucket {args.bucket}, {rate} instances/sec, {num_processes} processes')
-
+    run_bulk_ops(list_deletes(args, client), processes=int(args.processes),
+                 concurrency=int(getattr(args, 'concurrency', DEFAULT_CONCURRENCY)),
+                 batch=int(args.batch), description=f'Empty {args.bucket}')
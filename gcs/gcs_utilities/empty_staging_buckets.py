@@ -26,6 +26,7 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--processes', default=8, help="Number of concurrent processes")
+    parser.add_argument('--concurrency', default=64, help="Maximum number of batched deletes in flight per process")
     parser.add_argument('--batch', default=1000, help='Size of batch assigned to each process')
     parser.add_argument('--project', default='idc-pdp-staging')
 
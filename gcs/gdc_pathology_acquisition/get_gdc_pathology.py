@@ -22,7 +22,11 @@ from operator import itemgetter
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from google.cloud import storage
 from base64 import b64decode
-from multiprocessing import Process, Queue
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 # url = "https://api.gdc.cancer.gov/files"
 # filters = {
@@ -144,13 +148,148 @@ def get_pathology_files(project_id):
 
 
 
-def copy_file_to_gcs(client, file, content, dst_bucket, gdc_version):
+# Bytes uploaded per request of a resumable upload. Must be a multiple of 256KiB
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAXTRIES = 5
+
+_http = threading.local()
+
+
+def get_http_session():
+    # A requests.Session per thread
+    if not hasattr(_http, 'session'):
+        _http.session = requests.Session()
+    return _http.session
+
+
+class Byte_Budget:
+    """Limits the total size of the files being transferred at once. A file larger than the
+    budget is transferred when no other file is in flight."""
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, size):
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.budget:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+# Parse the Range header of a 308 response to a resumable upload request,
+# returning the number of bytes that GCS has committed
+def committed_bytes(response):
+    if 'Range' not in response.headers:
+        return 0
+    return int(response.headers['Range'].split('-')[-1]) + 1
+
+
+# Upload data at offset of a resumable upload session. Returns the number of bytes committed,
+# which may be less than offset + len(data)
+def put_chunk(session_url, data, offset, total_size):
+    headers = {'Content-Range': f'bytes {offset}-{offset + len(data) - 1}/{total_size}'}
+    response = get_http_session().put(session_url, data=bytes(data), headers=headers)
+    if response.status_code == 308:
+        return committed_bytes(response)
+    response.raise_for_status()
+    return offset + len(data)
+
+
+# Ask GCS how many bytes of a resumable upload session it has committed
+def query_committed(session_url, total_size):
+    response = get_http_session().put(session_url, headers={'Content-Range': f'bytes */{total_size}'})
+    if response.status_code == 308:
+        return committed_bytes(response)
+    response.raise_for_status()
+    return total_size
+
+
+# Stream a GDC file into a resumable upload session. state.md5 is the MD5 of the first
+# state.hashed bytes of the file, and GCS has committed the first state.committed bytes.
+# The download starts at byte state.hashed; bytes before state.committed are only hashed.
+# At most UPLOAD_CHUNK_SIZE + DOWNLOAD_CHUNK_SIZE bytes are buffered. The last chunk, which
+# finalizes the object, is only uploaded if the MD5 of the whole file matches file["md5sum"].
+# Returns True if the object was finalized, False if the MD5 did not match
+def stream_file_to_session(file, session_url, state):
+    total_size = file['file_size']
+    data_endpt = "https://api.gdc.cancer.gov/data/{}".format(file["file_id"])
+    headers = {"Content-Type": "application/json"}
+    if state.hashed:
+        headers['Range'] = f'bytes={state.hashed}-'
+
+    def advance(buffer, n):
+        state.md5.update(buffer[:n])
+        state.hashed += n
+        del buffer[:n]
+
+    buffer = bytearray()
+    with get_http_session().get(data_endpt, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buffer.extend(chunk)
+            # Hash, but do not send, bytes that were committed by a previous attempt
+            if state.hashed < state.committed:
+                advance(buffer, min(state.committed - state.hashed, len(buffer)))
+            while len(buffer) >= UPLOAD_CHUNK_SIZE and state.hashed + len(buffer) < total_size:
+                state.committed = put_chunk(session_url, buffer[:UPLOAD_CHUNK_SIZE], state.hashed, total_size)
+                advance(buffer, state.committed - state.hashed)
+
+    if state.hashed + len(buffer) != total_size:
+        raise IOError(f'Received {state.hashed + len(buffer)} of {total_size} bytes')
+    # Check the hash of the complete file before finalizing the upload
+    final_md5 = state.md5.copy()
+    final_md5.update(buffer)
+    if final_md5.hexdigest() != file["md5sum"]:
+        return False
+    while buffer:
+        state.committed = put_chunk(session_url, buffer, state.hashed, total_size)
+        advance(buffer, state.committed - state.hashed)
+    return True
+
+
+# Stream a file from GDC to GCS. After a failure, the transfer resumes from the
+# last offset that GCS committed, rather than from the start of the file.
+def transfer_file(args, file, dst_bucket, gdc_version):
     blob = dst_bucket.blob(f'{gdc_version}/{file["file_name"]}')
-    result = blob.upload_from_string(content)
+    session_url = blob.create_resumable_upload_session(size=file['file_size'])
+    state = SimpleNamespace(md5=hashlib.md5(), hashed=0, committed=0)
+    start_time = time.time()
+    for _try in range(1, MAXTRIES + 1):
+        try:
+            if stream_file_to_session(file, session_url, state):
+                break
+            errlogger.error(f'Incorrect hash for {gdc_version}/{file["file_name"]}')
+            # Abandon the upload so that no object is created
+            get_http_session().delete(session_url)
+            return
+        except Exception as exc:
+            progresslogger.info(f'Transfer failure {_try}: {file["file_id"]}: {exc}')
+            try:
+                # GCS may have committed more, or less, than the last response told us
+                state.committed = query_committed(session_url, file['file_size'])
+            except Exception as exc:
+                pass
+            if state.committed < state.hashed:
+                # Bytes that we hashed were not all committed. Restart the file
+                state = SimpleNamespace(md5=hashlib.md5(), hashed=0, committed=state.committed)
+    else:
+        errlogger.error(f'Transfer failure: {file["file_id"]}')
+        return
+
+    blob.reload()
     try:
         assert file["md5sum"] == b64decode(blob.md5_hash).hex()
         successlogger.info(f'{file["file_name"]}')
-        progresslogger.info(f'p{args.id}  {file["file_id"]}')
+        elapsed_time = time.time() - start_time
+        progresslogger.info(f'{file["file_id"]}, {round(file["file_size"] / pow(10, 6), 2)}MB, '
+                            f'{round(file["file_size"] / elapsed_time / pow(10, 6), 1)}MB/s')
     except Exception as exc:
         errlogger.error(f'Incorrect or no hash for {gdc_version}/{file["file_name"]}; {exc}')
         # Need to delete the new blob
@@ -158,69 +297,31 @@ def copy_file_to_gcs(client, file, content, dst_bucket, gdc_version):
     return
 
 
-def download_file(args, file):
-    MAXTRIES = 3
-    _try = 1
-
-    file_id = file["file_id"]
-    data_endpt = "https://api.gdc.cancer.gov/data/{}".format(file_id)
-
-    while _try <= MAXTRIES:
-        try:
-            response = requests.get(data_endpt, headers={"Content-Type": "application/json"})
-            return response.content
-        except Exception as exc:
-            progresslogger.info(f'p{args.id}  Download failure {_try}: {file["file_id"]}')
-            _try += 1
-    errlogger.error(f'p{args.id}  Download failure: {file["file_id"]}')
-    return None
-
-
-def worker(input, args, dst_bucket_name):
+def transfer_worker(args, budget, file, dst_bucket):
     try:
-        client = storage.Client()
-        dst_bucket = client.bucket(bucket_name=dst_bucket_name)
+        # gdc_versions = get_gdc_version_of_file(file)
+        # gdc_version = gdc_versions[-1]['data_release']
+        history = file['history']
+        gdc_version = max(history, key=lambda version: version['data_release'])['data_release']
+        transfer_file(args, file, dst_bucket, gdc_version)
     except Exception as exc:
-        errlogger.error(f'p{args.id}:  {exc}')
-        exit(2)
-    for file, n  in iter (input.get, 'STOP'):
-        content = download_file(args, file)
-        if content:
-            # gdc_versions = get_gdc_version_of_file(file)
-            # gdc_version = gdc_versions[-1]['data_release']
-            history = file['history']
-            gdc_version = max(history, key=lambda version: version['data_release'])['data_release']
-            copy_file_to_gcs(client, file, content, dst_bucket, gdc_version)
+        errlogger.error(f'Transfer failure: {file["file_id"]}: {exc}')
+    finally:
+        budget.release(file['file_size'])
 
 
+# Transfer files on a pool of threads. The number of files in flight is limited by the total
+# of their sizes, args.bytes_in_flight, and by args.max_transfers
 def get_new_files(client, new_files, dst_bucket):
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args, dst_bucket.name)))
-        processes[-1].start()
-
-    # Distribute the work across the task_queues
+    budget = Byte_Budget(args.bytes_in_flight)
     n = 0
-    for file in new_files:
-        task_queue.put((file, n))
-        n += 1
-    print('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
+    with ThreadPoolExecutor(max_workers=args.max_transfers) as executor:
+        # Largest first, so that a large file does not start last
+        for file in sorted(new_files, key=lambda file: -file['file_size']):
+            budget.reserve(file['file_size'])
+            executor.submit(transfer_worker, args, budget, file, dst_bucket)
+            n += 1
+    print('Transfers complete; {} blobs'.format(n))
     return
 
 
@@ -311,7 +412,9 @@ def download_files(project_id, files):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--processes', default=8)
+    parser.add_argument('--max_transfers', type=int, default=32, help='Maximum number of concurrent transfers')
+    parser.add_argument('--bytes_in_flight', type=int, default=16 * pow(2, 30), \
+                        help='Maximum total size of the files being transferred at once')
     parser.add_argument('--min_gdc_version', default = "37.0", help="Skip files from previous versions")
     parser.add_argument("--ignore_dones", default=False, help="If True, process project even if previously processed")
     parser.add_argument("--projects", default=["CGCI-BLGSP"], help="List of projects to process. Process all procents if empty")
@@ -18,20 +18,21 @@
 import argparse
 from gcs.gcs_utilities.copy_bucket_mp import copy_all_instances
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.checkpoints import get_checkpoint_store
+import settings
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--processes', default=256, help="Number of concurrent processes")
-    parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
+    parser.add_argument('--processes', default=16, help="Number of concurrent processes")
+    parser.add_argument('--concurrency', default=64, help="Maximum number of copies in flight per process")
+    parser.add_argument('--batch', default=1000, help='Size of batch assigned to each process')
     parser.add_argument('--log_dir', default=f'/mnt/disks/idc-etl/logs/copy_bucket_mp')
 
     args = parser.parse_args()
 
-    try:
-        # Create a set of previously copied blobs
-        dones = set(open(successlogger.handlers[0].baseFilename).read().splitlines())
-    except:
-        dones = set([])
+    # Previously copied blobs. Imported from the success log on the first run
+    dones = get_checkpoint_store('copy_staging_buckets_to_public_buckets', settings.LOG_DIR,
+                                 successlogger.handlers[0].baseFilename)
 
     args.src_bucket = 'idc-open-data-staging'
     args.dst_bucket = 'idc-open-data'
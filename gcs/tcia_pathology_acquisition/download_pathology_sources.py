@@ -24,82 +24,73 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 from time import strftime, gmtime
 from multiprocessing import Process, Queue
 import time
-from subprocess import run
 import logging
 import contextlib
+from utilities.gcs_uploader import GCS_Uploader
 
 ASPERA_DOWNLOAD_FOLDER = '/mnt/disks/idc-etl/aspera'
 
-def copy_files_to_gcs(args, files, dst_bucket, TCIA_collection_version, slug, tag, aspera_delta):
-    try:
-        gcs_start = time.time()
-        file = files[0]
-        progresslogger.info(f'p{args.id}: Starting GCS transfer of {file["path"]}, {len(files)} files')
-
-        breakpoint()  # Configure gsutil so that it will not do multipart uploads
-        res = run(['gsutil', 'setprop', 'storage/parallel_composite_upload_enabled', 'False'])
-
-        if tag:
-            if tag.startswith('CMB') or tag in ('AML', 'BRCA', 'CCRCC', 'CM', 'COAD', 'GBM', 'HNSCC', 'LSCC', 'LUAD', 'OV', 'PDA', 'SAR', 'UCEC'):
-                cmmd = ' '.join(['gsutil', '-m', '-q', 'cp', f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"].rsplit("/",1)[0]}/*',
-                       f'gs://{dst_bucket.name}/{tag}/v{TCIA_collection_version}/{slug}/'])
-                res = run(['gsutil', '-m', '-q', 'cp', f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"].rsplit("/",1)[0]}/*',
-                           f'gs://{dst_bucket.name}/{tag}/v{TCIA_collection_version}/{slug}/'])
-            else:
-                cmmd = ' '.join(['gsutil', '-m', '-q', 'cp', f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"].rsplit("/",1)[0]}/*',
-                       f'gs://{dst_bucket.name}/{tag}/v{TCIA_collection_version}/{slug}{file["path"].rsplit("/",1)[0]}/'])
-                res = run(['gsutil', '-m', '-q', 'cp', f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"].rsplit("/",1)[0]}/*',
-                           f'gs://{dst_bucket.name}/{tag}/v{TCIA_collection_version}/{slug}{file["path"].rsplit("/",1)[0]}/'])
+# The name of the blob to which an Aspera file is copied
+def gcs_blob_name(file, TCIA_collection_version, slug, tag):
+    file_dir, file_name = file["path"].rsplit("/",1)
+    if tag:
+        if tag.startswith('CMB') or tag in ('AML', 'BRCA', 'CCRCC', 'CM', 'COAD', 'GBM', 'HNSCC', 'LSCC', 'LUAD', 'OV', 'PDA', 'SAR', 'UCEC'):
+            return f'{tag}/v{TCIA_collection_version}/{slug}/{file_name}'
         else:
-            cmmd = ' '.join(['gsutil', '-m', '-q', 'cp', f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"].rsplit("/",1)[0]}/*',
-                       f'gs://{dst_bucket.name}/v{TCIA_collection_version}/{slug}{file["path"].rsplit("/",1)[0]}'])
-            res = run(['gsutil', '-m', '-q', 'cp', f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"].rsplit("/",1)[0]}/*',
-                       f'gs://{dst_bucket.name}/v{TCIA_collection_version}/{slug}{file["path"].rsplit("/",1)[0]}'])
-        gcs_delta = time.time() - gcs_start
-
-        if res.stderr is not None:
-            errlogger.error(f'p{args.id}: Copy to GCS failed: {tag}/v{TCIA_collection_version}/{file["path"]}, {res.stderr}')
-            return
-
-        files_size = sum(os.path.getsize(f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"]}') for file in files)
-    except Exception as exc:
-        errlogger.error(
-            f'p{args.id}: Copy to GCS failed: {tag}/v{TCIA_collection_version}/{file["path"]}, {exc}')
-        # Try to delete the file
-        run(["rm", f'{ASPERA_DOWNLOAD_FOLDER}/{slug}{file["path"]}'])
-        return
-
-    # Delete the file
-    try:
-        for file in files:
-            res = run(["rm", f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"]}'])
-            if res.stderr is None:
-                successlogger.info(f'p{args.id}: {file["path"]}')
-            else:
-                errlogger.error(
-                    f'p{args.id}: Transfer to gcs failed: {tag}/v{TCIA_collection_version}/{file["path"]}, {res.stderr}')
-        progresslogger.info(
-            f'p{args.id}: {file["path"]}, {len(files)} files, size: {round(files_size / pow(10, 9), 2)} GB, aspera rate: {round(files_size / aspera_delta / pow(10, 6), 2)} MB/s, GCS rate: {round(files_size / gcs_delta / pow(10, 6), 2)} MB/s')
-    except Exception as exc:
-        errlogger.error(f'p{args.id}: Transfer to gcs failed: {tag}/v{TCIA_collection_version}/{file["path"]}, {exc}')
+            return f'{tag}/v{TCIA_collection_version}/{slug}{file_dir}/{file_name}'
+    else:
+        return f'v{TCIA_collection_version}/{slug}{file_dir}/{file_name}'
+
+
+# Submit the downloaded files to the uploader. Returns without waiting for the uploads, so that
+# the download of the next batch overlaps the upload of this one. Each local file is deleted
+# as soon as its upload is verified.
+def copy_files_to_gcs(args, uploader, files, dst_bucket, TCIA_collection_version, slug, tag, aspera_delta):
+    file = files[0]
+    progresslogger.info(f'p{args.id}: Starting GCS transfer of {file["path"]}, {len(files)} files')
+    files_size = 0
+    for file in files:
+        path = f'{ASPERA_DOWNLOAD_FOLDER}/{slug}/p{args.id}{file["path"]}'
+        try:
+            files_size += os.path.getsize(path)
+            uploader.upload(path, dst_bucket, gcs_blob_name(file, TCIA_collection_version, slug, tag),
+                            callback=lambda path, blob_name, metrics, file=file: log_upload(args, file, TCIA_collection_version, tag, metrics))
+        except Exception as exc:
+            errlogger.error(
+                f'p{args.id}: Copy to GCS failed: {tag}/v{TCIA_collection_version}/{file["path"]}, {exc}')
+    progresslogger.info(
+        f'p{args.id}: {file["path"]}, {len(files)} files, size: {round(files_size / pow(10, 9), 2)} GB, aspera rate: {round(files_size / aspera_delta / pow(10, 6), 2)} MB/s')
     return
 
 
+def log_upload(args, file, TCIA_collection_version, tag, metrics):
+    if metrics:
+        successlogger.info(f'p{args.id}: {file["path"]}')
+        progresslogger.info(f'p{args.id}: {file["path"]}, size: {round(metrics["size"] / pow(10, 6), 2)} MB, GCS rate: {round(metrics["rate"] / pow(10, 6), 2)} MB/s')
+    else:
+        errlogger.error(f'p{args.id}: Transfer to gcs failed: {tag}/v{TCIA_collection_version}/{file["path"]}')
+
+
 # Download a list of files from an Aspera package and copy to a specified GCS bucket
-def download_aspera_files_to_gcs(args, aspera_url, files, dst_bucket, slug, TCIA_collection_version, tag):
+def download_aspera_files_to_gcs(args, uploader, aspera_url, files, dst_bucket, slug, TCIA_collection_version, tag):
     duration = download_files_from_aspera(args, aspera_url, files, slug, TCIA_collection_version, tag)
     if duration:
-        copy_files_to_gcs(args, files, dst_bucket, TCIA_collection_version, slug, tag, duration)
+        copy_files_to_gcs(args, uploader, files, dst_bucket, TCIA_collection_version, slug, tag, duration)
     return
 
 
 def worker(input, args, aspera_url, dst_bucket, TCIA_collection_version, slug, tag):
     client = storage.Client()
+    # The parent's client is not safe to use after the fork
+    dst_bucket = client.bucket(dst_bucket.name)
+    # Uploads of one batch proceed on the uploader's threads while the next batch is downloaded
+    uploader = GCS_Uploader(num_threads=args.upload_threads)
     for files in iter(input.get, 'STOP'):
         try:
-            download_aspera_files_to_gcs(args, aspera_url, files, dst_bucket, slug, TCIA_collection_version, tag)
+            download_aspera_files_to_gcs(args, uploader, aspera_url, files, dst_bucket, slug, TCIA_collection_version, tag)
         except Exception as exc3:
             errlogger.error(f'p{args.id}: worker, exception type: {repr(exc3)} exception {exc3}')
+    uploader.close()
     return
 
 # Get a list of the files already in idc-source-data for a particular collections/bucket
@@ -346,6 +337,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--version", default=settings.CURRENT_VERSION-1)
     parser.add_argument('--processes', default=1)
+    parser.add_argument('--upload_threads', type=int, default=8, help='Number of upload threads per process')
     parser.add_argument('--mode', default='download')
     parser.add_argument("--dst_bucket_prefix", default="", help="dst_bucket ID prefix")
     parser.add_argument("--dst_bucket_suffix", default="_pathology_data", help="dst_bucket ID suffix")
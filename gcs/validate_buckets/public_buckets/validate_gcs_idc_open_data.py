@@ -37,6 +37,8 @@ if __name__ == '__main__':
     parser.add_argument('--expected_blobs', default=f'{settings.LOG_DIR}/expected_blobs.txt', help='List of blobs names expected to be in above collections')
     parser.add_argument('--found_blobs', default=f'{settings.LOG_DIR}/success.log', help='List of blobs names found in bucket')
     parser.add_argument('--find_blobs', default=True, help='Find blobs even if found_blobs bucket is not empty')
+    parser.add_argument('--inventory', default=False, help='Validate against a local inventory of the bucket')
+    parser.add_argument('--inventory_max_age', default=None, help='Hours after which a prefix of the inventory is relisted. Relist all prefixes if not set')
 
     parser.add_argument('--batch', default=10000, help='Size of batch assigned to each process')
     parser.add_argument('--log_dir', default=f'/mnt/disks/idc-etl/logs/validate_open_buckets')
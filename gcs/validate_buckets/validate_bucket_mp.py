@@ -23,6 +23,8 @@ import json
 # Noramlly the progresslogger file is trunacated. The following causes it to be appended.
 # builtins.APPEND_PROGRESSLOGGER = True
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.checkpoints import get_checkpoint_store
+from utilities.bucket_inventory import get_bucket_inventory
 from google.cloud import storage, bigquery
 from multiprocessing import Process, Queue
 
@@ -61,7 +63,7 @@ def get_expected_blobs_in_bucket(args, max_version):
     blob_names = set(query_job.result().to_dataframe()['blob_name'].to_list())
     return blob_names
 
-def worker(input, args):
+def worker(input, args, done_series):
     RETRIES=3
     client = storage.Client()
     bucket = client.bucket(args.bucket)
@@ -74,8 +76,10 @@ def worker(input, args):
                         for blob in page:
                             successlogger.info(blob.name)
                     progresslogger.info(series_uuid)
+                    done_series.mark_done(series_uuid)
                 except Exception as exc:
                     errlogger.error(f'p{args.id}: Error {exc}')
+    done_series.close()
 
 def get_found_series_in_bucket(args):
     client = storage.Client()
@@ -105,10 +109,11 @@ def get_found_blobs_in_bucket(args, found_series):
     bucket = client.bucket(args.bucket)
     progresslogger.info(f'Finding blobs in bucket')
 
-    done_series = open(f'{progresslogger.handlers[0].baseFilename}').read().splitlines()
+    # Series whose blobs have been found. Imported from the progress log on the first run
+    done_series = get_checkpoint_store(f'find_blobs_{args.bucket}', settings.LOG_DIR,
+                                       progresslogger.handlers[0].baseFilename)
 
-    undone_series = list(set(found_series) - set(done_series))
-    undone_series.sort()
+    undone_series = list(done_series.filter_undone(sorted(found_series)))
     # Start worker processes
     num_processes = args.processes
     processes = []
@@ -116,7 +121,7 @@ def get_found_blobs_in_bucket(args, found_series):
     for process in range(num_processes):
         args.id = process + 1
         processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
+            Process(group=None, target=worker, args=(task_queue, args, done_series)))
         processes[-1].start()
 
     # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
@@ -140,10 +145,7 @@ def get_found_blobs_in_bucket(args, found_series):
 
     # Verify that all series are done
     # Get the completed series
-    done_series = open(f'{progresslogger.handlers[0].baseFilename}').read().splitlines()
-
-    undone_series = list(set(found_series) - set(done_series))
-    undone_series.sort()
+    undone_series = list(done_series.filter_undone(sorted(found_series)))
     if undone_series:
         errlogger.error("Some series not done:")
         for series in undone_series:
@@ -153,7 +155,52 @@ def get_found_blobs_in_bucket(args, found_series):
 
 
 
+def report_differences(args, kind, unexpected, unfound):
+    if unexpected:
+        unexpected.sort()
+        errlogger.error(f"Unexpected {kind} in bucket: {len(unexpected)}")
+        for name in unexpected:
+            errlogger.error(name)
+        with open(f"{settings.LOG_DIR}/unexpected_{kind}.json", "w") as f:
+            json.dump(unexpected, f)
+    if unfound:
+        unfound.sort()
+        errlogger.error(f"Expected {kind} not found in bucket: {len(unfound)}")
+        for name in unfound:
+            errlogger.error(name)
+        with open(f"{settings.LOG_DIR}/unfound_{kind}.json", "w") as f:
+            json.dump(unfound, f)
+
+
+# Validate against a local inventory of the bucket. The partitions of the inventory that were refreshed
+# less than args.inventory_max_age hours ago are used as they are. The others are relisted, all of
+# them if inventory_max_age is not set.
+def check_all_instances_inventory(args, max_version):
+    inventory = get_bucket_inventory(args.bucket, settings.LOG_DIR)
+    max_age = getattr(args, 'inventory_max_age', None)
+    if inventory.refresh(num_processes=int(args.processes), max_age=float(max_age) * 3600 if max_age else None):
+        errlogger.error(f"Inventory of bucket {args.bucket} is incomplete")
+        return
+
+    unexpected_series, unfound_series = inventory.difference(get_expected_series_in_bucket(args, max_version), folders=True)
+    if not unexpected_series and not unfound_series:
+        progresslogger.info(f"Bucket {args.bucket} has the correct set of series")
+    else:
+        errlogger.error(f"Bucket {args.bucket} does not have the correct set of series")
+        report_differences(args, 'series', unexpected_series, unfound_series)
+
+    unexpected_blobs, unfound_blobs = inventory.difference(get_expected_blobs_in_bucket(args, max_version))
+    if not unexpected_blobs and not unfound_blobs:
+        successlogger.info(f"Bucket {args.bucket} has the correct set of blobs")
+    else:
+        errlogger.error(f"Bucket {args.bucket} does not have the correct set of blobs")
+        report_differences(args, 'blobs', unexpected_blobs, unfound_blobs)
+
+
 def check_all_instances_mp(args, max_version=settings.CURRENT_VERSION):
+    if getattr(args, 'inventory', False):
+        check_all_instances_inventory(args, max_version)
+        return
 
     found_series = get_found_series_in_bucket(args)
     expected_series = get_expected_series_in_bucket(args, max_version)
@@ -165,22 +212,8 @@ def check_all_instances_mp(args, max_version=settings.CURRENT_VERSION):
         unexpected_series = list(found_series - expected_series)
         unfound_series = list(expected_series - found_series)
         # Release memory
-        del found_series
         del expected_series
-        if unexpected_series:
-            unexpected_series.sort()
-            errlogger.error(f"Unexpected series in bucket: {len(unexpected_series)}")
-            for series in unexpected_series:
-                errlogger.error(series)
-            with open(f"{settings.LOG_DIR}/unexpected_series.json", "w") as f:
-                json.dump(unexpected_series, f)
-        if unfound_series:
-            unfound_series.sort()
-            errlogger.error(f"Expected series not found in bucket: {len(unfound_series)}")
-            for series in unfound_series:
-                errlogger.error(series)
-            with open(f"{settings.LOG_DIR}/unfound_series.json") as f:
-                json.dump(unfound_series, f)
+        report_differences(args, 'series', unexpected_series, unfound_series)
 
     found_blobs = set(open(args.found_blobs).read().splitlines())
     if not found_blobs or args.find_blobs:
@@ -202,21 +235,6 @@ def check_all_instances_mp(args, max_version=settings.CURRENT_VERSION):
         # Release memory
         del found_blobs
         del expected_blobs
-        if unexpected_blobs:
-            unexpected_blobs.sort()
-            errlogger.error(f"Unexpected blobs in bucket: {len(unexpected_blobs)}")
-            for blob in unexpected_blobs:
-                errlogger.error(blob)
-            with open(f"{settings.LOG_DIR}/unexpected_blobs.json", "w") as f:
-                json.dump(unexpected_blobs, f)
-        if unfound_blobs:
-            unfound_blobs.sort()
-            errlogger.error(f"Expected blobs not found in bucket: {len(unfound_blobs)}")
-            for blob in unfound_blobs:
-                errlogger.error(blob)
-            with open(f"{settings.LOG_DIR}/unfound_blobs.json", 'w') as f:
-                json.dump(unfound_blobs, f)
+        report_differences(args, 'blobs', unexpected_blobs, unfound_blobs)
 
     return
-
-
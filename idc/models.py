@@ -623,6 +623,14 @@ class Instance(Base):
                           secondary=series_instance,
                           back_populates='instances')
 
+# Objects of the versioned hierarchy whose hashes must be recomputed, because they, or
+# something below them, changed in some version. Ancestors of a dirty object are rehashed
+# only if its hash changed.
+merkle_dirty = Table('merkle_dirty', Base.metadata,
+                     Column('version', Integer, primary_key=True, comment="Version in which the object was touched"),
+                     Column('table_name', String, primary_key=True, comment="'series', 'study', 'patient', 'collection' or 'version'"),
+                     Column('id', String, primary_key=True, comment="Primary key of the object"))
+
 # Table that includes all IDC sourced collections.
 # This is a snapshot of what should be the current/next IDC version
 class IDC_Collection(Base):
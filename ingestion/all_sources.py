@@ -38,6 +38,10 @@ class All_Sources:
         except Exception as exc:
             print(exc)
 
+    # Have the TCIA source answer listing and hash requests from a prefetched Hierarchy_Cache
+    def set_hierarchy_cache(self, hierarchy_cache):
+        self.sources[instance_source.tcia].hierarchy_cache = hierarchy_cache
+
     ###-------------------Versions-----------------###
 
     def idc_version_hashes(self, version):
@@ -15,17 +15,17 @@
 #
 
 import time
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
-from idc.models import instance_source, Version, Collection, Patient
-from ingestion.utilities.utils import accum_sources, delete_bucket, create_prestaging_bucket, is_skipped
+from idc.models import instance_source, Collection, Patient
+from ingestion.utilities.utils import accum_sources, add_children, classify_objects, delete_bucket, create_prestaging_bucket, is_skipped, mark_dirty
 from ingestion.patient import clone_patient, build_patient, retire_patient
-from ingestion.all_sources import All_Sources
-from utilities.sqlalchemy_helpers import sa_session
+from ingestion.scheduler import Patient_Pool, schedule_patients
 from python_settings import settings
 
-from multiprocessing import Process, Queue, Lock, shared_memory
 from queue import Empty
 
 def clone_collection(collection,uuid):
@@ -46,36 +46,6 @@ def retire_collection(args, collection):
     collection.final_idc_version = settings.PREVIOUS_VERSION
 
 
-PATIENT_TRIES=5
-def worker(input, output, args, access, lock):
-    with sa_session() as sess:
-        all_sources = All_Sources(args.pid, sess, settings.CURRENT_VERSION, access,
-                                  args.skipped_tcia_collections, args.skipped_idc_collections, lock)
-
-        for more_args in iter(input.get, 'STOP'):
-            index, collection_id, submitter_case_id = more_args
-            version = sess.query(Version).filter(Version.version==settings.CURRENT_VERSION).one()
-            collection = next(collection for collection in version.collections if collection.collection_id ==collection_id)
-            patient = next(patient for patient in collection.patients if patient.submitter_case_id==submitter_case_id)
-            successlogger.info("p%s, Building patient %s/%s, %s; %s", args.pid, collection.collection_id, patient.submitter_case_id, index, time.asctime())
-            for attempt in range(PATIENT_TRIES):
-                try:
-                    time.sleep((2**attempt)-1)
-                    build_patient(sess, args, all_sources, index, version, collection, patient)
-                    successlogger.info("p%s, Built patient %s/%s, %s; %s", args.pid, collection.collection_id, patient.submitter_case_id, index, time.asctime())
-                    break
-                except Exception as exc:
-                    errlogger.error("p%s, exception %s; reattempt %s on patient %s/%s, %s; %s", args.pid, exc, attempt, collection.collection_id, patient.submitter_case_id, index, time.asctime())
-                    sess.rollback()
-                attempt += 1
-                if attempt == PATIENT_TRIES:
-                    errlogger.error("p%s, Failed to process patient: %s", args.pid, patient.submitter_case_id)
-                    sess.rollback()
-                    break
-
-            output.put(patient.submitter_case_id)
-
-
 def expand_collection(sess, args, all_sources, collection):
     # skipped is a vector of booleans, one for each source
     skipped = is_skipped(args.skipped_collections, collection.collection_id)
@@ -118,18 +88,11 @@ def expand_collection(sess, args, all_sources, collection):
         # Get the IDs of the patients that we have.
         idc_objects = {object.submitter_case_id: object for object in collection.patients}
 
-        # If any (non-skipped) source has an object but IDC does not, it is new. Note that we don't get objects from
-        # skipped collections
-        new_objects = sorted([id for id in patients \
-                              if not id in idc_objects])
-        # An object in IDC will continue to exist if any non-skipped source has the object or IDC's object has a
-        # skipped source. I.E. if an object has a skipped source then, we can't ask the source about it so assume
-        # it exists.
-        existing_objects = [obj for id, obj in idc_objects.items() if \
-                id in patients or any([a and b for a, b in zip(obj.sources,skipped)])]
-        retired_objects = [obj for id, obj in idc_objects.items() \
-                      if not obj in existing_objects]
+        # Note that we don't get objects from skipped collections
+        new_objects, existing_objects, retired_objects = classify_objects(patients, idc_objects,
+                lambda id, obj: any([a and b for a, b in zip(obj.sources,skipped)]))
 
+    added_patients = []
     for patient in sorted(new_objects):
         new_patient = Patient()
 
@@ -151,8 +114,9 @@ def expand_collection(sess, args, all_sources, collection):
         new_patient.is_new=True
         new_patient.expanded=False
 
-        collection.patients.append(new_patient)
+        added_patients.append(new_patient)
         progresslogger.info('  p%s: Patient %s is new',  args.pid, new_patient.submitter_case_id)
+    add_children(sess, args, collection, 'patients', added_patients)
 
     sorted_patients = sorted(existing_objects, key=lambda patient: patient.submitter_case_id)
     n = 0
@@ -191,6 +155,7 @@ def expand_collection(sess, args, all_sources, collection):
             rev_patient.sources = patients[patient.submitter_case_id]
             rev_patient.rev_idc_version = settings.CURRENT_VERSION
             collection.patients.append(rev_patient)
+            mark_dirty(sess, [collection, rev_patient])
             progresslogger.info('  p%s: %s:Patient %s is revised',  args.pid, n, rev_patient.submitter_case_id)
             n +=1
             # Mark the now previous version of this object as having been replaced
@@ -214,6 +179,7 @@ def expand_collection(sess, args, all_sources, collection):
         breakpoint()
         retire_patient(args, patient)
         collection.patients.remove(patient)
+        mark_dirty(sess, [collection])
         progresslogger.info('  p%s: Patient %s is retired', args.pid, patient.submitter_case_id)
 
     new_patients = []
@@ -239,21 +205,31 @@ def expand_collection(sess, args, all_sources, collection):
     return
 
 
-def build_collection(sess, args, all_sources, collection_index, version, collection):
-    begin = time.time()
+# Set the per collection members of args, prefetch the collection's hierarchy and expand it
+def prepare_collection(sess, args, all_sources, collection_index, collection):
     successlogger.info("p%s: Expand Collection %s, %s", args.pid, collection.collection_id, collection_index)
     args.prestaging_tcia_bucket = f"{args.prestaging_tcia_bucket_prefix}{collection.collection_id.lower().replace(' ','_').replace('-','_')}"
     args.prestaging_idc_bucket = f"{args.prestaging_idc_bucket_prefix}{collection.collection_id.lower().replace(' ','_').replace('-','_')}"
+    # Prefetch the collection's TCIA hierarchy and hashes, before expansion and before forking workers.
+    # A collection that is done or already expanded is not prefetched.
+    if args.hierarchy_cache and collection.revised.tcia and not collection.done and not collection.expanded and \
+            not is_skipped(args.skipped_collections, collection.collection_id)[instance_source.tcia.value]:
+        args.hierarchy_cache.prefetch(collection.collection_id)
     if not collection.expanded:
         successlogger.info("p%s: Expanding Collection %s, %s, %s patients", args.pid, collection.collection_id,
                            collection_index, len(collection.patients))
         expand_collection(sess, args, all_sources, collection)
         successlogger.info("p%s: Expanded Collection %s, %s, %s patients", args.pid, collection.collection_id, collection_index, len(collection.patients))
 
+
+def build_collection(sess, args, all_sources, collection_index, version, collection):
+    begin = time.time()
+    prepare_collection(sess, args, all_sources, collection_index, collection)
+
     if args.num_processes==0:
         patients = sorted(collection.patients, key=lambda patient: patient.done, reverse=True)
-        for patient in patients:
-            patient_index = f'{patients.index(patient) + 1} of {len(patients)}'
+        for index, patient in enumerate(patients):
+            patient_index = f'{index + 1} of {len(patients)}'
             if not patient.done:
                 build_patient(sess, args, all_sources, patient_index, version, collection, patient)
             else:
@@ -262,78 +238,38 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
                                 patient_index)
 
     else:
-        processes = []
-        # Create queues
-        task_queue = Queue()
-        done_queue = Queue()
-
-        # List of patients enqueued
-        enqueued_patients = []
-
-        num_processes = min(args.num_processes, len(collection.patients))
-        # If the collection is sourced from TCIA, limit the number of processes to avoid overwhelming th
-        # NBIA server
-        if collection.revised.tcia:
-            num_processes = min(num_processes, 16)
-
-        # Enqueue each patient in the the task queue
-        # patients = sorted(collection.patients, key=lambda patient: patient.done, reverse=True)
-        all_patients = [patient for patient in collection.patients]
-        all_patients = sorted(all_patients, key=lambda patient: patient.submitter_case_id)
-        patients = [patient for patient in collection.patients if patient.done==False]
-        patients = sorted(patients, key=lambda patient: patient.submitter_case_id)
-        # Start worker processes
-        lock = Lock()
-        for process in range(min(num_processes, len(patients))):
-            args.pid = process+1
-            processes.append(
-                Process(target=worker, args=(task_queue, done_queue, args, args.access, lock )))
-            processes[-1].start()
-
-        args.pid = 0
-        for patient in patients:
-            patient_index = f'{all_patients.index(patient) + 1} of {len(all_patients)}'
-            if not patient.done:
-                task_queue.put((patient_index, collection.collection_id, patient.submitter_case_id))
-                # enqueued_patients.append(patient.submitter_case_id)
-                successlogger.info("  p%s: Patient %s %s enqueued", args.pid, patient.submitter_case_id,
-                            patient_index)
-            else:
-                successlogger.info("  p%s: Patient %s, %s, previously built", args.pid, patient.submitter_case_id,
-                            patient_index)
+        # Patients that are not done, largest first
+        tasks = schedule_patients(sess, args, collection)
+        successlogger.info("  p%s: %s of %s patients of %s previously built", args.pid,
+                           len(collection.patients) - len(tasks), len(collection.patients), collection.collection_id)
+
+        # Load on the NBIA server is bounded by the global cap on concurrent NBIA requests
+        # (--max_nbia_requests) rather than by limiting the number of processes.
+        pool = Patient_Pool(args, min(args.num_processes, len(tasks))) if tasks else None
 
         # Collect the results for each patient
         try:
-            # while not enqueued_patients == []:
-            #     # Timeout if waiting too long
-            #     try:
-            #         results = done_queue.get(True, 60)
-            #     except Empty as e:
-            #         pass
-            #         continue
-            #
-            #     enqueued_patients.remove(results)
-            #     successlogger.info("  p%s: Patient %s dequeued", args.pid, results)
-            # Tell child processes to stop
-            for process in processes:
-                task_queue.put('STOP')
-
-            # Wait for them to stop
-            for process in processes:
-                process.join()
+            if pool:
+                pool.submit(collection, tasks)
+                pool.wait(collection.collection_id)
+                pool.close()
 
+            # The workers committed their patients in their own sessions
             sess.commit()
 
-        except Empty as e:
+        except Empty:
             errlogger.error("Timeout in build_collection %s", collection.collection_id)
-            for process in processes:
-                process.terminate()
-                process.join()
+            pool.terminate()
             sess.rollback()
             duration = str(timedelta(seconds=(time.time() - begin)))
             successlogger.info("Collection %s, %s, NOT completed in %s", collection.collection_id, collection_index,
                             duration)
 
+    finish_collection(sess, args, all_sources, collection_index, collection, begin)
+
+
+# Validate and mark done a collection all of whose patients have been built
+def finish_collection(sess, args, all_sources, collection_index, collection, begin):
     if all([patient.done for patient in collection.patients]):
         collection.max_timestamp = max([patient.max_timestamp for patient in collection.patients if patient.max_timestamp != None])
         try:
@@ -376,3 +312,68 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
         successlogger.info("Collection %s, %s, not completed in %s", collection.collection_id, collection_index,
                         duration)
 
+    if args.hierarchy_cache:
+        args.hierarchy_cache.discard(collection.collection_id)
+
+
+
+# Build several collections on one pool of worker processes. The patients of the next collection
+# are enqueued while the workers are still building those of the previous collection, so that
+# workers are not left idle while the last patients of a collection are built. A collection is
+# finished as soon as all its patients have been reported.
+# collections is a list of (collection_index, collection) of collections that are not done.
+def build_collections_pooled(sess, args, all_sources, version, collections):
+    pool = None
+    started = {}
+    # The workers are forked once, so they only see the hierarchies that the parent prefetches
+    # for later collections if they are saved. If no cache directory was given, save them in a
+    # temporary one.
+    temp_cache_dir = None
+    if args.hierarchy_cache and not args.hierarchy_cache.cache_dir:
+        temp_cache_dir = tempfile.mkdtemp(prefix='hierarchy_cache_')
+        args.hierarchy_cache.cache_dir = temp_cache_dir
+
+    def finish(collection_id):
+        collection_index, collection, begin = started.pop(collection_id)
+        # The workers committed their patients in their own sessions
+        sess.commit()
+        finish_collection(sess, args, all_sources, collection_index, collection, begin)
+
+    try:
+        for collection_index, collection in collections:
+            # Don't get far ahead of the workers. Enqueue the next collection when they are
+            # about to run out of patients.
+            while pool and pool.pending() >= 2 * args.num_processes:
+                completed_id = pool.collect()
+                if completed_id:
+                    finish(completed_id)
+
+            progresslogger.info(f'Building collection {collection.collection_id}')
+            begin = time.time()
+            prepare_collection(sess, args, all_sources, collection_index, collection)
+            tasks = schedule_patients(sess, args, collection)
+            started[collection.collection_id] = (collection_index, collection, begin)
+            if not tasks:
+                finish(collection.collection_id)
+                continue
+            if not pool:
+                # Forked after the first collection is prefetched and expanded
+                pool = Patient_Pool(args, args.num_processes)
+            pool.submit(collection, tasks)
+
+        if pool:
+            while pool.pending():
+                completed_id = pool.collect()
+                if completed_id:
+                    finish(completed_id)
+            pool.close()
+
+    except Empty:
+        errlogger.error("Timeout in build_collections_pooled; collections %s not completed", list(started))
+        pool.terminate()
+        sess.rollback()
+
+    finally:
+        if temp_cache_dir:
+            args.hierarchy_cache.cache_dir = ''
+            shutil.rmtree(temp_cache_dir, ignore_errors=True)
@@ -23,15 +23,16 @@ import logging
 from logging import DEBUG, INFO
 from datetime import datetime, timedelta
 import shutil
-from multiprocessing import Lock, shared_memory
+from multiprocessing import Lock
 from idc.models import Base, Version, Collection
-from utilities.tcia_helpers import get_access_token
+from utilities.tcia_helpers import Token_Manager, set_token_manager, set_max_concurrent_requests, NBIA_AUTH_URL
 from utilities.sqlalchemy_helpers import sa_session
 from utilities.logging_config import successlogger, errlogger, progresslogger, rootlogger
 from ingestion.utilities.utils import list_skips
 from ingestion.version import clone_version, build_version
 from python_settings import settings
 from ingestion.all_sources import All_Sources
+from ingestion.utilities.hierarchy_cache import Hierarchy_Cache
 
 DICOM_DIR = '/mnt/disks/idc-etl/dicom' # Directory in which to expand downloaded zip files')
 
@@ -43,9 +44,14 @@ def ingest(args):
         shutil.rmtree('{}'.format(args.dicom_dir))
     os.mkdir('{}'.format(args.dicom_dir))
 
+    # Bound the number of concurrent NBIA requests made by all worker processes
+    set_max_concurrent_requests(args.max_nbia_requests)
+
     with sa_session() as sess:
-        # Get a sharable NBIA access token
-        access = shared_memory.ShareableList(get_access_token())
+        # Create an NBIA token manager that is shared by all worker processes. Registering it
+        # makes it the default for tcia_helpers functions called without an explicit token.
+        access = Token_Manager(NBIA_AUTH_URL)
+        set_token_manager(access)
         args.access = access
 
         args.skipped_tcia_collections = list_skips(sess, args.skipped_tcia_collections)
@@ -64,6 +70,10 @@ def ingest(args):
         args.skipped_collections = skipped_collections
         all_sources = All_Sources(args.pid, sess, settings.CURRENT_VERSION, args.access,
                                   args.skipped_tcia_collections, args.skipped_idc_collections, Lock())
+        # Optionally prefetch each collection's TCIA hierarchy and hashes before expanding it
+        args.hierarchy_cache = Hierarchy_Cache(args.hierarchy_cache_dir, args.prefetch_threads, version=settings.CURRENT_VERSION) \
+            if args.prefetch_hierarchy else None
+        all_sources.set_hierarchy_cache(args.hierarchy_cache)
 
         version = sess.query(Version).filter(Version.version == settings.CURRENT_VERSION).first()
         if not version:
@@ -102,15 +112,21 @@ def ingest(args):
                     version.max_timestamp = None
                     sess.commit()
 
-        if not version.done:
-            build_version(sess, args, all_sources, version)
-        else:
-            successlogger.info("    version %s previously built", settings.CURRENT_VERSION)
+        try:
+            if not version.done:
+                build_version(sess, args, all_sources, version)
+            else:
+                successlogger.info("    version %s previously built", settings.CURRENT_VERSION)
+        finally:
+            progresslogger.info("NBIA access tokens: %s", access.counters())
+            access.unlink()
         return
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--num_processes', type=int, default=16, help="Number of concurrent processes")
+    parser.add_argument('--max_nbia_requests', type=int, default=16, \
+                        help="Maximum number of concurrent requests to the NBIA server across all processes. 0 is unlimited")
 
     parser.add_argument('--skipped_tcia_collections', nargs='*', \
             default=[
@@ -130,6 +146,20 @@ if __name__ == '__main__':
     parser.add_argument('--prestaging_idc_bucket_prefix', default=f'idc_v{settings.CURRENT_VERSION}_idc_', help='Copy idc instances here before forwarding to --staging_bucket')
     parser.add_argument('--copy_through_directory', default=f'/mnt/disks/idc-dev-etl-v{settings.CURRENT_VERSION}', \
                         help='If instance is a composite object, copy it through this directory to GCS to convert to non-composite object')
+    parser.add_argument('--prefetch_hierarchy', action=argparse.BooleanOptionalAction, default=True, \
+                        help='Prefetch the TCIA hierarchy and hashes of each collection before expanding it')
+    parser.add_argument('--prefetch_threads', type=int, default=8, \
+                        help='Number of threads with which to prefetch the TCIA hierarchy')
+    parser.add_argument('--hierarchy_cache_dir', default='', \
+                        help='If not empty, persist prefetched hierarchies in this directory and reuse them on rerun')
+    parser.add_argument('--pipeline_depth', type=int, default=2, \
+                        help='Maximum number of TCIA series of a patient being downloaded, processed or uploaded at once. 0 builds series sequentially')
+    parser.add_argument('--pipeline_disk_budget', type=int, default=20*2**30, \
+                        help='Bytes of downloaded series that may be on disk under the dicom directory per process before further downloads wait')
+    parser.add_argument('--bulk_expand', action=argparse.BooleanOptionalAction, default=True, \
+                        help='Insert the new patients, studies, series and instances found by expansion with one executemany per table')
+    parser.add_argument('--cross_collection_pool', action=argparse.BooleanOptionalAction, default=True, \
+                        help='Build all collections on one pool of --num_processes workers, enqueuing the patients of the next collection before the previous collection completes')
     parser.add_argument('--stop_after_collection_summary', type=bool, default=False, \
                         help='Stop after printing a summary of collection dispositions')
 
@@ -15,18 +15,15 @@
 #
 
 import os
-from pathlib import Path
 import time
 from datetime import datetime, timezone
 from utilities.logging_config import successlogger, progresslogger, errlogger
-import pydicom
 import shutil
-from pydicom.errors import InvalidDicomError
 from idc.models import Version, Instance, IDC_Instance
 from sqlalchemy import select,delete
 from google.cloud import storage
-from utilities.tcia_helpers import  get_TCIA_instances_per_series_with_hashes
-from ingestion.utilities.utils import validate_hashes, md5_hasher, copy_disk_to_gcs, copy_gcs_to_gcs
+from utilities.tcia_helpers import  stream_TCIA_instances_per_series_with_hashes
+from ingestion.utilities.utils import validate_streamed_hashes, copy_disk_to_gcs, copy_gcs_to_gcs
 
 # successlogger = logging.getLogger('root.success')
 # progresslogger = logging.getLogger('root.progress')
@@ -40,120 +37,109 @@ def clone_instance(instance, uuid):
     return new_instance
 
 
-def build_instances_tcia(sess, args, collection, patient, study, series):
-     try:
+# Download stage of building a TCIA series. Stream a zip of the instances in a series,
+# unzipping each instance to dicom/<series.uuid>/ as it arrives. We get back the md5 hash,
+# size and DICOM IDs of each instance, as well as the hash that TCIA says it should have.
+# This only reads series.uuid and series.series_instance_uid, so it can run outside of the
+# thread that owns the DB session.
+def download_instances_tcia(args, series):
+    # Delete the series from disk in case it is there from a previous run
+    shutil.rmtree("{}/{}".format(args.dicom_dir, series.uuid), ignore_errors=True)
+    return stream_TCIA_instances_per_series_with_hashes(args.dicom_dir, series)
+
+
+# Process stage of building a TCIA series. Validate the downloaded instances, rename each
+# file with its instance's uuid, and record each instance's hash and size.
+# Returns False, without marking any instance done, if the series is not valid.
+def process_instances_tcia(sess, args, collection, patient, study, series, members):
+    # Validate that the instances were received with the expected hashes.
+    if not validate_streamed_hashes(args, collection, patient, study, series, members):
+        # If validation fails, return. None of the instances will have the done bit set to True
+        return False
+
+    # Ensure that the zip has the expected number of instances
+    if not len(members) == len(series.instances):
+        errlogger.error("      p%s: Invalid zip file for %s/%s/%s/%s", args.pid,
+            collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
+        # Return without marking all instances done. This will prevent the series from being done.
+        return False
+
+    # TCIA file names are based on the position of the image in a scan. We need the SOPInstanceUID,
+    # which was read from each instance's header as it was streamed, so that we can know the instance.
+    # Rename each file with its associated uuid that we generated when we expanded this series.
+    instances = {instance.sop_instance_uid:instance for instance in series.instances}
+
+    for dcm, member in members.items():
+        if member['ids'] is None:
+            errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
+            if collection.collection_id == 'NLST':
+                breakpoint()
+                # For NLST only, just delete the invalid file
+                os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
+                continue
+            else:
+                # Return without marking all instances done. This will be prevent the series from being done.
+                return False
+        SOPInstanceUID = member['ids']['SOPInstanceUID']
 
-        # Delete the series from disk in case it is there from a previous run
+        instance = instances[SOPInstanceUID]
+
+        # Validate that DICOM IDs match what we are expecting
         try:
-            # shutil.rmtree("{}/{}".format(args.dicom_dir, series.series_instance_uid), ignore_errors=True)
-            shutil.rmtree("{}/{}".format(args.dicom_dir, series.uuid), ignore_errors=True)
+            assert patient.submitter_case_id == member['ids']['PatientID'];
+            assert study.study_instance_uid == member['ids']['StudyInstanceUID'];
+            assert series.series_instance_uid == member['ids']['SeriesInstanceUID'];
         except:
-            # It wasn't there
-            pass
-
-        # Download a zip of the instances in a series
-        # It will write the zip to a file dicom/<series_instance_uid>.zip in the
-        # working directory, and expand the zip to directory dicom/<series_instance_uid>
-        hashes = get_TCIA_instances_per_series_with_hashes(args.dicom_dir, series)
-        # Validate that the files on disk have the expected hashes.
-        if not validate_hashes(args, collection, patient, study, series, hashes):
-            # If validation fails, return. None of the instances will have the done bit set to True
-            return
-
-        # Get a list of the files from the download
-        dcms = [dcm for dcm in os.listdir("{}/{}".format(args.dicom_dir, series.uuid))]
+            errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
+            errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, \
+                DICOM: {member["ids"]["PatientID"]}')
+            errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {study.study_instance_uid}, \
+                DICOM: {member["ids"]["StudyInstanceUID"]}')
+            errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {series.series_instance_uid}, \
+                DICOM: {member["ids"]["SeriesInstanceUID"]}')
+            # Return without marking all instances done. This will be prevent the series from being done.
+            return False
+
+        uuid = instance.uuid
+        file_name = "{}/{}/{}".format(args.dicom_dir, series.uuid, dcm)
+        blob_name = "{}/{}/{}.dcm".format(args.dicom_dir, series.uuid, uuid)
+        if os.path.exists(blob_name):
+            errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
+            if collection.collection_id == 'NLST':
+                breakpoint()
+                # For NLST only, just delete the duplicate
+                os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
+                continue
+            else:
+                # Return without marking all instances done. This will prevent the series from being done.
+                return False
+
+        os.rename(file_name, blob_name)
+
+        # The hash and size were computed as the instance was streamed
+        instance.hash = member['hash']
+        instance.size = member['size']
+        instance.timestamp = datetime.utcnow()
+
+    if collection.collection_id == 'NLST':
+        breakpoint()
+        # For NLST only, delete any instances for which there is not a corresponding file
+        for instance in series.instances:
+            if not os.path.exists("{}/{}/{}.dcm".format(args.dicom_dir, series.uuid, instance.uuid)):
+                sess.execute(delete(Instance).where(Instance.uuid==instance.uuid))
+                series.instances.remove(instance)
 
-        # Ensure that the zip has the expected number of instances
-        if not len(dcms) == len(series.instances):
-            errlogger.error("      p%s: Invalid zip file for %s/%s/%s/%s", args.pid,
-                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
-            # Return without marking all instances done. This will prevent the series from being done.
-            return
+    return True
 
-        # TCIA file names are based on the position of the image in a scan. We need to extract the SOPInstanceUID
-        # so that we can know the instance.
-        # Use pydicom to open each file to get its UID and rename the file with its associated uuid that we
-        # generated when we expanded this series.
-
-        # Replace the TCIA assigned file name
-        # Also compute the md5 hash and length in bytes of each
-        instances = {instance.sop_instance_uid:instance for instance in series.instances}
-
-        for dcm in dcms:
-            try:
-                reader = pydicom.dcmread("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm), stop_before_pixels=True)
-                SOPInstanceUID = reader.SOPInstanceUID
-            except InvalidDicomError:
-                errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
-                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
-                if collection.collection_id == 'NLST':
-                    breakpoint()
-                    # For NLST only, just delete the invalid file
-                    os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
-                    continue
-                else:
-                    # Return without marking all instances done. This will be prevent the series from being done.
-                    return
-
-            instance = instances[SOPInstanceUID]
-            # # If an instance is already done, don't need to do anything more
-            # if instance.done:
-            #     # Delete file. We already have it.
-            #     os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
-            #     progresslogger.debug("      p%s: Instance %s previously done, ", args.pid, series.uuid)
-            #
-            #     continue
-
-            # Validate that DICOM IDs match what we are expecting
-            try:
-                assert patient.submitter_case_id == reader.PatientID;
-                assert study.study_instance_uid == reader.StudyInstanceUID;
-                assert series.series_instance_uid == reader.SeriesInstanceUID;
-            except:
-                errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
-                errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, \
-                    DICOM: {reader.PatientID}')
-                errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {patient.study_instance_uid}, \
-                    DICOM: {reader.StudyInstanceUID}')
-                errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {patient.series_instance_uid}, \
-                    DICOM: {reader.SeriesInstanceUID}')
-                # Return without marking all instances done. This will be prevent the series from being done.
-                return
 
-            uuid = instance.uuid
-            file_name = "{}/{}/{}".format(args.dicom_dir, series.uuid, dcm)
-            blob_name = "{}/{}/{}.dcm".format(args.dicom_dir, series.uuid, uuid)
-            if os.path.exists(blob_name):
-                errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
-                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
-                if collection.collection_id == 'NLST':
-                    breakpoint()
-                    # For NLST only, just delete the duplicate
-                    os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
-                    continue
-                else:
-                    # Return without marking all instances done. This will prevent the series from being done.
-                    return
-
-            os.rename(file_name, blob_name)
-
-            instance.hash = md5_hasher(blob_name)
-            if len(instance.hash) != 32:
-                breakpoint()
-                errlogger.error("       p%s: Hash failed for %s/%s/%s/%s/%s", args.pid,
-                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
-                # Return without marking all instances done. This will be prevent the series from being done.
-                return
-            instance.size = Path(blob_name).stat().st_size
-            instance.timestamp = datetime.utcnow()
-
-        if collection.collection_id == 'NLST':
-            breakpoint()
-            # For NLST only, delete any instances for which there is not a corresponding file
-            for instance in series.instances:
-                if not os.path.exists("{}/{}/{}.dcm".format(args.dicom_dir, series.uuid, instance.uuid)):
-                    sess.execute(delete(Instance).where(Instance.uuid==instance.uuid))
-                    series.instances.remove(instance)
+def build_instances_tcia(sess, args, collection, patient, study, series):
+     try:
+        members = download_instances_tcia(args, series)
+        if not process_instances_tcia(sess, args, collection, patient, study, series, members):
+            # Return without marking all instances done. This will be prevent the series from being done.
+            return
 
         # Copy the instance data to a staging bucket
         try:
@@ -19,8 +19,9 @@ from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
 from idc.models import Patient, Study
-from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped
+from ingestion.utilities.utils import accum_sources, add_children, classify_objects, get_merkle_hash, is_skipped, mark_dirty
 from ingestion.study import clone_study, build_study, retire_study
+from ingestion.pipeline import build_patient_series_pipelined
 from python_settings import settings
 
 # Return a dictionary of the dois and urls of all series in the patient
@@ -88,19 +89,11 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
     else:
         # Get the IDs of the studies that we have.
         idc_objects = {object.study_instance_uid: object for object in patient.studies}
-        # If any (non-skipped) source has an object but IDC does not, it is new. Note that we don't get objects from
-        # skipped collections
-        new_objects = sorted([id for id in studies \
-                              if not id in idc_objects])
-        # An object in IDC will continue to exist if any non-skipped source has the object or IDC's object has a
-        # skipped source. I.E. if an object has a skipped source then, we can't ask the source about it so assume
-        # it exists.
-        existing_objects = [obj for id, obj in idc_objects.items() if \
-                id in studies or any([a and b for a, b in zip(obj.sources,skipped)])]
-        # An object in IDC is retired if it no longer exists in IDC
-        retired_objects = [obj for id, obj in idc_objects.items() \
-                      if not obj in existing_objects]
+        # Note that we don't get objects from skipped collections
+        new_objects, existing_objects, retired_objects = classify_objects(studies, idc_objects,
+                lambda id, obj: any([a and b for a, b in zip(obj.sources,skipped)]))
 
+    added_studies = []
     for study in sorted(new_objects):
         new_study = Study()
         new_study.study_instance_uid=study
@@ -120,8 +113,9 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
         new_study.done = False
         new_study.is_new=True
         new_study.expanded=False
-        patient.studies.append(new_study)
+        added_studies.append(new_study)
         progresslogger.debug  ('    p%s: Study %s is new',  args.pid, new_study.study_instance_uid)
+    add_children(sess, args, patient, 'studies', added_studies)
 
     for study in existing_objects:
         idc_hashes = study.hashes
@@ -149,6 +143,7 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
             rev_study.sources = studies[study.study_instance_uid]
             rev_study.rev_idc_version = settings.CURRENT_VERSION
             patient.studies.append(rev_study)
+            mark_dirty(sess, [patient, rev_study])
             progresslogger.info  ('    p%s: Study %s is revised',  args.pid, rev_study.study_instance_uid)
 
             # Mark the now previous version of this object as having been replaced
@@ -170,6 +165,7 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
         breakpoint()
         retire_study(args, study)
         patient.studies.remove(study)
+        mark_dirty(sess, [patient])
         progresslogger.info('  p%s: Study %s is retired', args.pid, study.study_instance_uid)
 
     patient.expanded = True
@@ -191,8 +187,12 @@ def build_patient(sess, args, all_sources, patient_index, version, collection, p
         # Get the source_doi and source_url for each series in the patient
         # dois_urls_licenses = get_dois_urls_licenses(args, all_sources, collection.collection_id, patient.submitter_case_id)
         dois_urls = get_dois_urls(args, all_sources, collection, patient)
-        for study in patient.studies:
-            study_index = f'{patient.studies.index(study) + 1} of {len(patient.studies)}'
+        if args.pipeline_depth:
+            # Download, process and upload the patient's TCIA series in a pipeline. Studies and
+            # series that it completes are seen as previously built by the loop below.
+            build_patient_series_pipelined(sess, args, all_sources, version, collection, patient, dois_urls)
+        for index, study in enumerate(patient.studies):
+            study_index = f'{index + 1} of {len(patient.studies)}'
             if not study.done:
                 # build_study(sess, args, all_sources, study_index, version, collection, patient, study, data_collection_doi_url, analysis_collection_dois)
                 successlogger.info("    p%s: Building study %s, %s ", args.pid, study.study_instance_uid, study_index)
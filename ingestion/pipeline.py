@@ -0,0 +1,201 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Pipelined building of the TCIA sourced series of a patient.
+# Building a TCIA series has three stages:
+#   download: stream the series from NBIA to dicom/<series.uuid>/    (download thread)
+#   process:  validate the instances and record their hashes/sizes  (this thread, which owns the DB session)
+#   upload:   upload the series to the prestaging bucket            (upload thread)
+# The stages are connected by queues, so that while series N is being uploaded and committed,
+# series N+1 is being downloaded. At most args.pipeline_depth series are in the pipeline at a time,
+# and a new download does not start while the series on disk exceed args.pipeline_disk_budget bytes.
+# A series is only marked done, and committed, after its upload succeeds. A series that fails in
+# any stage is left not done, and is retried by the sequential build.
+
+import shutil
+import time
+import threading
+from queue import Queue
+from types import SimpleNamespace
+from utilities.logging_config import successlogger, errlogger
+from ingestion.instance import download_instances_tcia, process_instances_tcia
+from ingestion.utilities.utils import copy_disk_to_gcs
+from ingestion.study import expand_study
+from ingestion.series import expand_series, build_series
+
+STOP = 'STOP'
+
+
+# A copy of the series attributes that are needed by the download and upload stages, so that
+# those stages never touch ORM objects from outside the session's thread.
+def series_snapshot(series):
+    return SimpleNamespace(
+        uuid = series.uuid,
+        series_instance_uid = series.series_instance_uid,
+        instances = [SimpleNamespace(uuid=instance.uuid, hash=instance.hash, size=instance.size) \
+                     for instance in series.instances]
+    )
+
+
+class Series_Pipeline:
+    def __init__(self, args, depth, disk_budget):
+        self.args = args
+        # Limits the number of series that have been, or are being, downloaded but not yet uploaded
+        self.slots = threading.BoundedSemaphore(depth)
+        self.disk_budget = disk_budget
+        self.disk_in_use = 0
+        self.disk = threading.Condition()
+        self.download_queue = Queue()
+        self.upload_queue = Queue(maxsize=depth)
+        # Results of the download and upload stages, consumed by the process stage
+        self.results = Queue()
+        self.stopped = threading.Event()
+        self.threads = [
+            threading.Thread(target=self.downloader, daemon=True),
+            threading.Thread(target=self.uploader, daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _reserve_disk(self):
+        # Wait until the series already on disk are within budget. A series is always allowed if
+        # the disk is otherwise empty, however large it is.
+        with self.disk:
+            while self.disk_in_use and self.disk_in_use >= self.disk_budget:
+                if self.stopped.is_set():
+                    return False
+                self.disk.wait(1)
+        return True
+
+    def _release(self, series, size):
+        shutil.rmtree("{}/{}".format(self.args.dicom_dir, series.uuid), ignore_errors=True)
+        with self.disk:
+            self.disk_in_use -= size
+            self.disk.notify_all()
+        self.slots.release()
+
+    def downloader(self):
+        for series in iter(self.download_queue.get, STOP):
+            while not self.slots.acquire(timeout=1):
+                if self.stopped.is_set():
+                    return
+            if self.stopped.is_set() or not self._reserve_disk():
+                return
+            try:
+                members = download_instances_tcia(self.args, series)
+                size = sum(member['size'] for member in members.values())
+                with self.disk:
+                    self.disk_in_use += size
+                self.results.put(('downloaded', series.uuid, members, size, None))
+            except Exception as exc:
+                self.results.put(('downloaded', series.uuid, None, 0, exc))
+
+    def uploader(self):
+        for series, size in iter(self.upload_queue.get, STOP):
+            try:
+                copy_disk_to_gcs(self.args, None, None, None, series)
+                self.results.put(('uploaded', series.uuid, None, size, None))
+            except Exception as exc:
+                self.results.put(('uploaded', series.uuid, None, size, exc))
+
+    def download(self, series):
+        self.download_queue.put(series_snapshot(series))
+
+    def upload(self, series, size):
+        self.upload_queue.put((series_snapshot(series), size))
+
+    def failed(self, series, size):
+        self._release(series, size)
+
+    def uploaded(self, series, size):
+        # The upload stage deletes the series from disk
+        with self.disk:
+            self.disk_in_use -= size
+            self.disk.notify_all()
+        self.slots.release()
+
+    def close(self):
+        # Series still queued for download are abandoned
+        self.stopped.set()
+        self.download_queue.put(STOP)
+        self.upload_queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+
+# Expand all the studies and series of a patient, then download, process and upload
+# its TCIA sourced series in a pipeline. Each series is finalized with build_series
+# as soon as its upload completes.
+def build_patient_series_pipelined(sess, args, all_sources, version, collection, patient, dois_urls):
+    begin = time.time()
+    # Expansion must be complete before we know which series to download
+    seriess = {}
+    series_indices = {}
+    for study in patient.studies:
+        if study.done:
+            continue
+        if not study.expanded:
+            expand_study(sess, args, all_sources, version, collection, patient, study, dois_urls)
+        for index, series in enumerate(study.seriess):
+            series_indices[series.uuid] = f'{index + 1} of {len(study.seriess)}'
+            if series.done:
+                continue
+            if not series.expanded:
+                if expand_series(sess, args, all_sources, version, collection, patient, study, series):
+                    continue
+            if series.sources.tcia and not all(instance.done for instance in series.instances):
+                seriess[series.uuid] = (study, series)
+    if not seriess:
+        return
+
+    pipeline = Series_Pipeline(args, args.pipeline_depth, args.pipeline_disk_budget)
+    try:
+        for study, series in seriess.values():
+            pipeline.download(series)
+
+        pending = len(seriess)
+        while pending:
+            stage, uuid, members, size, exc = pipeline.results.get()
+            study, series = seriess[uuid]
+            series_index = series_indices[uuid]
+            if stage == 'downloaded':
+                if exc:
+                    errlogger.error("      p%s: Download failed for series %s: %s", args.pid, series.series_instance_uid, exc)
+                    pipeline.failed(series, size)
+                    pending -= 1
+                elif process_instances_tcia(sess, args, collection, patient, study, series, members):
+                    pipeline.upload(series, size)
+                else:
+                    pipeline.failed(series, size)
+                    pending -= 1
+            else:
+                pending -= 1
+                if exc:
+                    # The upload stage only deletes the series from disk once it has been uploaded
+                    pipeline.failed(series, size)
+                    errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s", args.pid,
+                        collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+                    continue
+                pipeline.uploaded(series, size)
+                for instance in series.instances:
+                    instance.done = True
+                # Validate the series hashes, mark the series done and commit
+                build_series(sess, args, all_sources, series_index, version, collection, patient, study, series)
+    finally:
+        pipeline.close()
+
+    successlogger.info("  p%s: Pipelined %s series of patient %s in %.1fs", args.pid, len(seriess),
+                       patient.submitter_case_id, time.time() - begin)
@@ -0,0 +1,238 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Scheduling of patients on a pool of worker processes.
+# Patients are enqueued largest first, by their estimated number of instances, so that a
+# single large patient does not start last and leave the other workers idle at the end.
+# Idle workers take the next patient from the shared task queue, and report the outcome
+# and duration of each patient on the done queue. The pool can outlive a collection, so
+# that build_version can enqueue the patients of the next collection while the workers
+# are still building the patients of the previous one.
+
+import time
+from datetime import timedelta
+from multiprocessing import Process, Queue, Lock
+from queue import Empty
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from idc.models import Version, Collection, Patient, Study, Series, collection_patient, patient_study
+from ingestion.patient import build_patient
+from ingestion.all_sources import All_Sources
+from utilities.sqlalchemy_helpers import sa_session
+from utilities.tcia_helpers import set_token_manager
+from utilities.logging_config import successlogger, progresslogger, errlogger
+from python_settings import settings
+
+PATIENT_TRIES=5
+RESULT_TIMEOUT=60
+
+# Members of args that are set per collection, and so must be passed with each task to
+# workers that may have been forked before the collection was started
+COLLECTION_ARGS = ['prestaging_tcia_bucket', 'prestaging_idc_bucket']
+
+
+def worker(input, output, args, access, lock):
+    # Make the shared token manager the default for tcia_helpers functions in this process
+    set_token_manager(access)
+    with sa_session() as sess:
+        all_sources = All_Sources(args.pid, sess, settings.CURRENT_VERSION, access,
+                                  args.skipped_tcia_collections, args.skipped_idc_collections, lock)
+        # The hierarchy cache was prefetched by the parent before this process was forked
+        all_sources.set_hierarchy_cache(args.hierarchy_cache)
+
+        current_collection_id = None
+        for more_args in iter(input.get, 'STOP'):
+            index, collection_id, collection_uuid, submitter_case_id, patient_uuid, collection_args = more_args
+            if collection_id != current_collection_id:
+                # The collection may have been expanded by the parent after this process started
+                vars(args).update(collection_args)
+                sess.expire_all()
+                if args.hierarchy_cache:
+                    if current_collection_id:
+                        args.hierarchy_cache.discard(current_collection_id)
+                    # A collection prefetched after the fork is only visible if the parent saved it
+                    args.hierarchy_cache.load_saved(collection_id)
+                current_collection_id = collection_id
+            begin = time.time()
+            built = False
+            # Always report the patient, else the parent waits for it forever
+            try:
+                version, collection, patient = load_patient(sess, args, collection_uuid, patient_uuid)
+                successlogger.info("p%s, Building patient %s/%s, %s; %s", args.pid, collection.collection_id, patient.submitter_case_id, index, time.asctime())
+                for attempt in range(PATIENT_TRIES):
+                    try:
+                        time.sleep((2**attempt)-1)
+                        build_patient(sess, args, all_sources, index, version, collection, patient)
+                        successlogger.info("p%s, Built patient %s/%s, %s; %s", args.pid, collection.collection_id, patient.submitter_case_id, index, time.asctime())
+                        built = True
+                        break
+                    except Exception as exc:
+                        errlogger.error("p%s, exception %s; reattempt %s on patient %s/%s, %s; %s", args.pid, exc, attempt, collection.collection_id, patient.submitter_case_id, index, time.asctime())
+                        sess.rollback()
+                    attempt += 1
+                    if attempt == PATIENT_TRIES:
+                        errlogger.error("p%s, Failed to process patient: %s", args.pid, patient.submitter_case_id)
+                        sess.rollback()
+                        break
+            except Exception as exc:
+                errlogger.error("p%s, Failed to load patient %s/%s, %s: %s", args.pid, collection_id, submitter_case_id, index, exc)
+                sess.rollback()
+            finally:
+                output.put((collection_id, submitter_case_id, args.pid, built, time.time() - begin))
+
+
+# Load just the subtree of the patient being built, rather than walking the
+# version->collections->patients relationships to find it
+def load_patient(sess, args, collection_uuid, patient_uuid):
+    begin = time.time()
+    version = sess.get(Version, settings.CURRENT_VERSION)
+    collection = sess.get(Collection, collection_uuid)
+    patient = sess.query(Patient).filter(Patient.uuid == patient_uuid). \
+        options(selectinload(Patient.studies).selectinload(Study.seriess).selectinload(Series.instances)).one()
+    progresslogger.info("p%s, Loaded patient %s/%s in %.3fs", args.pid, collection.collection_id,
+                        patient.submitter_case_id, time.time() - begin)
+    return version, collection, patient
+
+
+# Estimate the number of instances of each patient of a collection. NBIA's instance counts from
+# the hierarchy prefetch are used if available. Otherwise the instance count of the patient in the
+# previous version is used. A revised patient still has the studies of its previous version at
+# this point. New patients without a prefetch have no estimate and are scheduled last.
+def estimate_patient_sizes(sess, args, collection):
+    rows = sess.query(Patient.submitter_case_id, func.coalesce(func.sum(Study.study_instances), 0)). \
+        join(collection_patient, collection_patient.c.patient_uuid == Patient.uuid). \
+        join(patient_study, patient_study.c.patient_uuid == Patient.uuid). \
+        join(Study, Study.uuid == patient_study.c.study_uuid). \
+        filter(collection_patient.c.collection_uuid == collection.uuid). \
+        group_by(Patient.submitter_case_id).all()
+    sizes = {submitter_case_id: instances for submitter_case_id, instances in rows}
+    if args.hierarchy_cache and args.hierarchy_cache.has_collection(collection.collection_id):
+        for patient in collection.patients:
+            instances = args.hierarchy_cache.patient_instances(collection.collection_id, patient.submitter_case_id)
+            if instances:
+                sizes[patient.submitter_case_id] = instances
+    return sizes
+
+
+# Return a list of (patient_index, submitter_case_id, patient uuid, estimated instances) of the patients of a
+# collection that are not done, largest first
+def schedule_patients(sess, args, collection):
+    sizes = estimate_patient_sizes(sess, args, collection)
+    all_patients = sorted(patient.submitter_case_id for patient in collection.patients)
+    indices = {submitter_case_id: index for index, submitter_case_id in enumerate(all_patients)}
+    patients = sorted((patient for patient in collection.patients if not patient.done),
+                      key=lambda patient: (-sizes.get(patient.submitter_case_id, 0), patient.submitter_case_id))
+    return [(f'{indices[patient.submitter_case_id] + 1} of {len(all_patients)}', patient.submitter_case_id, patient.uuid,
+             sizes.get(patient.submitter_case_id, 0)) for patient in patients]
+
+
+class Patient_Pool:
+    def __init__(self, args, num_processes):
+        self.args = args
+        self.task_queue = Queue()
+        self.done_queue = Queue()
+        # collection_id -> set of submitter_case_ids enqueued but not yet reported
+        self.outstanding = {}
+        # collection_id -> list of (submitter_case_id, pid, built, seconds)
+        self.results = {}
+        self.begin = {}
+        self.processes = []
+        lock = Lock()
+        for process in range(num_processes):
+            args.pid = process+1
+            self.processes.append(
+                Process(target=worker, args=(self.task_queue, self.done_queue, args, args.access, lock)))
+            self.processes[-1].start()
+        args.pid = 0
+
+    def submit(self, collection, tasks):
+        collection_id = collection.collection_id
+        collection_args = {key: getattr(self.args, key) for key in COLLECTION_ARGS}
+        self.outstanding[collection_id] = set(submitter_case_id for _, submitter_case_id, _, _ in tasks)
+        self.results[collection_id] = []
+        self.begin[collection_id] = time.time()
+        for patient_index, submitter_case_id, patient_uuid, instances in tasks:
+            self.task_queue.put((patient_index, collection_id, collection.uuid, submitter_case_id, patient_uuid, collection_args))
+            successlogger.info("  p%s: Patient %s %s enqueued, ~%s instances", self.args.pid, submitter_case_id,
+                               patient_index, instances)
+
+    def pending(self, collection_id=None):
+        if collection_id:
+            return len(self.outstanding.get(collection_id, []))
+        return sum(len(patients) for patients in self.outstanding.values())
+
+    # Wait for a result. Returns the collection_id of a collection all of whose patients have now been
+    # reported, else None. Raises Empty if no result arrives and a worker has died, after failing the
+    # outstanding patients, because the patient that the dead worker was building will never be reported.
+    def collect(self, timeout=RESULT_TIMEOUT):
+        try:
+            collection_id, submitter_case_id, pid, built, seconds = self.done_queue.get(True, timeout)
+        except Empty:
+            dead = [process.pid for process in self.processes if process.exitcode is not None]
+            if dead and self.pending():
+                errlogger.error("  p%s: Worker processes %s died; failing %s outstanding patients", self.args.pid,
+                                dead, self.pending())
+                for collection_id, patients in list(self.outstanding.items()):
+                    self.results[collection_id].extend((submitter_case_id, 0, False, 0) for submitter_case_id in sorted(patients))
+                    self.outstanding.pop(collection_id)
+                    self.report(collection_id)
+                raise
+            return None
+        self.outstanding[collection_id].discard(submitter_case_id)
+        self.results[collection_id].append((submitter_case_id, pid, built, seconds))
+        progresslogger.info("  p%s: Patient %s/%s %s by p%s in %s", self.args.pid, collection_id, submitter_case_id,
+                            'built' if built else 'FAILED', pid, str(timedelta(seconds=int(seconds))))
+        if not self.outstanding[collection_id]:
+            self.outstanding.pop(collection_id)
+            self.report(collection_id)
+            return collection_id
+        return None
+
+    # Wait until all the patients of a collection, or of all collections, have been reported
+    def wait(self, collection_id=None):
+        completed = []
+        while self.pending(collection_id):
+            completed_id = self.collect()
+            if completed_id:
+                completed.append(completed_id)
+        return completed
+
+    def report(self, collection_id):
+        results = self.results.pop(collection_id)
+        if not results:
+            return
+        failed = [submitter_case_id for submitter_case_id, _, built, _ in results if not built]
+        longest = max(results, key=lambda result: result[3])
+        successlogger.info("p%s: Collection %s: %s patients built, %s failed in %s; patient time %s, longest %s (%s)",
+            self.args.pid, collection_id, len(results) - len(failed), len(failed),
+            str(timedelta(seconds=int(time.time() - self.begin.pop(collection_id)))),
+            str(timedelta(seconds=int(sum(result[3] for result in results)))),
+            str(timedelta(seconds=int(longest[3]))), longest[0])
+        for submitter_case_id in failed:
+            errlogger.error("p%s: Collection %s: patient %s failed", self.args.pid, collection_id, submitter_case_id)
+
+    def close(self):
+        # Tell child processes to stop
+        for process in self.processes:
+            self.task_queue.put('STOP')
+        # Wait for them to stop
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
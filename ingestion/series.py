@@ -20,7 +20,7 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
 from idc.models import Series, Instance, instance_source
 from ingestion.instance import clone_instance, build_instances_idc, build_instances_tcia
-from ingestion.utilities.utils import is_skipped
+from ingestion.utilities.utils import add_children, classify_objects, is_skipped, mark_dirty
 from python_settings import settings
 
 
@@ -65,19 +65,11 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         # breakpoint()
         idc_objects = {object.sop_instance_uid: object for object in series.instances}
 
-        # If any (non-skipped) source has an object but IDC does not, it is new. Note that we don't get objects from
-        # skipped collections
-        new_objects = sorted([id for id, source in instances.items() \
-               if id not in idc_objects ])
-        # An object in IDC will continue to exist if any non-skipped source has the object or IDC's object has a
-        # skipped source. I.E. if an object has a skipped source then, we can't ask the source about it so assume
-        # it exists.
-        existing_objects = [obj for id, obj in idc_objects.items() \
-            if id in instances or (obj.source and skipped[obj.source.value])]
-        # An object in IDC is retired if it no longer exists in IDC
-        retired_objects = [obj for id, obj in idc_objects.items() \
-               if not obj in existing_objects ]
+        # Note that we don't get objects from skipped collections
+        new_objects, existing_objects, retired_objects = classify_objects(instances, idc_objects,
+                lambda id, obj: obj.source and skipped[obj.source.value])
 
+    added_instances = []
     for instance in sorted(new_objects):
         new_instance = Instance()
         new_instance.sop_instance_uid=instance
@@ -93,8 +85,9 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         new_instance.hash = ""
         new_instance.timestamp = datetime.utcnow()
         new_instance.final_idc_version = 0
-        series.instances.append(new_instance)
+        added_instances.append(new_instance)
         progresslogger.debug('        p%s: Instance %s is new', args.pid, new_instance.sop_instance_uid)
+    add_children(sess, args, series, 'instances', added_instances)
 
     for instance in existing_objects:
         idc_hash = instance.hash
@@ -112,6 +105,7 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
             rev_instance.size = 0
             rev_instance.rev_idc_version = settings.CURRENT_VERSION
             series.instances.append(rev_instance)
+            mark_dirty(sess, [series])
             progresslogger.debug('        p%s: Instance %s is revised', args.pid, rev_instance.sop_instance_uid)
 
             # Mark the now previous version of this object as having been replaced
@@ -132,6 +126,7 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         breakpoint()
         instance.final_idc_version = settings.PREVIOUS_VERSION
         series.instances.remove(instance)
+        mark_dirty(sess, [series])
         progresslogger.info('  p%s: Instance %s is retired', args.pid, instance.sop_instance_uid)
 
 
@@ -14,10 +14,9 @@
 # limitations under the License.
 #
 import time
-from utilities.tcia_helpers_v4 import get_hash
 from utilities.tcia_helpers import  get_TCIA_studies_per_patient, get_TCIA_patients_per_collection,\
     get_TCIA_series_per_study, get_TCIA_instance_uids_per_series, get_collection_values_and_counts,\
-    get_tcia_instance_hash, get_access_token
+    get_tcia_instance_hash, get_hash
 from idc.models  import IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance, instance_source
 from sqlalchemy import select
 from ingestion.utilities.get_collection_dois_urls_licenses import get_patient_dois_idc, \
@@ -42,6 +41,8 @@ class TCIA(Source):
         self.access = access
         self.skipped_collections = skipped_collections
         self.lock = lock
+        # Optional prefetched Hierarchy_Cache. Listings and hashes are served from it when present.
+        self.hierarchy_cache = None
 
     # def get_hash(self, request_data, access_token=None, refresh_token=None):
     #         self.lock.acquire()
@@ -63,8 +64,9 @@ class TCIA(Source):
     #             self.lock.release()
     #         return result
 
+    # self.access is a Token_Manager shared by all worker processes
     def get_hash(self, request_data):
-            result = get_hash(request_data)
+            result = get_hash(request_data, token_manager=self.access)
             if  result.status_code != 200:
                 result = None
             return result
@@ -105,6 +107,8 @@ class TCIA(Source):
     ###-------------------Patients-----------------###
 
     def patients(self, collection):
+        if self.hierarchy_cache and self.hierarchy_cache.has_collection(collection.collection_id):
+            return self.hierarchy_cache.patients(collection.collection_id)
         patients = [patient['PatientId'] for patient in get_TCIA_patients_per_collection(collection.collection_id, self.nbia_server)]
         return patients
 
@@ -113,6 +117,10 @@ class TCIA(Source):
 
 
     def src_patient_hash(self, collection_id, submitter_case_id):
+        if self.hierarchy_cache:
+            hash = self.hierarchy_cache.patient_hash(collection_id, submitter_case_id)
+            if hash is not None:
+                return hash
         try:
             result = self.get_hash({'Collection':collection_id, 'PatientID': submitter_case_id})
         except Exception as exc:
@@ -147,11 +155,17 @@ class TCIA(Source):
     ###-------------------Studies-----------------###
 
     def studies(self, patient):
+        if self.hierarchy_cache and self.hierarchy_cache.has_collection(patient.collections[0].collection_id):
+            return self.hierarchy_cache.studies(patient.collections[0].collection_id, patient.submitter_case_id)
         studies = [study['StudyInstanceUID'] for study in get_TCIA_studies_per_patient(patient.collections[0].collection_id, patient.submitter_case_id, self.nbia_server)]
         return studies
 
 
     def src_study_hash(self, study_instance_uid):
+        if self.hierarchy_cache:
+            hash = self.hierarchy_cache.study_hash(study_instance_uid)
+            if hash is not None:
+                return hash
         try:
             result = self.get_hash({'StudyInstanceUID': study_instance_uid})
         except Exception as exc:
@@ -167,12 +181,18 @@ class TCIA(Source):
     ###-------------------Series-----------------###
 
     def series(self, study):
+        if self.hierarchy_cache and self.hierarchy_cache.has_collection(study.patients[0].collections[0].collection_id):
+            return self.hierarchy_cache.series(study.study_instance_uid) or []
         series = [series['SeriesInstanceUID'] for series in get_TCIA_series_per_study(study.patients[0].collections[0].collection_id, study.patients[0].submitter_case_id, study.study_instance_uid, \
                                          self.nbia_server)]
         return series
 
 
     def src_series_hash(self, series_instance_uid):
+        if self.hierarchy_cache:
+            hash = self.hierarchy_cache.series_hash(series_instance_uid)
+            if hash is not None:
+                return hash
         try:
             result = self.get_hash({'SeriesInstanceUID': series_instance_uid})
         except Exception as exc:
@@ -204,23 +224,10 @@ class TCIA(Source):
             raise Exception('get_hash failed for instance %s', sop_instance_uid)
 
     def get_instance_hash(self, sop_instance_uid, access_token=None, refresh_token=None):
-        self.lock.acquire()
-        try:
-            # result = get_instance_hash(sop_instance_uid, self.access_token)
-            result = get_tcia_instance_hash(sop_instance_uid, self.access[0])
-            if result.status_code == 401:
-                # # Refresh the token and try once more to get the hash
-                # self.access_token, self.refresh_token = refresh_access_token(self.refresh_token)
-                # Get a new access token
-                self.access_token, self.refresh_token = get_access_token()
-                result = get_tcia_instance_hash(sop_instance_uid, self.access_token)
-                if result.status_code != 200:
-                    result = None
-            elif result.status_code != 200:
-                result = None
-        finally:
-            self.lock.release()
-            return result
+        result = get_tcia_instance_hash(sop_instance_uid, token_manager=self.access)
+        if result.status_code != 200:
+            result = None
+        return result
 
 
 class IDC(Source):
@@ -229,13 +236,35 @@ class IDC(Source):
         self.source = instance_source.idc
         self.sess = sess
         self.skipped_collections = skipped_collections
+        # Hashes memoized by the batched lookups, indexed by object ID. Listing the children of
+        # a parent replaces the memoized hashes of that level, so that at most the children of
+        # one parent are held per level.
+        self.collection_hashes = {}
+        self.patient_hashes = {}
+        self.study_hashes = {}
+        self.series_hashes = {}
+        self.instance_hashes = {}
+
+
+    # Return the hash of an object from the memoized hashes, else from a point query
+    def _src_hash(self, hashes, id, query):
+        if id in hashes:
+            return hashes[id]
+        row = self.sess.execute(query).fetchone()
+        return row.hash if row else ""
 
 
     ###-------------------Collections-----------------###
 
+    # Get the hashes of all IDC collections in one query
+    def get_collection_hashes(self):
+        query = select(IDC_Collection.collection_id, IDC_Collection.hash)
+        self.collection_hashes = {row.collection_id: row.hash for row in self.sess.execute(query).fetchall()}
+        return self.collection_hashes
+
+
     def collections(self):
-        query = select(IDC_Collection.collection_id)
-        collections = [row.collection_id for row in self.sess.execute(query).fetchall()]
+        collections = list(self.get_collection_hashes())
         for collection in self.skipped_collections:
             try:
                 collections.remove(collection)
@@ -246,22 +275,26 @@ class IDC(Source):
 
     def src_collection_hash(self, collection_id):
         query = select(IDC_Collection.hash).where(IDC_Collection.collection_id == collection_id)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
-        return hash
+        return self._src_hash(self.collection_hashes, collection_id, query)
 
 
     ###-------------------Patients-----------------###
 
+    # Get the hashes of all patients in a collection in one query
+    def get_patient_hashes(self, collection_id):
+        query = select(IDC_Patient.submitter_case_id, IDC_Patient.hash).where(IDC_Patient.collection_id == collection_id)
+        self.patient_hashes = {row.submitter_case_id: row.hash for row in self.sess.execute(query).fetchall()}
+        return self.patient_hashes
+
+
     def patients(self, collection):
-        query = select(IDC_Patient.submitter_case_id).where(IDC_Patient.collection_id == collection.collection_id)
-        patients = [row.submitter_case_id for row in self.sess.execute(query).fetchall()]
-        return patients
+        return list(self.get_patient_hashes(collection.collection_id))
 
 
     def src_patient_hash(self, collection_id, submitter_case_id):
         try:
-           query = select(IDC_Patient.hash).where(IDC_Patient.submitter_case_id == submitter_case_id)
-           hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
+            query = select(IDC_Patient.hash).where(IDC_Patient.submitter_case_id == submitter_case_id)
+            hash = self._src_hash(self.patient_hashes, submitter_case_id, query)
         except Exception as exc:
             errlogger.error(f'Exception in src_patient_hash: {exc}')
             breakpoint()
@@ -288,39 +321,51 @@ class IDC(Source):
 
     ###-------------------Studies-----------------###
 
+    # Get the hashes of all studies in a patient in one query
+    def get_study_hashes(self, submitter_case_id):
+        query = select(IDC_Study.study_instance_uid, IDC_Study.hash).where(IDC_Study.submitter_case_id == submitter_case_id)
+        self.study_hashes = {row.study_instance_uid: row.hash for row in self.sess.execute(query).fetchall()}
+        return self.study_hashes
+
+
     def studies(self, patient):
-        query = select(IDC_Study.study_instance_uid).where(IDC_Study.submitter_case_id == patient.submitter_case_id)
-        studies = [row.study_instance_uid for row in self.sess.execute(query).fetchall()]
-        return studies
+        return list(self.get_study_hashes(patient.submitter_case_id))
 
 
     def src_study_hash(self, study_instance_uid):
         query = select(IDC_Study.hash).where(IDC_Study.study_instance_uid == study_instance_uid)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
-        return hash
+        return self._src_hash(self.study_hashes, study_instance_uid, query)
 
     ###-------------------Series-----------------###
 
+    # Get the hashes of all series in a study in one query
+    def get_series_hashes(self, study_instance_uid):
+        query = select(IDC_Series.series_instance_uid, IDC_Series.hash).where(IDC_Series.study_instance_uid == study_instance_uid)
+        self.series_hashes = {row.series_instance_uid: row.hash for row in self.sess.execute(query).fetchall()}
+        return self.series_hashes
+
+
     def series(self, study):
-        query = select(IDC_Series.series_instance_uid).where(IDC_Series.study_instance_uid == study.study_instance_uid)
-        series = [row.series_instance_uid for row in self.sess.execute(query).fetchall()]
-        return series
+        return list(self.get_series_hashes(study.study_instance_uid))
 
 
     def src_series_hash(self, series_instance_uid):
         query = select(IDC_Series.hash).where(IDC_Series.series_instance_uid == series_instance_uid)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
-        return hash
+        return self._src_hash(self.series_hashes, series_instance_uid, query)
 
     ###-------------------Instances-----------------###
 
+    # Get the hashes of all instances in a series in one query
+    def get_instance_hashes(self, series_instance_uid):
+        query = select(IDC_Instance.sop_instance_uid, IDC_Instance.hash).where(IDC_Instance.series_instance_uid == series_instance_uid)
+        self.instance_hashes = {row.sop_instance_uid: row.hash for row in self.sess.execute(query).fetchall()}
+        return self.instance_hashes
+
+
     def instances(self, collection, series):
-        query = select(IDC_Instance.sop_instance_uid).where(IDC_Instance.series_instance_uid == series.series_instance_uid)
-        instances = [row.sop_instance_uid for row in self.sess.execute(query).fetchall()]
-        return instances
+        return list(self.get_instance_hashes(series.series_instance_uid))
 
     def src_instance_hash(self, sop_instance_uid):
         query = select(IDC_Instance.hash).where(IDC_Instance.sop_instance_uid == sop_instance_uid)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
-        return hash
+        return self._src_hash(self.instance_hashes, sop_instance_uid, query)
 
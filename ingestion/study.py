@@ -20,7 +20,7 @@ from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
 from idc.models import Study, Series, instance_source
-from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped
+from ingestion.utilities.utils import accum_sources, add_children, classify_objects, get_merkle_hash, is_skipped, mark_dirty
 from ingestion.series import clone_series, build_series, retire_series
 
 from python_settings import settings
@@ -68,19 +68,11 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
     else:
         # Get the IDs of the series that we have.
         idc_objects = {object.series_instance_uid: object for object in study.seriess}
-        # If any (non-skipped) source has an object but IDC does not, it is new. Note that we don't get objects from
-        # skipped collections
-        new_objects = sorted([id for id in seriess \
-                if not id in idc_objects])
-        # An object in IDC will continue to exist if any non-skipped source has the object or IDC's object has a
-        # skipped source. I.E. if an object has a skipped source then, we can't ask the source about it so assume
-        # it exists.
-        existing_objects = [obj for id, obj in idc_objects.items() \
-                if id in seriess or any([a and b for a, b in zip(obj.sources,skipped)])]
-        # An object in IDC is retired if it no longer exists in IDC
-        retired_objects = [obj for id, obj in idc_objects.items() \
-                if not obj in existing_objects]
+        # Note that we don't get objects from skipped collections
+        new_objects, existing_objects, retired_objects = classify_objects(seriess, idc_objects,
+                lambda id, obj: any([a and b for a, b in zip(obj.sources,skipped)]))
 
+    added_seriess = []
     for series in sorted(new_objects):
         new_series = Series()
         new_series.series_instance_uid = series
@@ -108,8 +100,9 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
         new_series.done=False
         new_series.is_new=True
         new_series.expanded=False
-        study.seriess.append(new_series)
+        added_seriess.append(new_series)
         progresslogger.debug('      p%s:Series %s new', args.pid, new_series.series_instance_uid)
+    add_children(sess, args, study, 'seriess', added_seriess)
 
     for series in existing_objects:
         idc_hashes = series.hashes
@@ -137,6 +130,7 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
             rev_series.rev_idc_version = settings.CURRENT_VERSION
             rev_series.versioned_source_doi = dois_urls[series.series_instance_uid]['versioned_source_doi']
             study.seriess.append(rev_series)
+            mark_dirty(sess, [study, rev_series])
             progresslogger.debug('      p%s:Series %s revised',  args.pid, rev_series.series_instance_uid)
 
             # Mark the now previous version of this object as having been replaced
@@ -158,6 +152,7 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
         # breakpoint()
         retire_series(args, series)
         study.seriess.remove(series)
+        mark_dirty(sess, [study])
         progresslogger.info('  p%s: Series %s is retired', args.pid, series.series_instance_uid)
 
 
@@ -180,8 +175,8 @@ def build_study(sess, args, all_sources, study_index, version, collection, patie
             successlogger.info("    p%s: Study previously expanded %s, %s, %s series", args.pid,
                                study.study_instance_uid, study_index, len(study.seriess))
 
-        for series in study.seriess:
-            series_index = f'{study.seriess.index(series) + 1} of {len(study.seriess)}'
+        for index, series in enumerate(study.seriess):
+            series_index = f'{index + 1} of {len(study.seriess)}'
             if not series.done:
                 successlogger.info("      p%s: Building Series %s, %s", args.pid, series.series_instance_uid,
                                    series_index)
@@ -0,0 +1,98 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Check classify_objects() against the list comprehensions that the expand_* functions used before.
+# Run from the repo root: python -m pytest ingestion/tests
+
+import random
+from enum import Enum
+import pytest
+
+utils = pytest.importorskip('ingestion.utilities.utils')
+
+
+class Source(Enum):
+    tcia = 0
+    idc = 1
+
+
+# Compares by identity, as do the model objects
+class Obj:
+    def __init__(self, id, source=None, sources=None):
+        self.id = id
+        self.source = source
+        self.sources = sources
+
+
+# As in expand_series
+def series_skipped(skipped):
+    return lambda id, obj: obj.source and skipped[obj.source.value]
+
+
+# As in expand_version, expand_collection, expand_patient and expand_study
+def sources_skipped(skipped):
+    return lambda id, obj: any([a and b for a, b in zip(obj.sources, skipped)])
+
+
+# The classification as it was done before classify_objects()
+def old_classify(src_objects, idc_objects, has_skipped_source):
+    new_objects = sorted([id for id in src_objects if not id in idc_objects])
+    existing_objects = [obj for id, obj in idc_objects.items()
+                        if id in src_objects or has_skipped_source(id, obj)]
+    retired_objects = [obj for id, obj in idc_objects.items()
+                       if not obj in existing_objects]
+    return new_objects, existing_objects, retired_objects
+
+
+def test_new_existing_retired():
+    idc_objects = {id: Obj(id, sources=[True, False]) for id in ['a', 'b', 'c']}
+    new_objects, existing_objects, retired_objects = \
+        utils.classify_objects({'b': None, 'c': None, 'd': None}, idc_objects, sources_skipped([False, False]))
+    assert new_objects == ['d']
+    assert existing_objects == [idc_objects['b'], idc_objects['c']]
+    assert retired_objects == [idc_objects['a']]
+
+
+def test_skipped_source_is_not_retired():
+    idc_objects = {'a': Obj('a', source=Source.idc), 'b': Obj('b', source=Source.tcia)}
+    new_objects, existing_objects, retired_objects = \
+        utils.classify_objects({}, idc_objects, series_skipped([False, True]))
+    assert new_objects == []
+    assert existing_objects == [idc_objects['a']]
+    assert retired_objects == [idc_objects['b']]
+
+
+def test_empty():
+    assert utils.classify_objects({}, {}, sources_skipped([False, False])) == ([], [], [])
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_old_classification(seed):
+    rng = random.Random(seed)
+    ids = [f'1.2.{i}' for i in range(rng.randint(0, 50))]
+    skipped = [rng.random() < 0.5, rng.random() < 0.5]
+    src_objects = {id: None for id in ids if rng.random() < 0.6}
+    series_objects = {id: Obj(id, source=rng.choice([None, Source.tcia, Source.idc]))
+                      for id in ids if rng.random() < 0.6}
+    parent_objects = {id: Obj(id, sources=[rng.random() < 0.5, rng.random() < 0.5])
+                      for id in ids if rng.random() < 0.6}
+
+    for idc_objects, has_skipped_source in [(series_objects, series_skipped(skipped)),
+                                            (parent_objects, sources_skipped(skipped))]:
+        # src_objects may be a dictionary or a set
+        for src in [src_objects, set(src_objects)]:
+            assert utils.classify_objects(src, idc_objects, has_skipped_source) == \
+                   old_classify(src, idc_objects, has_skipped_source)
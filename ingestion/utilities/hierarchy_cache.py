@@ -0,0 +1,214 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Prefetch the TCIA patient/study/series hierarchy of a collection, and the NBIA hash of
+# each object in it, before the collection is expanded. Listings and hashes are fetched
+# concurrently by a bounded pool of threads. The TCIA source answers from this cache, falling
+# back to NBIA on a miss, so that expansion does not make one serial NBIA round-trip per object.
+
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utilities.tcia_helpers import get_hash, get_TCIA_patients_per_collection, get_TCIA_series_per_collection
+from utilities.logging_config import successlogger, progresslogger, errlogger
+
+PREFETCH_THREADS = 8
+# A saved hierarchy older than this is not reused, as TCIA may have revised the collection since
+MAX_AGE = 24 * 60 * 60
+
+
+class Hierarchy_Cache:
+    def __init__(self, cache_dir='', threads=PREFETCH_THREADS, nbia_server='NBIA', version=None, max_age=MAX_AGE):
+        self.cache_dir = cache_dir
+        # Saved hierarchies are keyed by the version being built, and are only reused if less than max_age seconds old
+        self.version = version
+        self.max_age = max_age
+        self.threads = threads
+        self.nbia_server = nbia_server
+        # Per collection listings
+        self.collection_patients = {}   # collection_id -> [submitter_case_id]
+        self.collection_studies = {}    # collection_id -> {submitter_case_id: [study_instance_uid]}
+        self.patient_hashes = {}        # collection_id -> {submitter_case_id: hash}
+        # Study and series UIDs are globally unique, so these are not indexed by collection
+        self.study_series = {}          # study_instance_uid -> [series_instance_uid]
+        self.study_hashes = {}          # study_instance_uid -> hash
+        self.series_hashes = {}         # series_instance_uid -> hash
+        self.series_instances = {}      # series_instance_uid -> NBIA ImageCount
+
+    def has_collection(self, collection_id):
+        return collection_id in self.collection_patients
+
+    ###-------------------Lookups-----------------###
+    # Each lookup returns None if the cache doesn't have the object
+
+    def patients(self, collection_id):
+        return self.collection_patients.get(collection_id)
+
+    def studies(self, collection_id, submitter_case_id):
+        if collection_id in self.collection_studies:
+            return self.collection_studies[collection_id].get(submitter_case_id, [])
+        return None
+
+    def series(self, study_instance_uid):
+        return self.study_series.get(study_instance_uid)
+
+    def patient_hash(self, collection_id, submitter_case_id):
+        return self.patient_hashes.get(collection_id, {}).get(submitter_case_id)
+
+    def study_hash(self, study_instance_uid):
+        return self.study_hashes.get(study_instance_uid)
+
+    def series_hash(self, series_instance_uid):
+        return self.series_hashes.get(series_instance_uid)
+
+    # The number of instances that NBIA reports for a patient; used to estimate the work to build it
+    def patient_instances(self, collection_id, submitter_case_id):
+        studies = self.studies(collection_id, submitter_case_id)
+        if studies is None:
+            return None
+        return sum(self.series_instances.get(series, 0) for study in studies for series in self.study_series.get(study, []))
+
+    ###-------------------Prefetch-----------------###
+
+    def _cache_file(self, collection_id):
+        return f"{self.cache_dir}/v{self.version}_{collection_id.replace(' ', '_').replace('/', '_')}.json"
+
+    # Returns True if a hierarchy of the collection has been saved for this version, and is not stale
+    def _is_saved(self, collection_id):
+        return bool(self.cache_dir) and os.path.exists(self._cache_file(collection_id)) and \
+            time.time() - os.path.getmtime(self._cache_file(collection_id)) < self.max_age
+
+    def _get_hash(self, request_data):
+        try:
+            result = get_hash(request_data)
+            if result.status_code == 200:
+                return result.content.decode()
+        except Exception as exc:
+            errlogger.error('Hierarchy_Cache: get_hash(%s) failed: %s', request_data, exc)
+        # On failure, leave the object uncached. The source will request it on demand.
+        return None
+
+    def _get_hashes(self, executor, requests):
+        # requests is a dictionary of id -> request_data. Return id -> hash of the successful requests
+        ids = list(requests)
+        hashes = executor.map(self._get_hash, [requests[id] for id in ids])
+        return {id: hash for id, hash in zip(ids, hashes) if hash is not None}
+
+    def prefetch(self, collection_id):
+        if self.has_collection(collection_id):
+            return
+        if self._is_saved(collection_id) and self.load(collection_id):
+            progresslogger.info('Hierarchy_Cache: Loaded %s from %s', collection_id, self._cache_file(collection_id))
+            return
+
+        begin = time.time()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            # Two listing calls give us the entire hierarchy of the collection
+            patients_future = executor.submit(get_TCIA_patients_per_collection, collection_id, self.nbia_server)
+            series_future = executor.submit(get_TCIA_series_per_collection, collection_id, self.nbia_server)
+            patients = sorted(patient['PatientId'] for patient in patients_future.result())
+            studies = {patient: [] for patient in patients}
+            study_series = {}
+            series_instances = {}
+            for series in series_future.result():
+                if not series['StudyInstanceUID'] in study_series:
+                    study_series[series['StudyInstanceUID']] = []
+                    studies.setdefault(series['PatientID'], []).append(series['StudyInstanceUID'])
+                study_series[series['StudyInstanceUID']].append(series['SeriesInstanceUID'])
+                series_instances[series['SeriesInstanceUID']] = series.get('ImageCount', 0)
+
+            patient_hashes = self._get_hashes(executor,
+                {patient: {'Collection': collection_id, 'PatientID': patient} for patient in patients})
+            study_hashes = self._get_hashes(executor,
+                {study: {'StudyInstanceUID': study} for study in study_series})
+            series_hashes = self._get_hashes(executor,
+                {series: {'SeriesInstanceUID': series} for seriess in study_series.values() for series in seriess})
+
+        self.collection_patients[collection_id] = patients
+        self.collection_studies[collection_id] = studies
+        self.patient_hashes[collection_id] = patient_hashes
+        self.study_series.update(study_series)
+        self.study_hashes.update(study_hashes)
+        self.series_hashes.update(series_hashes)
+        self.series_instances.update(series_instances)
+
+        successlogger.info('Hierarchy_Cache: Prefetched %s: %s/%s patient, %s/%s study, %s/%s series hashes in %.1fs',
+            collection_id, len(patient_hashes), len(patients), len(study_hashes), len(study_series),
+            len(series_hashes), sum(len(seriess) for seriess in study_series.values()), time.time() - begin)
+
+        if self.cache_dir:
+            self.save(collection_id)
+
+    # Drop a collection from the in-memory cache once it has been built
+    def discard(self, collection_id):
+        if not self.has_collection(collection_id):
+            return
+        for patient_studies in self.collection_studies.pop(collection_id).values():
+            for study in patient_studies:
+                for series in self.study_series.pop(study, []):
+                    self.series_hashes.pop(series, None)
+                    self.series_instances.pop(series, None)
+                self.study_hashes.pop(study, None)
+        self.collection_patients.pop(collection_id)
+        self.patient_hashes.pop(collection_id)
+
+    ###-------------------Persistence-----------------###
+
+    def save(self, collection_id):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        studies = self.collection_studies[collection_id]
+        study_uids = [study for patient_studies in studies.values() for study in patient_studies]
+        series_uids = [series for study in study_uids for series in self.study_series[study]]
+        data = dict(
+            version = self.version,
+            saved = time.time(),
+            patients = self.collection_patients[collection_id],
+            studies = studies,
+            patient_hashes = self.patient_hashes[collection_id],
+            study_series = {study: self.study_series[study] for study in study_uids},
+            study_hashes = {study: self.study_hashes[study] for study in study_uids if study in self.study_hashes},
+            series_hashes = {series: self.series_hashes[series] for series in series_uids if series in self.series_hashes},
+            series_instances = {series: self.series_instances[series] for series in series_uids if series in self.series_instances}
+        )
+        # Write then rename so that a partially written file is never loaded
+        with open(f'{self._cache_file(collection_id)}.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(f'{self._cache_file(collection_id)}.tmp', self._cache_file(collection_id))
+
+    # Returns False, and loads nothing, if the file was saved for another version or is stale
+    def load(self, collection_id):
+        with open(self._cache_file(collection_id)) as f:
+            data = json.load(f)
+        if data.get('version') != self.version or time.time() - data.get('saved', 0) >= self.max_age:
+            progresslogger.info('Hierarchy_Cache: Ignoring stale %s', self._cache_file(collection_id))
+            return False
+        self.collection_patients[collection_id] = data['patients']
+        self.collection_studies[collection_id] = data['studies']
+        self.patient_hashes[collection_id] = data['patient_hashes']
+        self.study_series.update(data['study_series'])
+        self.study_hashes.update(data['study_hashes'])
+        self.series_hashes.update(data['series_hashes'])
+        # Not present in files saved before instance counts were cached
+        self.series_instances.update(data.get('series_instances', {}))
+        return True
+
+    # Load a collection that was saved by another process, if it has been saved. Returns True if the
+    # collection is then in the cache.
+    def load_saved(self, collection_id):
+        if not self.has_collection(collection_id) and self._is_saved(collection_id):
+            self.load(collection_id)
+        return self.has_collection(collection_id)
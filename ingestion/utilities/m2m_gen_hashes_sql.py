@@ -13,167 +13,392 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-# This script updates all hashes in the M2M hierarchy
-# and for a specified collection
+# This script recomputes, in the DB, the per-source hashes of the objects in the versioned
+# version->collection->patient->study->series->instance M2M hierarchy, either of a whole
+# version or of one collection. Hashes are computed bottom-up with string_agg/md5, exactly as
+# get_merkle_hash() and the All_Sources.idc_*_hashes() methods compute them:
+#   series:  the hash of the series' source, and all_sources, are the merkle hash of its instances'
+#            hashes. The hash of the other source is "".
+#   others:  for each of tcia, idc, all_sources, the merkle hash of the children's hashes of that
+#            source, or "" if all those hashes are "".
+# Hashes are sorted with the "C" collation so that the order is that of Python's sort.
+# With --cross_check, each level's SQL hashes are compared with hashes computed in Python by
+# get_merkle_hash from the same children's hashes.
+# With --incremental, only dirty objects are rehashed. Ingestion records in merkle_dirty the objects
+# that it adds, revises, or retires children of, and the records accumulate across ingestion runs
+# until an incremental pass that stores hashes consumes them. The parents of an object are rehashed
+# only if its hash changed, so the cost is that of the delta rather than of the version. With
+# --seed_dirty, the objects added or revised in the version are first found by a scan of each table,
+# e.g. for a version ingested before the objects it touched were recorded.
+# The idc_* tables, which are not versioned, are hashed by the gen_idc_*_hashes functions.
 import sys
 import argparse
-from idc.models import IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance
+import time
 from ingestion.utilities.utils import get_merkle_hash
 
-from utilities.logging_config import progresslogger
+from utilities.logging_config import successlogger, progresslogger, errlogger
 from python_settings import settings
-from sqlalchemy import func, update, literal_column
 from utilities.sqlalchemy_helpers import sa_session
-from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.sql import text
 
-from google.cloud import storage
+SOURCES = ['tcia', 'idc', 'all_sources']
 
+# Levels above series, bottom up: (table, primary key, association table, parent column, child column, child table)
+PARENT_LEVELS = [
+    ('study', 'uuid', 'study_series', 'study_uuid', 'series_uuid', 'series'),
+    ('patient', 'uuid', 'patient_study', 'patient_uuid', 'study_uuid', 'study'),
+    ('collection', 'uuid', 'collection_patient', 'collection_uuid', 'patient_uuid', 'patient'),
+    ('version', 'version', 'version_collection', 'version', 'collection_uuid', 'collection'),
+]
 
-def gen_series_hashes(sess):
+
+# SQL selecting the primary keys of the objects of each level in the scope of a version or of one collection
+def scope_queries(version, collection_uuid=None):
+    scopes = {}
+    scopes['version'] = f"SELECT {int(version)}"
+    if collection_uuid:
+        scopes['collection'] = "SELECT CAST(:collection_uuid AS VARCHAR)"
+    else:
+        scopes['collection'] = f"SELECT collection_uuid FROM version_collection WHERE version IN ({scopes['version']})"
+    scopes['patient'] = f"SELECT patient_uuid FROM collection_patient WHERE collection_uuid IN ({scopes['collection']})"
+    scopes['study'] = f"SELECT study_uuid FROM patient_study WHERE patient_uuid IN ({scopes['patient']})"
+    scopes['series'] = f"SELECT series_uuid FROM study_series WHERE study_uuid IN ({scopes['study']})"
+    return scopes
+
+
+def series_hashes_query(scope):
+    return f"""
+        SELECT se_i.series_uuid AS id,
+            count(DISTINCT i.source) AS sources,
+            min(CAST(i.source AS VARCHAR)) AS source,
+            md5(string_agg(coalesce(i.hash, ''), '' ORDER BY coalesce(i.hash, '') COLLATE "C")) AS hash
+        FROM series_instance se_i
+        JOIN instance i
+        ON se_i.instance_uuid = i.uuid
+        WHERE se_i.series_uuid IN ({scope})
+        GROUP BY se_i.series_uuid"""
+
+
+def parent_hashes_query(level, scope):
+    table, key, assoc, parent_column, child_column, child_table = level
+    aggs = ',\n'.join(
+        f"""string_agg(coalesce((c.hashes).{source}, ''), '' ORDER BY coalesce((c.hashes).{source}, '') COLLATE "C") AS {source}""" \
+        for source in SOURCES)
+    hashes = ',\n'.join(
+        f"CASE WHEN {source} = '' THEN '' ELSE md5({source}) END AS {source}" for source in SOURCES)
+    return f"""
+        SELECT id, {hashes}
+        FROM (
+            SELECT a.{parent_column} AS id,
+            {aggs}
+            FROM {assoc} a
+            JOIN {child_table} c
+            ON a.{child_column} = c.uuid
+            WHERE a.{parent_column} IN ({scope})
+            GROUP BY a.{parent_column}) AS aggs"""
+
+
+# Compute, and if update, store, the hashes of the series in scope. Series whose instances are from
+# more than one source are invalid, and are neither hashed nor updated.
+# Returns a dictionary of series uuid -> [tcia, idc, all_sources] hash
+def gen_series_hashes(sess, scope, params, update):
+    query = series_hashes_query(scope)
+    if update:
+        # A data modifying CTE, so that the hashes are aggregated once, both to update and to return
+        query = f"""
+            WITH s AS ({query}),
+            u AS (
+                UPDATE series
+                SET hashes = ROW(CASE WHEN s.source = 'tcia' THEN s.hash ELSE '' END,
+                                 CASE WHEN s.source = 'idc' THEN s.hash ELSE '' END,
+                                 s.hash)::hashes
+                FROM s
+                WHERE series.uuid = s.id AND s.sources = 1)
+            SELECT * FROM s"""
+    hashes = {}
+    for row in sess.execute(text(query), params).fetchall():
+        if row.sources != 1:
+            errlogger.error('Instances in series %s have inconsistent sources', row.id)
+            continue
+        hashes[row.id] = [row.hash if row.source == source else '' for source in SOURCES[:-1]] + [row.hash]
+    return hashes
+
+
+# Compute, and if update, store, the hashes of the objects of a level above series that are in scope.
+# Returns a dictionary of primary key -> [tcia, idc, all_sources] hash
+def gen_parent_hashes(sess, level, scope, params, update):
+    table, key = level[0], level[1]
+    query = parent_hashes_query(level, scope)
+    if update:
+        query = f"""
+            WITH p AS ({query}),
+            u AS (
+                UPDATE {table}
+                SET hashes = ROW(p.tcia, p.idc, p.all_sources)::hashes
+                FROM p
+                WHERE {table}.{key} = p.id)
+            SELECT * FROM p"""
+    return {row.id: [row.tcia, row.idc, row.all_sources] for row in sess.execute(text(query), params).fetchall()}
+
+
+###-------------------Python cross check-----------------###
+
+# Compute the hashes of the series in scope in Python, as All_Sources.idc_series_hashes does
+def py_series_hashes(sess, scope, params):
+    children = {}
+    for row in sess.execute(text(f"""
+            SELECT se_i.series_uuid AS id, i.hash, CAST(i.source AS VARCHAR) AS source
+            FROM series_instance se_i
+            JOIN instance i
+            ON se_i.instance_uuid = i.uuid
+            WHERE se_i.series_uuid IN ({scope})"""), params):
+        children.setdefault(row.id, []).append(row)
+    hashes = {}
+    for id, rows in children.items():
+        if len(set(row.source for row in rows)) != 1:
+            continue
+        hash = get_merkle_hash([row.hash or '' for row in rows])
+        hashes[id] = [hash if rows[0].source == source else '' for source in SOURCES[:-1]] + [hash]
+    return hashes
+
+
+# Compute the hashes of the parents in scope in Python, as All_Sources.idc_*_hashes do
+def py_parent_hashes(sess, level, scope, params):
+    table, key, assoc, parent_column, child_column, child_table = level
+    children = {}
+    for row in sess.execute(text(f"""
+            SELECT a.{parent_column} AS id, (c.hashes).tcia AS tcia, (c.hashes).idc AS idc, (c.hashes).all_sources AS all_sources
+            FROM {assoc} a
+            JOIN {child_table} c
+            ON a.{child_column} = c.uuid
+            WHERE a.{parent_column} IN ({scope})"""), params):
+        children.setdefault(row.id, []).append([row.tcia or '', row.idc or '', row.all_sources or ''])
+    return {id: [get_merkle_hash([row[source] for row in childrens_hashes]) \
+                 if set([row[source] for row in childrens_hashes]) != set(['']) else '' for source in range(len(SOURCES))] \
+            for id, childrens_hashes in children.items()}
+
+
+def cross_check(table, sql_hashes, py_hashes):
+    mismatches = [id for id in set(sql_hashes) | set(py_hashes) if sql_hashes.get(id) != py_hashes.get(id)]
+    for id in mismatches[:100]:
+        errlogger.error('Cross check: %s %s: SQL %s, Python %s', table, id, sql_hashes.get(id), py_hashes.get(id))
+    progresslogger.info('Cross check: %s: %s of %s hashes agree', table, len(sql_hashes) - len(mismatches), len(sql_hashes))
+    return len(mismatches)
+
+
+# Recompute the hashes of a version, or of one collection of a version, bottom up.
+# If update, the hashes are stored, and each level is hashed from the stored hashes of the level below.
+# If check, each level is also hashed in Python, and the number of mismatches is returned.
+def gen_m2m_hashes(sess, version, collection_uuid=None, update=True, check=False):
+    scopes = scope_queries(version, collection_uuid)
+    params = {'collection_uuid': collection_uuid} if collection_uuid else {}
+    mismatches = 0
+
+    begin = time.time()
+    hashes = gen_series_hashes(sess, scopes['series'], params, update)
+    progresslogger.info('Hashed %s series in %.1fs', len(hashes), time.time() - begin)
+    if check:
+        mismatches += cross_check('series', hashes, py_series_hashes(sess, scopes['series'], params))
+
+    for level in PARENT_LEVELS:
+        table = level[0]
+        if collection_uuid and table == 'version':
+            # The version's hash depends on collections outside the scope
+            break
+        begin = time.time()
+        hashes = gen_parent_hashes(sess, level, scopes[table], params, update)
+        progresslogger.info('Hashed %s %s in %.1fs', len(hashes), table, time.time() - begin)
+        if check:
+            mismatches += cross_check(table, hashes, py_parent_hashes(sess, level, scopes[table], params))
+    return mismatches
+
+
+###-------------------Incremental maintenance-----------------###
+
+# Mark dirty the objects of each level that were added or revised in a version, and the version
+# itself. Any new or revised instance is in such a series. A revision that only retires children,
+# e.g. a series dropped from a study, changes no series, but revises the parent that lost them.
+def seed_dirty(sess, version):
+    for table in ['series'] + [level[0] for level in PARENT_LEVELS if level[0] != 'version']:
+        sess.execute(text(f"""
+            INSERT INTO merkle_dirty (version, table_name, id)
+            SELECT :version, '{table}', uuid
+            FROM {table}
+            WHERE rev_idc_version = :version AND final_idc_version = 0
+            ON CONFLICT DO NOTHING"""), {'version': version})
+    sess.execute(text("""
+        INSERT INTO merkle_dirty (version, table_name, id)
+        VALUES (:version, 'version', CAST(:version AS VARCHAR))
+        ON CONFLICT DO NOTHING"""), {'version': version})
+
+
+def dirty_query(table):
+    return f"SELECT id FROM merkle_dirty WHERE version = :version AND table_name = '{table}'"
+
+
+def stored_hashes(sess, table, key, scope, params):
+    return {row.id: [row.tcia or '', row.idc or '', row.all_sources or ''] for row in sess.execute(text(f"""
+        SELECT {key} AS id, (hashes).tcia AS tcia, (hashes).idc AS idc, (hashes).all_sources AS all_sources
+        FROM {table}
+        WHERE {key} IN ({scope})"""), params)}
+
+
+# Rehash the dirty objects of a version, and those of their ancestors in the version whose
+# children's hashes changed. Unchanged subtrees contribute their stored hashes. If update,
+# the hashes are stored and the version's dirty set is cleared.
+def gen_incremental_hashes(sess, version, update=True, check=False, seed=False):
+    if seed:
+        seed_dirty(sess, version)
+    params = {'version': version}
+    mismatches = 0
+
+    begin = time.time()
+    scope = dirty_query('series')
+    previous = stored_hashes(sess, 'series', 'uuid', scope, params)
+    hashes = gen_series_hashes(sess, scope, params, update)
+    if check:
+        mismatches += cross_check('series', hashes, py_series_hashes(sess, scope, params))
+    changed = [id for id, hash in hashes.items() if hash != previous.get(id)]
+    progresslogger.info('Rehashed %s dirty series, %s changed, in %.1fs', len(hashes), len(changed), time.time() - begin)
+
+    for level in PARENT_LEVELS:
+        table, key, assoc, parent_column, child_column, child_table = level
+        begin = time.time()
+        params['changed'] = changed
+        if table == 'version':
+            if not changed and not sess.execute(text(dirty_query(table)), params).first():
+                break
+            scope = "SELECT CAST(:version AS INTEGER)"
+        else:
+            # Parents in the current version of the children whose hashes changed, and dirty objects of this level
+            scope = f"""
+                SELECT a.{parent_column}
+                FROM {assoc} a
+                JOIN {table} p
+                ON a.{parent_column} = p.{key}
+                WHERE a.{child_column} = ANY(CAST(:changed AS VARCHAR[])) AND p.final_idc_version = 0
+                UNION
+                {dirty_query(table)}"""
+        previous = stored_hashes(sess, table, key, scope, params)
+        hashes = gen_parent_hashes(sess, level, scope, params, update)
+        if check:
+            mismatches += cross_check(table, hashes, py_parent_hashes(sess, level, scope, params))
+        changed = [id for id, hash in hashes.items() if hash != previous.get(id)]
+        progresslogger.info('Rehashed %s %s, %s changed, in %.1fs', len(hashes), table, len(changed), time.time() - begin)
+
+    if update:
+        sess.execute(text("DELETE FROM merkle_dirty WHERE version = :version"), {'version': version})
+    return mismatches
+
+
+###-------------------idc_* tables-----------------###
+
+def gen_idc_series_hashes(sess):
     update_hashes = text(
-        "UPDATE series "
+        "UPDATE idc_series "
         "SET hash = md5(hashes.hashes) "
         "FROM "
-        "(SELECT se_uuid, string_agg(hash, '' ORDER BY hash) hashes "
-        "FROM series_instance se_i"
-        "JOIN instance "
-        "ON se_i.sop_instance_uud = instance.sop_instance_uid"
-        "GROUP BY se_uuid ) AS hashes "
+        "(SELECT series_instance_uid, string_agg(hash, '' ORDER BY hash COLLATE \"C\") hashes "
+        "FROM idc_instance "
+        "GROUP BY series_instance_uid) AS hashes "
         "WHERE idc_series.series_instance_uid = hashes.series_instance_uid "
         "RETURNING idc_series.series_instance_uid, hash "
     )
     result = sess.execute(update_hashes).fetchall()
-    pass
-def gen_study_hashes(sess):
+    return result
+
+
+def gen_idc_study_hashes(sess):
     update_hashes = text(
         "UPDATE idc_study "
         "SET hash = md5(hashes.hashes) "
         "FROM "
-        "(SELECT study_instance_uid, string_agg(hash, '' ORDER BY hash) hashes "
+        "(SELECT study_instance_uid, string_agg(hash, '' ORDER BY hash COLLATE \"C\") hashes "
         "FROM idc_series "
         "GROUP BY study_instance_uid) AS hashes "
         "WHERE idc_study.study_instance_uid = hashes.study_instance_uid "
         "RETURNING idc_study.study_instance_uid, hash "
     )
     result = sess.execute(update_hashes).fetchall()
-    pass
+    return result
 
 
-def gen_patient_hashes(sess):
+def gen_idc_patient_hashes(sess):
     update_hashes = text(
         "UPDATE idc_patient "
         "SET hash = md5(hashes.hashes) "
         "FROM "
-        "(SELECT submitter_case_id, string_agg(hash, '' ORDER BY hash) hashes "
+        "(SELECT submitter_case_id, string_agg(hash, '' ORDER BY hash COLLATE \"C\") hashes "
         "FROM idc_study "
         "GROUP BY submitter_case_id) AS hashes "
         "WHERE idc_patient.submitter_case_id = hashes.submitter_case_id "
         "RETURNING idc_patient.submitter_case_id, hash "
     )
     result = sess.execute(update_hashes).fetchall()
-    pass
+    return result
 
 
-def gen_collection_hashes(sess):
+def gen_idc_collection_hashes(sess):
     update_hashes = text(
         "UPDATE idc_collection "
         "SET hash = md5(hashes.hashes) "
         "FROM "
-        "(SELECT collection_id, string_agg(hash, '' ORDER BY hash) hashes "
+        "(SELECT collection_id, string_agg(hash, '' ORDER BY hash COLLATE \"C\") hashes "
         "FROM idc_patient "
         "GROUP BY collection_id) AS hashes "
         "WHERE idc_collection.collection_id = hashes.collection_id "
         "RETURNING idc_collection.collection_id, hash "
     )
     result = sess.execute(update_hashes).fetchall()
-    pass
-
-
-def gen_version_hashes(sess):
-    # update_hashes = """
-    #         WITH c_hashes AS (
-    #         SELECT v.version idc_version,
-    #         string_agg((c.hashes).tcia, '' ORDER BY (c.hashes).tcia) tcia_hashes,
-    #         string_agg((c.hashes).idc, '' ORDER BY (c.hashes).idc) idc_hashes,
-    #         string_agg((c.hashes).all_sources, '' ORDER BY (c.hashes).all_sources) all_sources_hashes
-    #         FROM version v
-    #         JOIN version_collection v_c
-    #         ON v.version = v_c.version
-    #         JOIN collection c
-    #         ON v_c.collection_uuid = c.uuid
-    #         GROUP BY v.version),
-    #         v_hashes AS (
-    #         SELECT idc_version,
-    #         CASE WHEN c_hashes.tcia_hashes != '' THEN md5(c_hashes.tcia_hashes) ELSE '' END AS tcia_hash ,
-    #         CASE WHEN c_hashes.idc_hashes != '' THEN md5(c_hashes.idc_hashes) ELSE '' END AS idc_hash ,
-    #         CASE WHEN c_hashes.all_sources_hashes != '' THEN md5(c_hashes.all_sources_hashes) ELSE '' END AS all_sources_hash
-    #         FROM c_hashes
-    #         GROUP BY idc_version, c_hashes.tcia_hashes, c_hashes.idc_hashes, c_hashes.all_sources_hashes)
-    #         UPDATE version_dev
-    #         SET hashes.tcia = tcia_hash,  hashes.idc = idc_hash,  hashes.all_sources = all_sources_hash
-    #         FROM v_hashes
-    #         WHERE version = v_hashes.idc_version
-    # """
-
-
-#     update_hashes = text(
-#         "WITH c_hashes AS ("
-#         "SELECT idc_version, "
-#         "string_agg((c_hashes).tcia, '' ORDER BY (c_hashes).tcia) tcia_hashes,"
-#         "string_agg((c_hashes).idc, '' ORDER BY (c_hashes).idc) idc_hashes,"
-#         "string_agg((c_hashes).all_sources, '' ORDER BY (c_hashes).all_sources) all_sources_hashes "
-#         "FROM all_joined "
-#         "GROUP BY idc_version),"
-#         "v_hashes AS ("
-#         "SELECT idc_version, "
-#         "CASE WHEN c_hashes.tcia_hashes != '' THEN md5(c_hashes.tcia_hashes) ELSE '' END AS tcia_hash ,"
-#         "CASE WHEN c_hashes.idc_hashes != '' THEN md5(c_hashes.idc_hashes) ELSE '' END AS idc_hash ,"
-#         "CASE WHEN c_hashes.all_sources_hashes != '' THEN md5(c_hashes.all_sources_hashes) ELSE '' END AS all_sources_hash "
-#         "FROM c_hashes "
-#         "GROUP BY idc_version, c_hashes.tcia_hashes, c_hashes.idc_hashes, c_hashes.all_sources_hashes)"
-#         "UPDATE version_dev "
-#         "SET hashes.tcia = tcia_hash,  hashes.idc = idc_hash,  hashes.all_sources = all_sources_hash  "
-#         "FROM v_hashes "
-#         "WHERE version = v_hashes.idc_version"
-#     )
-#
+    return result
+
 
-    update_hashes = """
-        WITH c_hashes AS (
-        SELECT idc_version,
-        string_agg((c_hashes).tcia, '' ORDER BY (c_hashes).tcia) tcia_hashes,
-        string_agg((c_hashes).idc, '' ORDER BY (c_hashes).idc) idc_hashes,
-        string_agg((c_hashes).all_sources, '' ORDER BY (c_hashes).all_sources) all_sources_hashes
-        FROM all_joined_hashes_vc
-        GROUP BY idc_version),
-        v_hashes AS (
-        SELECT idc_version,
-        -- CASE WHEN c_hashes.tcia_hashes != '' THEN md5(c_hashes.tcia_hashes) ELSE '' END AS tcia_hash ,
-        -- CASE WHEN c_hashes.idc_hashes != '' THEN md5(c_hashes.idc_hashes) ELSE '' END AS idc_hash ,
-        -- CASE WHEN c_hashes.all_sources_hashes != '' THEN md5(c_hashes.all_sources_hashes) ELSE '' END AS all_sources_hash
-        md5(c_hashes.tcia_hashes) tcia_hash ,
-        md5(c_hashes.idc_hashes) idc_hash ,
-        md5(c_hashes.all_sources_hashes) all_sources_hash
-        FROM c_hashes
-        GROUP BY idc_version, c_hashes.tcia_hashes, c_hashes.idc_hashes, c_hashes.all_sources_hashes)
-        UPDATE version_dev
-        SET hashes.tcia = tcia_hash,  hashes.idc = idc_hash,  hashes.all_sources = all_sources_hash
-        FROM v_hashes
-        WHERE version = v_hashes.idc_version
-"""
-    result = sess.execute(update_hashes)
-    pass
-
-def gen_hashes():
-    with sa_session(echo=True) as sess:
-        # gen_series_hashes(sess)
-        # gen_study_hashes(sess)
-        # gen_patient_hashes(sess)
-        # gen_collection_hashes(sess)
-        gen_version_hashes(sess)
-        sess.commit()
-    progresslogger.info("Updated hashes")
+def gen_hashes(args):
+    with sa_session() as sess:
+        if args.idc_tables:
+            gen_idc_series_hashes(sess)
+            gen_idc_study_hashes(sess)
+            gen_idc_patient_hashes(sess)
+            gen_idc_collection_hashes(sess)
+        elif args.incremental:
+            mismatches = gen_incremental_hashes(sess, args.version, update=not args.dry_run, check=args.cross_check,
+                                                seed=args.seed_dirty)
+            if args.cross_check and mismatches:
+                errlogger.error('%s SQL hashes differ from Python hashes', mismatches)
+                if not args.dry_run:
+                    sess.rollback()
+                    return
+        else:
+            collection_uuid = None
+            if args.collection_id:
+                collection_uuid = sess.execute(text("""
+                    SELECT c.uuid
+                    FROM version_collection v_c
+                    JOIN collection c
+                    ON v_c.collection_uuid = c.uuid
+                    WHERE v_c.version = :version AND c.collection_id = :collection_id"""),
+                    {'version': args.version, 'collection_id': args.collection_id}).scalar()
+                if not collection_uuid:
+                    errlogger.error('Collection %s is not in version %s', args.collection_id, args.version)
+                    return
+            mismatches = gen_m2m_hashes(sess, args.version, collection_uuid, update=not args.dry_run, check=args.cross_check)
+            if args.cross_check and mismatches:
+                errlogger.error('%s SQL hashes differ from Python hashes', mismatches)
+                if not args.dry_run:
+                    sess.rollback()
+                    return
+        if not args.dry_run:
+            sess.commit()
+    successlogger.info("Updated hashes")
 
 if __name__ == '__main__':
-    gen_hashes()
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--version', type=int, default=settings.CURRENT_VERSION, help='Version whose hashes are recomputed')
+    parser.add_argument('--collection_id', default='', help='If not empty, only recompute the hashes of this collection of the version')
+    parser.add_argument('--cross_check', action=argparse.BooleanOptionalAction, default=False, help='Also compute hashes in Python and compare')
+    parser.add_argument('--dry_run', action=argparse.BooleanOptionalAction, default=False, help='Compute, but do not store, hashes')
+    parser.add_argument('--incremental', action=argparse.BooleanOptionalAction, default=False, help='Only rehash the dirty objects of the version and their changed ancestors')
+    parser.add_argument('--seed_dirty', action=argparse.BooleanOptionalAction, default=False, help='With --incremental, first mark dirty all the objects added or revised in the version')
+    parser.add_argument('--idc_tables', action=argparse.BooleanOptionalAction, default=False, help='Recompute the hashes of the idc_* tables instead')
+    args = parser.parse_args()
+    gen_hashes(args)
@@ -17,13 +17,14 @@
 import shutil
 import os
 import hashlib
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
 # import logging
 from subprocess import run, STDOUT, DEVNULL
 from google.cloud import storage, bigquery
 from google.api_core.exceptions import Conflict
 
-from sqlalchemy import and_
+from sqlalchemy import and_, insert, text
 
 from python_settings import settings
 
@@ -41,6 +42,26 @@ def is_skipped(skipped_collections, collection_id):
         skipped = (False, False)
     return skipped
 
+# Partition the objects at some level of the hierarchy into new, existing and retired objects in
+# linear time. src_objects is a dictionary (or set) of the IDs of the objects that the sources know
+# about. idc_objects is a dictionary of the objects that IDC has, indexed by ID.
+# If any (non-skipped) source has an object but IDC does not, it is new. An object in IDC will continue
+# to exist if any non-skipped source has the object or has_skipped_source(id, obj) is True. I.E. if
+# an object has a skipped source then, we can't ask the source about it so assume it exists. Any other
+# object in IDC is retired.
+# Returns the sorted IDs of the new objects, and lists of the existing and of the retired IDC objects.
+def classify_objects(src_objects, idc_objects, has_skipped_source):
+    new_objects = sorted(id for id in src_objects if id not in idc_objects)
+    existing_objects = []
+    retired_objects = []
+    for id, obj in idc_objects.items():
+        if id in src_objects or has_skipped_source(id, obj):
+            existing_objects.append(obj)
+        else:
+            retired_objects.append(obj)
+    return new_objects, existing_objects, retired_objects
+
+
 def to_webapp(collection_id):
     return collection_id.lower().replace('-','_').replace(' ','_')
 
@@ -97,16 +118,41 @@ def validate_hashes(args, collection, patient, study, series, hashes):
             return False
     return True
 
+# Validate that instances streamed from TCIA have the hashes listed in the series' md5hashes.csv
+def validate_streamed_hashes(args, collection, patient, study, series, members):
+    for file_name, member in members.items():
+        if member['hash'] != member['expected_hash']:
+            errlogger.error("      p%s: Invalid hash for %s/%s/%s/%s/%s", args.pid,
+            collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid,\
+            file_name)
+            return False
+    return True
+
+# One storage client per process, shared by all uploads in that process
+_storage_clients = {}
+def get_storage_client():
+    pid = os.getpid()
+    if not pid in _storage_clients:
+        _storage_clients[pid] = storage.Client()
+    return _storage_clients[pid]
+
+
+# GCS accepts at most 100 calls in a batch request
+DELETE_BATCH_SIZE = 100
 # Remove any instances in a series from a prestaging bucket.
 # Executed when some problem was detected after copy series
 # files to a bucket.
 def rollback_copy_to_prestaging_bucket(client, args, series):
     bucket = client.bucket(args.prestaging_tcia_bucket)
-    for instance in series.instances:
+    blob_names = [f'{series.uuid}/{instance.uuid}.dcm' for instance in series.instances]
+    for i in range(0, len(blob_names), DELETE_BATCH_SIZE):
         try:
-            results = bucket.blob(f'{series.uuid}/{instance.uuid}.dcm').delete()
+            # Some blobs may not have been uploaded, so don't fail on NotFound
+            with client.batch(raise_exception=False):
+                for blob_name in blob_names[i:i+DELETE_BATCH_SIZE]:
+                    bucket.delete_blob(blob_name)
         except:
-            errlogger.error('p%s: Failed to delete blob %s/%s.dcm during validation rollback',args.pid, series.uuid, instance.uuid)
+            errlogger.error('p%s: Failed to delete blobs of series %s during rollback',args.pid, series.uuid)
             raise
 
 
@@ -149,6 +195,32 @@ def copy_disk_to_prestaging_bucket(args, series):
         raise RuntimeError("p%s: Copy to prestage bucketfailed for series %s", args.pid, series.series_instance_uid) from exc
 
 
+UPLOAD_THREADS = 16
+# Upload the series instances downloaded from TCIA/NBIA from disk to the prestaging bucket.
+# Each upload includes the instance's locally computed MD5, so GCS rejects any upload
+# whose content does not match. The size is verified from the upload response, so no
+# further validation pass is needed.
+def upload_disk_to_prestaging_bucket(args, series, threads=UPLOAD_THREADS):
+    client = get_storage_client()
+    bucket = client.bucket(args.prestaging_tcia_bucket)
+
+    def upload_instance(instance):
+        blob = bucket.blob(f'{series.uuid}/{instance.uuid}.dcm')
+        blob.md5_hash = b64encode(bytes.fromhex(instance.hash)).decode()
+        blob.upload_from_filename(f'{args.dicom_dir}/{series.uuid}/{instance.uuid}.dcm', content_type='application/dicom')
+        if blob.size != instance.size:
+            raise RuntimeError(f'Size mismatch for {blob.name}: {blob.size} != {instance.size}')
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # list() so that any exception in an upload is raised here
+            list(executor.map(upload_instance, series.instances))
+    except Exception as exc:
+        errlogger.error("\tp%s: Upload to prestage bucket failed for series %s: %s", args.pid, series.series_instance_uid, exc)
+        rollback_copy_to_prestaging_bucket(client, args, series)
+        raise RuntimeError("p%s: Upload to prestage bucket failed for series %s", args.pid, series.series_instance_uid) from exc
+
+
 def delete_bucket(bucket):
     try:
         src = "gs://{}/**".format(bucket)
@@ -184,14 +256,13 @@ def create_prestaging_bucket(args, bucket):
 def copy_disk_to_gcs(args, collection, patient, study, series):
     # storage_client = storage.Client(project=settings.DEV_PROJECT)
 
-    # Delete the zip file before we copy to GCS so that it is not copied
-    os.remove("{}/{}.zip".format(args.dicom_dir, series.uuid))
-
-    # Copy the instances to the staging bucket
-    copy_disk_to_prestaging_bucket(args, series)
+    # Delete the zip file, if any, before we copy to GCS so that it is not copied.
+    # Series that are streamed from TCIA are not written to a zip.
+    if os.path.exists("{}/{}.zip".format(args.dicom_dir, series.uuid)):
+        os.remove("{}/{}.zip".format(args.dicom_dir, series.uuid))
 
-    # Ensure that they were copied correctly
-    validate_series_in_gcs(args, collection, patient, study, series)
+    # Upload the instances to the staging bucket. GCS verifies each instance's MD5 as it is written.
+    upload_disk_to_prestaging_bucket(args, series)
 
     # Delete the series from disk
     shutil.rmtree("{}/{}".format(args.dicom_dir, series.uuid), ignore_errors=True)
@@ -263,6 +334,50 @@ def accum_sources(parent, children):
     return sources
 
 
+# Add the new children of a parent that were created during expansion. Normally they are
+# appended to the parent's relationship and written by the unit of work at the next flush.
+# With args.bulk_expand, the children and the association table rows that link them to the
+# parent are instead written with one executemany per table. children must be new, unsessioned
+# objects, built in the same way so that all have the same set of columns.
+def add_children(sess, args, parent, relationship, children):
+    if not children:
+        return
+    mark_dirty(sess, [parent] + children)
+    if not args.bulk_expand:
+        for child in children:
+            getattr(parent, relationship).append(child)
+        return
+    prop = getattr(type(parent), relationship).property
+    columns = set(column.key for column in prop.mapper.column_attrs)
+    rows = [{key: value for key, value in child.__dict__.items() if key in columns} for child in children]
+    # The association table's column that references the parent, and the one that references the child
+    parent_column = prop.synchronize_pairs[0][1].name
+    child_column = prop.secondary_synchronize_pairs[0][1].name
+    # The parent may itself be pending
+    sess.flush()
+    sess.execute(insert(prop.mapper.local_table), rows)
+    sess.execute(insert(prop.secondary),
+                 [{parent_column: parent.uuid, child_column: row['uuid']} for row in rows])
+    # Reload the relationship on next access, so that it includes the new children
+    sess.expire(parent, [relationship])
+
+
+# Record in merkle_dirty that objects of the hierarchy were touched in the current version, so that the
+# next incremental hash pass (m2m_gen_hashes_sql.py --incremental) rehashes them. Instances are rehashed
+# with their series, so they are not recorded.
+def mark_dirty(sess, objects, version=None):
+    ids = {}
+    for obj in objects:
+        if obj.__tablename__ != 'instance':
+            ids.setdefault(obj.__tablename__, []).append(str(obj.version if obj.__tablename__ == 'version' else obj.uuid))
+    for table, table_ids in ids.items():
+        sess.execute(text("""
+            INSERT INTO merkle_dirty (version, table_name, id)
+            SELECT :version, :table_name, unnest(CAST(:ids AS VARCHAR[]))
+            ON CONFLICT DO NOTHING"""),
+            {'version': version or settings.CURRENT_VERSION, 'table_name': table, 'ids': table_ids})
+
+
 # Generate a list of skipped collections. We always skip collections that don't have 'Public' access.
 # The list is specific to a source.
 def list_skips(sess, skipped_collections):
@@ -19,8 +19,8 @@ from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
 from idc.models import instance_source, Version, Collection
-from ingestion.utilities.utils import accum_sources, is_skipped
-from ingestion.collection import clone_collection, build_collection, retire_collection
+from ingestion.utilities.utils import accum_sources, classify_objects, is_skipped, mark_dirty
+from ingestion.collection import clone_collection, build_collection, build_collections_pooled, retire_collection
 from egestion.egest import egest_version
 
 from python_settings import settings
@@ -81,17 +81,10 @@ def expand_version(sess, args, all_sources, version):
             progresslogger.info(f'p%s: Excluding collection {idc_objects[idc_object].collection_id}. Skipped in all sources.')
             idc_objects.pop(idc_object)
 
-    # Collections that are not previously known about by any source.
-    new_objects = sorted( [id for id in collections \
-                           if id not in idc_objects])
-    # An object in IDC will continue to exist if any non-skipped source has the object or IDC's object has a
-    # skipped source. I.E. if an object has a skipped source then, we can't ask the source about it so assume
-    # it exists.
-    existing_objects = [obj for id, obj in idc_objects.items() if \
-        id in collections or any([a and b for a, b in zip(obj.sources, is_skipped(args.skipped_collections, id))])]
-    # Collections that are no longer known about by any source
-    retired_objects = [obj for id, obj in idc_objects.items() \
-       if not obj in existing_objects]
+    # Partition into collections that are not previously known about by any source, that continue
+    # to exist, and that are no longer known about by any source
+    new_objects, existing_objects, retired_objects = classify_objects(collections, idc_objects,
+        lambda id, obj: any([a and b for a, b in zip(obj.sources, is_skipped(args.skipped_collections, id))]))
 
     for idc_collection_id in sorted(new_objects,
             key=lambda idc_collection_id: collections[idc_collection_id]['collection_id']):
@@ -116,6 +109,7 @@ def expand_version(sess, args, all_sources, version):
         new_collection.expanded = False
 
         version.collections.append(new_collection)
+        mark_dirty(sess, [version, new_collection])
         progresslogger.info('p%s: Collection %s is new', args.pid, new_collection.collection_id)
 
     for collection in existing_objects:
@@ -153,6 +147,7 @@ def expand_version(sess, args, all_sources, version):
             rev_collection.revised = revised
             rev_collection.rev_idc_version = settings.CURRENT_VERSION
             version.collections.append(rev_collection)
+            mark_dirty(sess, [version, rev_collection])
             progresslogger.info('p%s: Collection %s is revised',  args.pid, rev_collection.collection_id)
 
             # Mark the now previous version of this object as having been replaced
@@ -174,6 +169,7 @@ def expand_version(sess, args, all_sources, version):
             collection.expanded = True
 
             version.collections.append(rev_collection)
+            mark_dirty(sess, [version, rev_collection])
             progresslogger.info('p%s: Collection %s is renamed',  args.pid, rev_collection.collection_id)
 
             # Mark the now previous version of this object as having been replaced
@@ -196,6 +192,7 @@ def expand_version(sess, args, all_sources, version):
         # Mark the now previous version of this object as having been retired
         retire_collection(args, collection)
         version.collections.remove(collection)
+        mark_dirty(sess, [version])
         progresslogger.info(f'p{args.pid}: Collection {collection.collection_id} is retired')
 
     progresslogger.info(f'\n\nVersion expansion summary')
@@ -231,14 +228,25 @@ def build_version(sess, args, all_sources, version):
         expand_version(sess, args, all_sources, version)
     idc_collections = sorted(version.collections, key=lambda collection: collection.collection_id)
     progresslogger.info("p%s: Expanded Version %s; %s collections", args.pid, settings.CURRENT_VERSION, len(idc_collections))
-    for collection in idc_collections:
-        collection_index = f'{idc_collections.index(collection) + 1} of {len(idc_collections)}'
-        if not collection.done:
-            progresslogger.info(f'Building collection {collection.collection_id}')
-            build_collection(sess, args, all_sources, collection_index, version, collection)
-            pass
-        else:
-            progresslogger.info("p%s: Collection %s, %s, previously built", args.pid, collection.collection_id, collection_index)
+    if args.num_processes and args.cross_collection_pool:
+        # Build all collections on one pool of worker processes
+        collections = []
+        for index, collection in enumerate(idc_collections):
+            collection_index = f'{index + 1} of {len(idc_collections)}'
+            if not collection.done:
+                collections.append((collection_index, collection))
+            else:
+                progresslogger.info("p%s: Collection %s, %s, previously built", args.pid, collection.collection_id, collection_index)
+        build_collections_pooled(sess, args, all_sources, version, collections)
+    else:
+        for index, collection in enumerate(idc_collections):
+            collection_index = f'{index + 1} of {len(idc_collections)}'
+            if not collection.done:
+                progresslogger.info(f'Building collection {collection.collection_id}')
+                build_collection(sess, args, all_sources, collection_index, version, collection)
+                pass
+            else:
+                progresslogger.info("p%s: Collection %s, %s, previously built", args.pid, collection.collection_id, collection_index)
 
     # Check if we are really done
     if all([collection.done for collection in idc_collections]):
@@ -0,0 +1,265 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Streaming load of a BQ table into a PostgreSQL table.
+# The table is read with the BigQuery Storage Read API as Arrow record batches, on several
+# read streams in parallel, one worker process per stream at a time. Each worker formats the
+# record batches in PostgreSQL's COPY text format and loads them with COPY FROM STDIN, in chunks
+# of at most chunk_bytes, so memory use does not depend on the size of the table.
+# The data is loaded into <table>_staging, which replaces <table> only once every stream has
+# loaded and the row count matches, so a failed load leaves <table> as it was.
+# BQ types map to the nearest PostgreSQL type. A STRUCT (RECORD) column becomes JSONB, as does a
+# repeated STRUCT, which becomes a JSONB array. Other repeated columns become PostgreSQL arrays.
+
+import io
+import json
+import math
+import time
+from base64 import b64encode
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from multiprocessing import Process, Queue
+import psycopg2
+from psycopg2 import sql
+from google.cloud import bigquery, bigquery_storage
+from google.cloud.bigquery_storage import types
+from utilities.logging_config import successlogger, progresslogger, errlogger
+
+# COPY is issued once this much formatted data has been buffered
+CHUNK_BYTES = 64 * 1024 * 1024
+
+PG_TYPES = {
+    'STRING': 'TEXT',
+    'BYTES': 'BYTEA',
+    'INTEGER': 'BIGINT',
+    'INT64': 'BIGINT',
+    'FLOAT': 'DOUBLE PRECISION',
+    'FLOAT64': 'DOUBLE PRECISION',
+    'NUMERIC': 'NUMERIC',
+    'BIGNUMERIC': 'NUMERIC',
+    'BOOLEAN': 'BOOLEAN',
+    'BOOL': 'BOOLEAN',
+    'TIMESTAMP': 'TIMESTAMP WITH TIME ZONE',
+    'DATETIME': 'TIMESTAMP WITHOUT TIME ZONE',
+    'DATE': 'DATE',
+    'TIME': 'TIME',
+    'JSON': 'JSONB',
+    'GEOGRAPHY': 'TEXT',
+    'RECORD': 'JSONB',
+    'STRUCT': 'JSONB',
+}
+
+
+def pg_type(field):
+    if field.field_type in ('RECORD', 'STRUCT'):
+        return 'JSONB'
+    base = PG_TYPES.get(field.field_type, 'TEXT')
+    return f'{base}[]' if field.mode == 'REPEATED' else base
+
+
+def pg_column(field):
+    column = sql.SQL('{} {}').format(sql.Identifier(field.name), sql.SQL(pg_type(field)))
+    if field.mode == 'REQUIRED':
+        column = sql.SQL('{} NOT NULL').format(column)
+    return column
+
+
+# The PostgreSQL text of a scalar value, before escaping for COPY
+def scalar_text(value):
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    return str(value)
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return b64encode(value).decode()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def json_text(value):
+    return json.dumps(value, default=json_default)
+
+
+def array_text(values):
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append('NULL')
+        else:
+            elements.append('"' + scalar_text(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '{' + ','.join(elements) + '}'
+
+
+def field_formatter(field):
+    if field.field_type in ('RECORD', 'STRUCT'):
+        return json_text
+    if field.mode == 'REPEATED':
+        return array_text
+    return scalar_text
+
+
+def copy_escape(text):
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# Format an Arrow record batch as lines of COPY text format
+def format_batch(batch, formatters):
+    columns = [column.to_pylist() for column in batch.columns]
+    formatters = [formatters[name] for name in batch.schema.names]
+    lines = []
+    for row in zip(*columns):
+        lines.append('\t'.join('\\N' if value is None else copy_escape(formatter(value))
+                               for value, formatter in zip(row, formatters)))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def copy_chunk(cursor, buffer, copy_sql):
+    buffer.seek(0)
+    cursor.copy_expert(copy_sql, buffer)
+    rows = cursor.rowcount
+    buffer.seek(0)
+    buffer.truncate()
+    return rows
+
+
+def load_stream(conn, read_client, stream_name, staging_table, formatters, chunk_bytes):
+    rows = 0
+    copy_sql = None
+    buffer = io.StringIO()
+    with conn.cursor() as cursor:
+        for page in read_client.read_rows(stream_name).rows().pages:
+            batch = page.to_arrow()
+            if copy_sql is None:
+                copy_sql = sql.SQL('COPY {} ({}) FROM STDIN').format(
+                    sql.Identifier(staging_table),
+                    sql.SQL(', ').join(sql.Identifier(name) for name in batch.schema.names)).as_string(conn)
+            buffer.write(format_batch(batch, formatters))
+            if buffer.tell() >= chunk_bytes:
+                rows += copy_chunk(cursor, buffer, copy_sql)
+        if buffer.tell():
+            rows += copy_chunk(cursor, buffer, copy_sql)
+    conn.commit()
+    return rows
+
+
+def load_worker(input, output, connect_args, staging_table, fields, chunk_bytes):
+    read_client = bigquery_storage.BigQueryReadClient()
+    conn = psycopg2.connect(**connect_args)
+    formatters = {field.name: field_formatter(field) for field in fields}
+    for stream_name in iter(input.get, 'STOP'):
+        try:
+            output.put((stream_name, load_stream(conn, read_client, stream_name, staging_table, formatters, chunk_bytes), None))
+        except Exception as exc:
+            conn.rollback()
+            output.put((stream_name, 0, str(exc)))
+    conn.close()
+
+
+def load_bq_table_to_psql(project, dataset, table_id, dst_table, connect_args, processes=8,
+                          columns=None, chunk_bytes=CHUNK_BYTES):
+    """Load the BQ table project.dataset.table_id, or just the list of columns if given, into the PostgreSQL
+    table dst_table of the DB given by connect_args, the keyword args of psycopg2.connect().
+    dst_table is replaced. Returns the number of rows loaded."""
+    begin = time.time()
+    table = bigquery.Client(project=project).get_table(f'{project}.{dataset}.{table_id}')
+    if columns:
+        columns = set(columns)
+        unknown = columns - set(field.name for field in table.schema)
+        if unknown:
+            raise ValueError(f'Columns {sorted(unknown)} are not in {table_id}')
+    fields = [field for field in table.schema if not columns or field.name in columns]
+    staging_table = f'{dst_table}_staging'
+
+    read_client = bigquery_storage.BigQueryReadClient()
+    requested_session = types.ReadSession(
+        table=f'projects/{project}/datasets/{dataset}/tables/{table_id}',
+        data_format=types.DataFormat.ARROW,
+        read_options=types.ReadSession.TableReadOptions(selected_fields=[field.name for field in fields]))
+    session = read_client.create_read_session(parent=f'projects/{project}', read_session=requested_session,
+                                              max_stream_count=processes)
+
+    conn = psycopg2.connect(**connect_args)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(staging_table)))
+            cursor.execute(sql.SQL('CREATE TABLE {} ({})').format(
+                sql.Identifier(staging_table), sql.SQL(', ').join(pg_column(field) for field in fields)))
+        conn.commit()
+
+        task_queue = Queue()
+        done_queue = Queue()
+        workers = []
+        for process in range(min(processes, len(session.streams))):
+            workers.append(Process(target=load_worker, args=(task_queue, done_queue, connect_args,
+                                                              staging_table, fields, chunk_bytes)))
+            workers[-1].start()
+        for stream in session.streams:
+            task_queue.put(stream.name)
+        for process in workers:
+            task_queue.put('STOP')
+
+        rows = 0
+        errors = []
+        for stream in session.streams:
+            stream_name, stream_rows, error = done_queue.get()
+            rows += stream_rows
+            if error:
+                errlogger.error(f'Load of {table_id} stream {stream_name} failed: {error}')
+                errors.append(stream_name)
+            else:
+                progresslogger.info(f'Loaded {stream_rows} rows of {table_id} from stream {stream_name}')
+        for process in workers:
+            process.join()
+
+        if errors or rows != table.num_rows:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(staging_table)))
+            conn.commit()
+            raise RuntimeError(f'Load of {table_id} failed: {len(errors)} streams failed, '
+                               f'{rows} of {table.num_rows} rows loaded')
+
+        # Swap the staging table in
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(dst_table)))
+            cursor.execute(sql.SQL('ALTER TABLE {} RENAME TO {}').format(
+                sql.Identifier(staging_table), sql.Identifier(dst_table)))
+        conn.commit()
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('ANALYZE {}').format(sql.Identifier(dst_table)))
+        conn.commit()
+    finally:
+        conn.close()
+
+    elapsed = time.time() - begin
+    successlogger.info(f'Loaded {rows} rows of {project}.{dataset}.{table_id} into {dst_table} in '
+                       f'{round(elapsed, 1)}s, {round(rows / elapsed) if elapsed else 0} rows/s, '
+                       f'{len(session.streams)} streams')
+    return rows
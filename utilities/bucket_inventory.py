@@ -0,0 +1,198 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A local snapshot of the listing of a bucket, so that validators and copiers can query the blobs
+# of a bucket without paging through the GCS list API each time.
+# The snapshot is a SQLite DB of (name, size, md5, crc32c, generation, updated) per blob, partitioned
+# by the first prefix_length hex digits of the blob name. IDC blob names begin with a UUID, so every
+# blob falls in one of the 16^prefix_length partitions.
+# GCS has no per-prefix modification time, so a refresh lists each partition in full. Each partition
+# has a watermark, the md5 of the names and generations of its blobs, and the snapshot of a partition
+# is only rewritten if its watermark has changed. To not list the bucket on every run, pass a max_age
+# to refresh(): partitions refreshed more recently than that are used as they are.
+
+import os
+import time
+import hashlib
+import sqlite3
+from itertools import islice
+from multiprocessing import Process, Queue
+from google.cloud import storage
+from utilities.logging_config import progresslogger, errlogger
+
+# The GCS maximum
+PAGE_SIZE = 1000
+INSERT_BATCH = 10000
+BUSY_TIMEOUT = 600
+FIELDS = 'items(name,size,md5Hash,crc32c,generation,updated),nextPageToken'
+
+
+def list_partition(client, bucket_name, partition):
+    return [(partition, blob.name, blob.size, blob.md5_hash, blob.crc32c, blob.generation,
+             blob.updated.isoformat() if blob.updated else None)
+            for blob in client.list_blobs(bucket_name, prefix=partition, page_size=PAGE_SIZE, fields=FIELDS)]
+
+
+# The md5 of the names and generations of the listed blobs of a partition
+def partition_watermark(rows):
+    md5 = hashlib.md5()
+    for row in rows:
+        md5.update(f'{row[1]}:{row[5]}\n'.encode())
+    return md5.hexdigest()
+
+
+def refresh_worker(input, output, bucket_name):
+    client = storage.Client()
+    for partition, stored_watermark in iter(input.get, 'STOP'):
+        try:
+            rows = list_partition(client, bucket_name, partition)
+            watermark = partition_watermark(rows)
+            # Don't send back the rows of a partition that hasn't changed
+            output.put((partition, watermark, len(rows), None if watermark == stored_watermark else rows))
+        except Exception as exc:
+            errlogger.error(f'Inventory of {bucket_name}/{partition} failed: {exc}')
+            output.put((partition, None, 0, None))
+
+
+class Bucket_Inventory:
+    def __init__(self, path, bucket_name, prefix_length=2):
+        self.path = path
+        self.bucket_name = bucket_name
+        self.prefix_length = prefix_length
+        self._connections = {}
+        with self._conn() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    partition TEXT NOT NULL,
+                    name TEXT PRIMARY KEY,
+                    size INTEGER,
+                    md5 TEXT,
+                    crc32c TEXT,
+                    generation INTEGER,
+                    updated TEXT
+                )""")
+            conn.execute('CREATE INDEX IF NOT EXISTS blobs_partition ON blobs (partition)')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS partitions (
+                    partition TEXT PRIMARY KEY,
+                    watermark TEXT,
+                    blobs INTEGER,
+                    refreshed REAL
+                )""")
+
+    def _conn(self):
+        # SQLite connections are not shared across processes
+        pid = os.getpid()
+        if pid not in self._connections:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections[pid] = conn
+        return self._connections[pid]
+
+    def partitions(self):
+        return [hex(i)[2:].zfill(self.prefix_length) for i in range(pow(16, self.prefix_length))]
+
+    # Refresh the snapshot. Only partitions that were last refreshed more than max_age seconds ago
+    # are listed, all of them if max_age is None, and only those whose watermark changed are rewritten.
+    def refresh(self, num_processes=16, max_age=None):
+        begin = time.time()
+        conn = self._conn()
+        stored = {partition: (watermark, refreshed) for partition, watermark, refreshed in
+                  conn.execute('SELECT partition, watermark, refreshed FROM partitions')}
+        partitions = [partition for partition in self.partitions() if max_age is None or
+                      partition not in stored or begin - stored[partition][1] > max_age]
+        if not partitions:
+            return 0
+
+        task_queue = Queue()
+        done_queue = Queue()
+        processes = []
+        for process in range(min(num_processes, len(partitions))):
+            processes.append(Process(target=refresh_worker, args=(task_queue, done_queue, self.bucket_name)))
+            processes[-1].start()
+        for partition in partitions:
+            task_queue.put((partition, stored.get(partition, (None, None))[0]))
+        for process in processes:
+            task_queue.put('STOP')
+
+        changed = 0
+        failed = 0
+        for _ in partitions:
+            partition, watermark, blobs, rows = done_queue.get()
+            if watermark is None:
+                failed += 1
+                continue
+            with conn:
+                if rows is not None:
+                    changed += 1
+                    conn.execute('DELETE FROM blobs WHERE partition = ?', (partition,))
+                    rows = iter(rows)
+                    while batch := list(islice(rows, INSERT_BATCH)):
+                        conn.executemany('INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                conn.execute('INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?)',
+                             (partition, watermark, blobs, time.time()))
+        for process in processes:
+            process.join()
+        progresslogger.info(f'Inventory of {self.bucket_name}: checked {len(partitions)} partitions, '
+                            f'rewrote {changed}, {failed} failed, in {round(time.time() - begin, 1)}s')
+        return failed
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM blobs').fetchone()[0]
+
+    # Yield the blob names, in order, that begin with prefix
+    def names(self, prefix=''):
+        for row in self._conn().execute('SELECT name FROM blobs WHERE name >= ? AND name < ? ORDER BY name',
+                                        (prefix, prefix + '\uffff')):
+            yield row[0]
+
+    # Yield (name, size, md5, crc32c, generation, updated) of the blobs, in order, that begin with prefix
+    def blobs(self, prefix=''):
+        yield from self._conn().execute(
+            'SELECT name, size, md5, crc32c, generation, updated FROM blobs WHERE name >= ? AND name < ? ORDER BY name',
+            (prefix, prefix + '\uffff'))
+
+    # Yield the distinct first components of the blob names, e.g. the series UUIDs of a bucket
+    # whose blobs are named <series_uuid>/<instance_uuid>.dcm
+    def folders(self):
+        for row in self._conn().execute(
+                "SELECT DISTINCT substr(name, 1, instr(name, '/') - 1) FROM blobs WHERE instr(name, '/') > 0 ORDER BY 1"):
+            yield row[0]
+
+    # Compare the snapshot with an iterable of expected names, e.g. of blobs or of folders.
+    # Returns (unexpected, unfound): sorted lists of the names only in the snapshot, and
+    # of the expected names not in the snapshot.
+    def difference(self, expected, folders=False):
+        conn = self._conn()
+        conn.execute('DROP TABLE IF EXISTS temp.expected')
+        conn.execute('CREATE TEMP TABLE expected (name TEXT PRIMARY KEY)')
+        expected = iter(expected)
+        while batch := list(islice(expected, INSERT_BATCH)):
+            conn.executemany('INSERT OR IGNORE INTO temp.expected VALUES (?)', ((name,) for name in batch))
+        found = "SELECT DISTINCT substr(name, 1, instr(name, '/') - 1) AS name FROM blobs WHERE instr(name, '/') > 0" \
+            if folders else 'SELECT name FROM blobs'
+        unexpected = [row[0] for row in conn.execute(f'SELECT name FROM ({found}) EXCEPT SELECT name FROM temp.expected ORDER BY 1')]
+        unfound = [row[0] for row in conn.execute(f'SELECT name FROM temp.expected EXCEPT SELECT name FROM ({found}) ORDER BY 1')]
+        conn.execute('DROP TABLE temp.expected')
+        conn.commit()
+        return unexpected, unfound
+
+
+# Open the inventory of a bucket, kept in <log_dir>/inventory/<bucket_name>.db
+def get_bucket_inventory(bucket_name, log_dir, prefix_length=2):
+    os.makedirs(f'{log_dir}/inventory', exist_ok=True)
+    return Bucket_Inventory(f'{log_dir}/inventory/{bucket_name}.db', bucket_name, prefix_length)
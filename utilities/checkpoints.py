@@ -0,0 +1,137 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A checkpoint store records which items of a resumable job are done, in place of reading a
+# success.log into a set on every restart. Items are kept in an indexed SQLite table in WAL mode,
+# keyed by (job, item), so a restart opens the store instead of loading it, and each membership
+# check is an index lookup. Several processes can write the same store concurrently; each process
+# opens its own connection. Items are committed in batches. An item is only reported as done once
+# its batch is committed, so after a crash at most the last uncommitted batch is redone.
+
+import os
+import time
+import sqlite3
+from itertools import islice
+
+# Items committed per transaction by mark_done()
+FLUSH_ITEMS = 1000
+# Pending items are also committed if the oldest is older than this many seconds
+FLUSH_SECONDS = 10
+# Items per query of filter_undone(). Below SQLite's default limit on host parameters
+QUERY_BATCH = 900
+BUSY_TIMEOUT = 600
+
+
+class Checkpoint_Store:
+    def __init__(self, path, job):
+        self.path = path
+        self.job = job
+        # Connections, and pending items, are per process
+        self._connections = {}
+        self._pending = {}
+        self._pending_since = {}
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                job TEXT NOT NULL,
+                item TEXT NOT NULL,
+                PRIMARY KEY (job, item)
+            ) WITHOUT ROWID""")
+        conn.commit()
+
+    def _conn(self):
+        pid = os.getpid()
+        if pid not in self._connections:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections[pid] = conn
+            self._pending[pid] = []
+            self._pending_since[pid] = time.time()
+        return self._connections[pid]
+
+    def __contains__(self, item):
+        return self.is_done(item)
+
+    def is_done(self, item):
+        return self._conn().execute('SELECT 1 FROM checkpoints WHERE job = ? AND item = ?',
+                                    (self.job, item)).fetchone() is not None
+
+    def mark_done(self, item):
+        self._conn()
+        pending = self._pending[os.getpid()]
+        if not pending:
+            self._pending_since[os.getpid()] = time.time()
+        pending.append(item)
+        if len(pending) >= FLUSH_ITEMS or time.time() - self._pending_since[os.getpid()] > FLUSH_SECONDS:
+            self.flush()
+
+    def mark_done_many(self, items):
+        conn = self._conn()
+        items = iter(items)
+        while batch := list(islice(items, FLUSH_ITEMS)):
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO checkpoints (job, item) VALUES (?, ?)',
+                                 ((self.job, item) for item in batch))
+
+    # Commit the items marked done by this process
+    def flush(self):
+        self._conn()
+        pending = self._pending[os.getpid()]
+        if pending:
+            self.mark_done_many(pending)
+            pending.clear()
+
+    def close(self):
+        self.flush()
+        self._connections.pop(os.getpid()).close()
+
+    # Yield the items of an iterable that are not done, in order
+    def filter_undone(self, items):
+        conn = self._conn()
+        items = iter(items)
+        while batch := list(islice(items, QUERY_BATCH)):
+            done = set(row[0] for row in conn.execute(
+                f'SELECT item FROM checkpoints WHERE job = ? AND item IN ({",".join("?" * len(batch))})',
+                [self.job] + batch))
+            yield from (item for item in batch if item not in done)
+
+    def count(self):
+        return self._conn().execute('SELECT COUNT(*) FROM checkpoints WHERE job = ?', (self.job,)).fetchone()[0]
+
+    def items(self):
+        for row in self._conn().execute('SELECT item FROM checkpoints WHERE job = ? ORDER BY item', (self.job,)):
+            yield row[0]
+
+    # Load the done items of a job from a log file of one item per line, e.g. a success.log
+    # written before the job used a checkpoint store. prefix is stripped from each line.
+    def import_log(self, file_name, prefix=''):
+        try:
+            with open(file_name) as f:
+                self.mark_done_many(line.rstrip('\n')[len(prefix):] for line in f
+                                    if line.strip() and line.startswith(prefix))
+        except FileNotFoundError:
+            pass
+        return self.count()
+
+
+# Open the checkpoint store of a job in log_dir. If the job has no checkpoints yet,
+# they are imported from its legacy log file, if any.
+def get_checkpoint_store(job, log_dir, legacy_log=None):
+    store = Checkpoint_Store(f'{log_dir}/checkpoints.db', job)
+    if legacy_log and store.count() == 0:
+        store.import_log(legacy_log)
+    return store
@@ -0,0 +1,408 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Bulk copy and delete of blobs.
+# run_bulk_ops() takes a stream of ops, each a copy (rewrite) of a blob to another bucket/name or
+# a delete of a blob, and runs them on a set of worker processes. Each process has many requests
+# in flight on a pool of threads. The number of requests in flight in a process is adapted AIMD
+# style: it grows by about one for each round of successful requests, and is halved when GCS
+# throttles a request (429 or 503). Deletes from the same bucket are sent as batch requests of
+# up to 100 deletes, and the result of each delete in a batch is checked separately, so that only
+# the deletes that failed are retried. Ops whose key (the name of the destination of a copy, or
+# of the deleted blob) is done in an optional Checkpoint_Store are skipped, and ops are marked
+# done as they complete. Counts, throughput and latency are reported per kind of op.
+
+import time
+import random
+import threading
+from collections import namedtuple
+from itertools import islice
+from queue import Queue as Result_Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
+from google.cloud import storage
+from google.api_core.exceptions import TooManyRequests, ServiceUnavailable, NotFound
+from utilities.logging_config import successlogger, progresslogger, errlogger
+
+COPY = 'copy'
+DELETE = 'delete'
+# GCS accepts at most 100 calls in a batch request
+DELETE_BATCH_SIZE = 100
+TRIES = 5
+MAX_BACKOFF = 32
+THROTTLED = (TooManyRequests, ServiceUnavailable)
+THROTTLE_STATUSES = (429, 503)
+TRANSIENT_STATUSES = (408, 500, 502, 504)
+# Requests in flight per process
+DEFAULT_CONCURRENCY = 64
+INITIAL_CONCURRENCY = 4
+# Ops per task queued to a process
+DEFAULT_BATCH = 1000
+LOG_SECONDS = 60
+
+Op = namedtuple('Op', ['op', 'src_bucket', 'src_name', 'dst_bucket', 'dst_name'])
+# The outcome of a unit of ops: a copy, or a batch of deletes. latencies are of each request sent.
+Result = namedtuple('Result', ['op', 'done', 'not_found', 'failed', 'latencies', 'bytes', 'throttles'])
+
+
+def copy_op(src_bucket, src_name, dst_bucket, dst_name=None):
+    return Op(COPY, src_bucket, src_name, dst_bucket, dst_name if dst_name else src_name)
+
+
+def delete_op(bucket, name):
+    return Op(DELETE, bucket, name, None, None)
+
+
+# The name under which an op is logged and checkpointed
+def op_key(op):
+    return op.dst_name if op.op == COPY else op.src_name
+
+
+def backoff(attempt):
+    time.sleep(min(MAX_BACKOFF, 2 ** attempt) * random.random())
+
+
+class AIMD_Limiter:
+    def __init__(self, initial, maximum, minimum=1, decrease=0.5, cooldown=1.0):
+        self.limit = float(min(initial, maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.last_decrease = 0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                # The requests in flight when GCS starts throttling tend to be throttled together,
+                # so decrease at most once per cooldown
+                now = time.time()
+                if now - self.last_decrease > self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class Op_Metrics:
+    # Latencies are counted in power of 2 millisecond buckets
+    BUCKETS = 32
+
+    def __init__(self):
+        self.ops = {}
+
+    def _op(self, op):
+        if op not in self.ops:
+            self.ops[op] = dict(done=0, not_found=0, failed=0, throttled=0, requests=0, bytes=0,
+                                seconds=0.0, max_seconds=0.0, histogram=[0] * self.BUCKETS)
+        return self.ops[op]
+
+    def record(self, result):
+        metrics = self._op(result.op)
+        metrics['done'] += len(result.done)
+        metrics['not_found'] += len(result.not_found)
+        metrics['failed'] += len(result.failed)
+        metrics['throttled'] += result.throttles
+        metrics['bytes'] += result.bytes
+        for seconds in result.latencies:
+            metrics['requests'] += 1
+            metrics['seconds'] += seconds
+            metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+            metrics['histogram'][min(self.BUCKETS - 1, int(seconds * 1000).bit_length())] += 1
+
+    def merge(self, other):
+        for op, other_metrics in other.ops.items():
+            metrics = self._op(op)
+            for key, value in other_metrics.items():
+                if key == 'histogram':
+                    metrics[key] = [a + b for a, b in zip(metrics[key], value)]
+                elif key == 'max_seconds':
+                    metrics[key] = max(metrics[key], value)
+                else:
+                    metrics[key] += value
+
+    def failed(self):
+        return sum(metrics['failed'] for metrics in self.ops.values())
+
+    # Upper bound, in ms, of the latency of the given fraction of requests
+    def percentile(self, op, fraction):
+        histogram = self.ops[op]['histogram']
+        target = fraction * sum(histogram)
+        count = 0
+        for bucket, n in enumerate(histogram):
+            count += n
+            if count >= target:
+                return 2 ** bucket
+        return 2 ** (self.BUCKETS - 1)
+
+    def summary(self, elapsed):
+        summaries = []
+        for op, metrics in self.ops.items():
+            completed = metrics['done'] + metrics['not_found']
+            mean = 1000 * metrics['seconds'] / metrics['requests'] if metrics['requests'] else 0
+            summaries.append(
+                f"{op}: {metrics['done']} done, {metrics['not_found']} not found, {metrics['failed']} failed, "
+                f"{metrics['throttled']} throttled; {round(completed / elapsed, 1) if elapsed else 0} ops/s, "
+                f"{round(metrics['bytes'] / elapsed / pow(10, 6), 2) if elapsed else 0} MB/s; "
+                f"latency mean {round(mean)}ms, p50 <{self.percentile(op, 0.5)}ms, "
+                f"p99 <{self.percentile(op, 0.99)}ms, max {round(1000 * metrics['max_seconds'])}ms")
+        return '; '.join(summaries) if summaries else 'no ops'
+
+
+class Bulk_Worker:
+    def __init__(self, pid, concurrency, initial_concurrency, checkpoint=None, log_success=True):
+        self.pid = pid
+        self.checkpoint = checkpoint
+        self.log_success = log_success
+        self.limiter = AIMD_Limiter(initial_concurrency, concurrency)
+        # A unit that is backing off before a retry holds a thread but not a request slot, so there
+        # are more threads than slots, to keep the slots busy while some units are backing off
+        self.executor = ThreadPoolExecutor(max_workers=2 * concurrency)
+        # Bounds the units submitted but not yet run
+        self.pending = threading.BoundedSemaphore(4 * concurrency)
+        # Results are recorded by the thread that submits ops, as checkpoint connections are per thread
+        self.results = Result_Queue()
+        self.outstanding = 0
+        self.metrics = Op_Metrics()
+        self.begin = time.time()
+        self.last_log = self.begin
+        # Clients are per thread. A batch is collected by its client, so a client in the middle
+        # of a batch cannot be used by any other thread.
+        self.local = threading.local()
+
+    def bucket(self, name):
+        if not hasattr(self.local, 'client'):
+            self.local.client = storage.Client()
+            self.local.buckets = {}
+        if name not in self.local.buckets:
+            self.local.buckets[name] = self.local.client.bucket(name)
+        return self.local.buckets[name]
+
+    def run(self, ops):
+        deletes = {}
+        for op in ops:
+            if op.op == DELETE:
+                group = deletes.setdefault(op.src_bucket, [])
+                group.append(op)
+                if len(group) == DELETE_BATCH_SIZE:
+                    self.submit(deletes.pop(op.src_bucket))
+            else:
+                self.submit([op])
+        for group in deletes.values():
+            self.submit(group)
+
+    def submit(self, unit):
+        self.pending.acquire()
+        self.outstanding += 1
+        self.executor.submit(self._run, unit)
+        self.drain()
+
+    def _run(self, unit):
+        try:
+            if unit[0].op == COPY:
+                result = self._copy(unit[0])
+            else:
+                result = self._delete(unit)
+        except Exception as exc:
+            errlogger.error(f'p{self.pid}: {unit[0].op} of {len(unit)} blobs failed: {exc}')
+            result = Result(unit[0].op, [], [], [op_key(op) for op in unit], [], 0, 0)
+        finally:
+            self.pending.release()
+        self.results.put(result)
+
+    def _copy(self, op):
+        key = op_key(op)
+        latencies = []
+        throttles = 0
+        token = None
+        for attempt in range(TRIES):
+            self.limiter.acquire()
+            start = time.time()
+            throttled = False
+            try:
+                src_blob = self.bucket(op.src_bucket).blob(op.src_name)
+                dst_blob = self.bucket(op.dst_bucket).blob(op.dst_name)
+                while True:
+                    token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob, token=token, retry=None)
+                    if not token:
+                        break
+                latencies.append(time.time() - start)
+                return Result(COPY, [key], [], [], latencies, total_bytes, throttles)
+            except NotFound as exc:
+                errlogger.error(f'p{self.pid}: {op.src_bucket}/{op.src_name} copy to {op.dst_bucket} failed: {exc}')
+                return Result(COPY, [], [], [key], latencies, 0, throttles)
+            except THROTTLED as exc:
+                throttled = True
+                throttles += 1
+                error = exc
+            except Exception as exc:
+                error = exc
+            finally:
+                self.limiter.release(throttled)
+            latencies.append(time.time() - start)
+            if attempt < TRIES - 1:
+                backoff(attempt)
+        errlogger.error(f'p{self.pid}: {op.src_bucket}/{op.src_name} copy to {op.dst_bucket} failed: {error}')
+        return Result(COPY, [], [], [key], latencies, 0, throttles)
+
+    # Send deletes from one bucket as a batch request. Returns the HTTP status of each delete, in order.
+    def _delete_batch(self, bucket_name, names):
+        bucket = self.bucket(bucket_name)
+        client = self.local.client
+        batch = client.batch(raise_exception=False)
+        # The batch is finished outside of its context manager, which would discard the
+        # response to each delete
+        client._push_batch(batch)
+        try:
+            for name in names:
+                bucket.delete_blob(name, retry=None)
+        finally:
+            client._pop_batch()
+        return [response.status_code for response in batch.finish(raise_exception=False)]
+
+    def _delete(self, ops):
+        bucket_name = ops[0].src_bucket
+        done = []
+        not_found = []
+        failed = []
+        latencies = []
+        throttles = 0
+        for attempt in range(TRIES):
+            self.limiter.acquire()
+            start = time.time()
+            statuses = None
+            try:
+                statuses = self._delete_batch(bucket_name, [op.src_name for op in ops])
+                throttled = any(status in THROTTLE_STATUSES for status in statuses)
+            except THROTTLED as exc:
+                throttled = True
+                error = exc
+            except Exception as exc:
+                throttled = False
+                error = exc
+            finally:
+                latencies.append(time.time() - start)
+            self.limiter.release(throttled)
+            throttles += throttled
+
+            if statuses is not None:
+                retries = []
+                for op, status in zip(ops, statuses):
+                    if 200 <= status < 300:
+                        done.append(op.src_name)
+                    elif status == 404:
+                        not_found.append(op.src_name)
+                    elif status in THROTTLE_STATUSES or status in TRANSIENT_STATUSES:
+                        retries.append(op)
+                    else:
+                        errlogger.error(f'p{self.pid}: {bucket_name}/{op.src_name} delete failed: HTTP {status}')
+                        failed.append(op.src_name)
+                ops = retries
+                if not ops:
+                    break
+                error = f'HTTP {set(statuses)}'
+            if attempt < TRIES - 1:
+                backoff(attempt)
+        else:
+            for op in ops:
+                errlogger.error(f'p{self.pid}: {bucket_name}/{op.src_name} delete failed: {error}')
+                failed.append(op.src_name)
+        return Result(DELETE, done, not_found, failed, latencies, 0, throttles)
+
+    def _record(self, result):
+        self.outstanding -= 1
+        self.metrics.record(result)
+        for key in result.done + result.not_found:
+            if self.log_success:
+                successlogger.info(key)
+            if self.checkpoint:
+                self.checkpoint.mark_done(key)
+
+    def drain(self):
+        while True:
+            try:
+                self._record(self.results.get_nowait())
+            except Empty:
+                break
+        if time.time() - self.last_log > LOG_SECONDS:
+            self.last_log = time.time()
+            progresslogger.info(f'p{self.pid}: {self.metrics.summary(self.last_log - self.begin)}; '
+                                f'concurrency {round(self.limiter.limit, 1)}')
+
+    def close(self):
+        while self.outstanding:
+            self._record(self.results.get())
+        self.executor.shutdown()
+        if self.checkpoint:
+            self.checkpoint.close()
+        return self.metrics
+
+
+def bulk_worker(input, output, pid, concurrency, initial_concurrency, checkpoint, log_success):
+    worker = Bulk_Worker(pid, concurrency, initial_concurrency, checkpoint, log_success)
+    for ops in iter(input.get, 'STOP'):
+        worker.run(ops)
+    output.put(worker.close())
+
+
+def run_bulk_ops(ops, processes=8, concurrency=DEFAULT_CONCURRENCY, batch=DEFAULT_BATCH, checkpoint=None,
+                 log_success=True, initial_concurrency=INITIAL_CONCURRENCY, description='Bulk ops'):
+    """Run an iterable of ops, made by copy_op() and delete_op(), on processes processes,
+    each with at most concurrency requests in flight. Returns the merged Op_Metrics."""
+    begin = time.time()
+    # Bounded, so that the ops are consumed no faster than they are run
+    task_queue = Queue(maxsize=4 * processes)
+    done_queue = Queue()
+    workers = []
+    for process in range(processes):
+        workers.append(Process(target=bulk_worker, args=(task_queue, done_queue, process + 1, concurrency,
+                                                         initial_concurrency, checkpoint, log_success)))
+        workers[-1].start()
+
+    n = 0
+    skipped = 0
+    ops = iter(ops)
+    while chunk := list(islice(ops, batch)):
+        n += len(chunk)
+        if checkpoint:
+            undone = set(checkpoint.filter_undone([op_key(op) for op in chunk]))
+            todo = [op for op in chunk if op_key(op) in undone]
+            skipped += len(chunk) - len(todo)
+            chunk = todo
+        if chunk:
+            task_queue.put(chunk)
+    progresslogger.info(f'{description}: work distribution complete; {n} ops, {skipped} previously done')
+
+    for process in workers:
+        task_queue.put('STOP')
+    metrics = Op_Metrics()
+    for process in workers:
+        metrics.merge(done_queue.get())
+    for process in workers:
+        process.join()
+
+    progresslogger.info(f'{description}: {metrics.summary(time.time() - begin)}; {processes} processes')
+    return metrics
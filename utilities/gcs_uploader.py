@@ -0,0 +1,122 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Parallel upload of local files to GCS from within a process, in place of shelling out to gsutil.
+# Files are uploaded on a bounded pool of threads as single (never composite) resumable uploads.
+# The MD5 of each file is computed locally and compared against the MD5 that GCS computed for
+# the uploaded object. A file can be deleted as soon as its upload is verified.
+# upload() returns without waiting, so that the caller can, for example, download the next batch
+# of files while the previous batch is being uploaded.
+
+import os
+import time
+import hashlib
+import threading
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from utilities.logging_config import progresslogger, errlogger
+
+# Size of each request of a resumable upload. Must be a multiple of 256KiB
+UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+UPLOAD_TRIES = 3
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class GCS_Uploader:
+    def __init__(self, num_threads=8, max_pending=None, delete=True):
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        # Bounds the number of files submitted but not yet uploaded; upload() blocks when it is reached
+        self.pending = threading.BoundedSemaphore(max_pending if max_pending else 4 * num_threads)
+        self.delete = delete
+        self.lock = threading.Lock()
+        self.futures = []
+        self.bytes = 0
+        self.files = 0
+        self.failures = 0
+        self.begin = time.time()
+
+    def upload(self, path, bucket, blob_name, callback=None):
+        """Upload a local file to bucket/blob_name. callback(path, blob_name, metrics) is called from the
+        upload thread with metrics {'size', 'seconds', 'rate'} if the upload succeeded, else None."""
+        self.pending.acquire()
+        future = self.executor.submit(self._upload, path, bucket, blob_name, callback)
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def _upload(self, path, bucket, blob_name, callback):
+        try:
+            metrics = None
+            for attempt in range(UPLOAD_TRIES):
+                try:
+                    metrics = self._upload_file(path, bucket, blob_name)
+                    break
+                except Exception as exc:
+                    errlogger.error(f'Upload of {path} to {bucket.name}/{blob_name} failed, attempt {attempt}: {exc}')
+            with self.lock:
+                if metrics:
+                    self.files += 1
+                    self.bytes += metrics['size']
+                else:
+                    self.failures += 1
+            if callback:
+                callback(path, blob_name, metrics)
+            return metrics
+        finally:
+            self.pending.release()
+
+    def _upload_file(self, path, bucket, blob_name):
+        start = time.time()
+        size = os.path.getsize(path)
+        md5 = file_md5(path)
+        blob = bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+        # Setting chunk_size makes this a resumable upload of a single object
+        blob.upload_from_filename(path, checksum='md5')
+        if b64decode(blob.md5_hash).hex() != md5:
+            blob.delete()
+            raise ValueError(f'MD5 mismatch: local {md5}, GCS {b64decode(blob.md5_hash).hex()}')
+        if self.delete:
+            os.unlink(path)
+        seconds = time.time() - start
+        metrics = dict(size=size, seconds=seconds, rate=size / seconds if seconds else 0)
+        progresslogger.debug(f'Uploaded {path} to {bucket.name}/{blob_name}, {round(size / pow(10, 6), 2)}MB, '
+                             f'{round(metrics["rate"] / pow(10, 6), 2)}MB/s')
+        return metrics
+
+    def wait(self):
+        """Wait for all files submitted so far to be uploaded. Returns the number of failures."""
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        for future in futures:
+            future.result()
+        return self.failures
+
+    def close(self):
+        failures = self.wait()
+        self.executor.shutdown()
+        elapsed = time.time() - self.begin
+        progresslogger.info(f'Uploaded {self.files} files, {round(self.bytes / pow(10, 9), 2)} GB, '
+                            f'{round(self.bytes / elapsed / pow(10, 6), 2) if elapsed else 0} MB/s, {failures} failures')
+        return failures
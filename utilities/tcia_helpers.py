@@ -18,10 +18,19 @@ import os
 
 import json
 from subprocess import run, PIPE
-from time import sleep
+from time import sleep, time
+from multiprocessing import Lock, BoundedSemaphore, shared_memory
+from contextlib import contextmanager
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import zipfile
+import hashlib
+from io import BytesIO
+import pydicom
+from pydicom.errors import InvalidDicomError
+from stream_unzip import stream_unzip
 import pandas as pd
 from tcia_utils import datacite
 from utilities.logging_config import errlogger
@@ -52,13 +61,75 @@ NLST_V1_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/services/v1'
 NLST_V2_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/services/v2'
 NLST_AUTH_URL = 'https://nlst.cancerimagingarchive.net/nbia-api/oauth/token'
 
+# Per-process HTTP client settings. Each process gets one requests.Session whose
+# connection pool keeps connections to the NBIA/TCIA servers alive across calls.
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+HTTP_RETRIES = 4
+HTTP_BACKOFF_FACTOR = 1
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+# Bounds the number of concurrent requests to the NBIA servers across all processes
+_request_slots = None
+
+
+def set_max_concurrent_requests(max_concurrent_requests):
+    # Must be called before worker processes are forked so that they share the semaphore.
+    # A value of 0 removes the limit.
+    global _request_slots
+    _request_slots = BoundedSemaphore(max_concurrent_requests) if max_concurrent_requests else None
+
+
+@contextmanager
+def request_slot():
+    if _request_slots:
+        _request_slots.acquire()
+        try:
+            yield
+        finally:
+            _request_slots.release()
+    else:
+        yield
+
+
+def get_session():
+    # Sessions are not shared across processes; a forked process gets its own
+    pid = os.getpid()
+    if not pid in _sessions:
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_BACKOFF_FACTOR,
+            status_forcelist=HTTP_RETRY_STATUSES,
+            allowed_methods=None, # NBIA POSTs, e.g. getMD5Hierarchy, are idempotent
+            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[pid] = session
+    return _sessions[pid]
+
+
+def http_request(method, url, **kwargs):
+    with request_slot():
+        return get_session().request(method, url, **kwargs)
+
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    return http_request('POST', url, **kwargs)
+
 
 # @backoff.on_exception(backoff.expo,
 #                       requests.exceptions.RequestException,
 #                       max_tries=3)
 def get_url(url, headers="", timeout=TIMEOUT):  # , headers):
     try:
-        result =  requests.get(url, headers=headers, timeout=timeout)  # , headers=headers)
+        result =  http_get(url, headers=headers, timeout=timeout)  # , headers=headers)
     except Exception as exc:
         logging.error(f'In get_url: {exc}', exc_info=True)
         raise
@@ -66,7 +137,7 @@ def get_url(url, headers="", timeout=TIMEOUT):  # , headers):
         raise RuntimeError('In get_url(): status_code=%s; url: %s', result.status_code, url)
     return result
 
-def get_access_token(auth_server = NBIA_AUTH_URL):
+def request_access_token(auth_server = NBIA_AUTH_URL):
     if auth_server == NLST_AUTH_URL:
         data = dict(
             username=settings.TCIA_ID,
@@ -82,31 +153,138 @@ def get_access_token(auth_server = NBIA_AUTH_URL):
             client_secret=settings.TCIA_CLIENT_SECRET,
             grant_type="password")
 
-    result = requests.post(auth_server, data = data)
-    return (result.json()['access_token'], result.json()['refresh_token'])
+    result = http_post(auth_server, data = data)
+    return result.json()
 
 
+def get_access_token(auth_server = NBIA_AUTH_URL):
+    token = request_access_token(auth_server)
+    return (token['access_token'], token['refresh_token'])
+
+
+# Maximum length of a token held in shared memory. ShareableList entries cannot grow
+# after creation, so we allocate this much up front.
+TOKEN_CAPACITY = 4096
+# Lifetime to assume if the auth server doesn't report expires_in
+DEFAULT_TOKEN_LIFETIME = 3600
+# Refresh a token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 60
+
+# Indices into the shared token state
+ACCESS_TOKEN, REFRESH_TOKEN, EXPIRES_AT, HITS, MISSES, REFRESHES = range(6)
+
+class Token_Manager:
+    # Manages an NBIA/NLST OAuth access token that is shared by all the processes of a job.
+    # The token state lives in a ShareableList and is guarded by a Lock, both of which are
+    # inherited by, or can be passed to, worker processes. A new token is requested only when
+    # there is none, when it is about to expire, or when the server rejects it with a 401.
+    def __init__(self, auth_server=NBIA_AUTH_URL, lock=None, margin=TOKEN_REFRESH_MARGIN):
+        self.auth_server = auth_server
+        self.lock = lock if lock else Lock()
+        self.margin = margin
+        self.state = shared_memory.ShareableList([' '*TOKEN_CAPACITY, ' '*TOKEN_CAPACITY, 0.0, 0, 0, 0])
+        self.state[ACCESS_TOKEN] = ''
+        self.state[REFRESH_TOKEN] = ''
+
+    def _fetch(self):
+        # Must be called with the lock held
+        token = request_access_token(self.auth_server)
+        if len(token['access_token']) > TOKEN_CAPACITY or len(token['refresh_token']) > TOKEN_CAPACITY:
+            raise RuntimeError(f'Token from {self.auth_server} exceeds {TOKEN_CAPACITY} bytes')
+        self.state[ACCESS_TOKEN] = token['access_token']
+        self.state[REFRESH_TOKEN] = token['refresh_token']
+        self.state[EXPIRES_AT] = time() + float(token.get('expires_in', DEFAULT_TOKEN_LIFETIME))
+
+    def token(self):
+        with self.lock:
+            if not self.state[ACCESS_TOKEN]:
+                self.state[MISSES] += 1
+                self._fetch()
+            elif time() >= self.state[EXPIRES_AT] - self.margin:
+                self.state[REFRESHES] += 1
+                self._fetch()
+            else:
+                self.state[HITS] += 1
+            return self.state[ACCESS_TOKEN]
+
+    # Called when a request with access_token got a 401. Only fetch a new token if some other
+    # process hasn't already replaced the rejected one.
+    def invalidate(self, access_token):
+        with self.lock:
+            if self.state[ACCESS_TOKEN] == access_token:
+                self.state[REFRESHES] += 1
+                self._fetch()
+            return self.state[ACCESS_TOKEN]
+
+    def headers(self, access_token=None):
+        return dict(
+            Authorization=f'Bearer {access_token if access_token else self.token()}'
+        )
 
-def get_tcia_instance_hash(sop_instance_uid, access_token=None):
-    # if not access_token:
-    #     access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
-    headers = dict(
-        Authorization=f'Bearer {access_token}'
-    )
+    # Issue a request with the shared token, retrying once with a new token on a 401
+    def request(self, method, url, **kwargs):
+        access_token = self.token()
+        result = http_request(method, url, headers=self.headers(access_token), **kwargs)
+        if result.status_code == 401:
+            access_token = self.invalidate(access_token)
+            result = http_request(method, url, headers=self.headers(access_token), **kwargs)
+        return result
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def counters(self):
+        return dict(
+            hits = self.state[HITS],
+            misses = self.state[MISSES],
+            refreshes = self.state[REFRESHES]
+        )
+
+    def close(self):
+        self.state.shm.close()
+
+    def unlink(self):
+        self.state.shm.close()
+        self.state.shm.unlink()
+
+
+# Per-process registry of token managers, indexed by auth server. A token manager that is
+# registered before worker processes are forked is shared by those workers.
+_token_managers = {}
+
+def get_token_manager(auth_server = NBIA_AUTH_URL):
+    if not auth_server in _token_managers:
+        _token_managers[auth_server] = Token_Manager(auth_server)
+    return _token_managers[auth_server]
+
+
+def set_token_manager(token_manager):
+    _token_managers[token_manager.auth_server] = token_manager
+
+
+
+def get_tcia_instance_hash(sop_instance_uid, access_token=None, token_manager=None):
     url = f"{NBIA_V2_URL}/getM5HashForImage?SOPInstanceUid={sop_instance_uid}"
-    result = requests.get(url, headers=headers)
+    if access_token:
+        headers = dict(
+            Authorization=f'Bearer {access_token}'
+        )
+        result = http_get(url, headers=headers)
+    else:
+        token_manager = token_manager if token_manager else get_token_manager(NBIA_AUTH_URL)
+        result = token_manager.get(url)
     return result
 
 
-def get_hash_nlst(request_data, access_token=''):
-    access_token, refresh_token = get_access_token(NLST_AUTH_URL)
+def get_hash_nlst(request_data, access_token='', token_manager=None):
+    token_manager = token_manager if token_manager else get_token_manager(NLST_AUTH_URL)
     retries = 4
     while retries:
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
         url = f"{NLST_URL}/getMD5Hierarchy"
-        result = requests.post(url, headers=headers, data=request_data)
+        result = token_manager.post(url, data=request_data)
         if result.status_code == 200:
             break
         else:
@@ -115,16 +293,16 @@ def get_hash_nlst(request_data, access_token=''):
     return result
 
 
-def get_hash(request_data, access_token=None):
-    if not access_token:
-        access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
+def get_hash(request_data, access_token=None, token_manager=None):
+    token_manager = token_manager if token_manager else get_token_manager(NBIA_AUTH_URL)
     retries = 4
     while retries:
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
         url = f"{NBIA_URL}/getMD5Hierarchy"
-        result = requests.post(url, headers=headers, data=request_data)
+        if access_token:
+            # Caller is managing its own token
+            result = http_post(url, headers=token_manager.headers(access_token), data=request_data)
+        else:
+            result = token_manager.post(url, data=request_data)
         if result.status_code == 200:
             break
         else:
@@ -139,14 +317,14 @@ def get_images_with_md5_hash_nlst(SeriesInstanceUID, access_token=None):
     )
     server_url = NLST_V1_URL
     url = f'{server_url}/getImageWithMD5Hash?SeriesInstanceUID={SeriesInstanceUID}'
-    result = requests.get(url, headers=headers)
+    result = http_get(url, headers=headers)
     return result
 
 
 def get_images_with_md5_hash(SeriesInstanceUID, access_token=None):
     server_url = NBIA_V1_URL
     url = f'{server_url}/getImageWithMD5Hash?SeriesInstanceUID={SeriesInstanceUID}'
-    result = requests.get(url)
+    result = http_get(url)
     return result
 
 
@@ -154,18 +332,15 @@ def get_images_with_md5_hash(SeriesInstanceUID, access_token=None):
 def get_collection_values_and_counts(server=NBIA_URL):
     if server == "NLST":
         server_url = NLST_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
+        headers = get_token_manager(NLST_AUTH_URL).headers()
     elif server == "NBIA":
         server_url = NBIA_URL
-        access_token, refresh_token = get_access_token()
+        headers = get_token_manager().headers()
     else:
         server_url = server
-        access_token, refresh_token = get_access_token()
-    headers = dict(
-        Authorization = f'Bearer {access_token}'
-    )
+        headers = get_token_manager().headers()
     url = f'{server_url}/getCollectionValuesAndCounts'
-    result = requests.get(url, headers=headers)
+    result = http_get(url, headers=headers)
     collections = [collection['criteria'] for collection in result.json()]
     return collections
 
@@ -173,10 +348,7 @@ def get_collection_values_and_counts(server=NBIA_URL):
 def get_TCIA_patients_per_collection(collection_id, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
+        headers = get_token_manager(NLST_AUTH_URL).headers()
     elif server == "NBIA":
         server_url = NBIA_V1_URL
         headers = ''
@@ -192,10 +364,7 @@ def get_TCIA_patients_per_collection(collection_id, server=NBIA_V1_URL):
 def get_TCIA_studies_per_patient(collection_id, patientID, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
+        headers = get_token_manager(NLST_AUTH_URL).headers()
     elif server == "NBIA":
         server_url = NBIA_V1_URL
         headers = ''
@@ -211,10 +380,7 @@ def get_TCIA_studies_per_patient(collection_id, patientID, server=NBIA_V1_URL):
 def get_TCIA_series_per_study(collection_id, patientID, studyInstanceUID, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
+        headers = get_token_manager(NLST_AUTH_URL).headers()
     elif server == "NBIA":
         server_url = NBIA_V1_URL
         headers = ''
@@ -227,6 +393,24 @@ def get_TCIA_series_per_study(collection_id, patientID, studyInstanceUID, server
     return series
 
 
+# Get all the series in a collection in a single call. Each series includes its
+# PatientID and StudyInstanceUID, so the result describes the collection hierarchy.
+def get_TCIA_series_per_collection(collection_id, server=NBIA_V1_URL):
+    if collection_id == "NLST":
+        server_url = NLST_V2_URL
+        headers = get_token_manager(NLST_AUTH_URL).headers()
+    elif server == "NBIA":
+        server_url = NBIA_V1_URL
+        headers = ''
+    else:
+        server_url = server
+        headers = ''
+    url = f'{server_url}/getSeries?Collection={collection_id}'
+    results = get_url(url, headers, timeout=None)
+    series = results.json() if results.content else []
+    return series
+
+
 def get_TCIA_series_metadata(seriesInstanceUID, server=NBIA_V1_URL):
     server_url = server
     headers = ''
@@ -239,10 +423,7 @@ def get_TCIA_series_metadata(seriesInstanceUID, server=NBIA_V1_URL):
 def get_TCIA_instance_uids_per_series(collection_id, seriesInstanceUID, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
+        headers = get_token_manager(NLST_AUTH_URL).headers()
     elif server == "NBIA":
         server_url = NBIA_V1_URL
         headers = ''
@@ -266,7 +447,7 @@ def get_TCIA_instances_per_series_with_hashes_nlst(dicom, series, access_token )
     )
 
     url = f'{NLST_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series.series_instance_uid}'
-    with requests.get(url, headers=headers, stream=True) as r:
+    with request_slot(), get_session().get(url, headers=headers, stream=True) as r:
         r.raise_for_status()
         with open(filename, 'wb') as f:
             for chunk in r.iter_content(chunk_size=8192):
@@ -293,7 +474,7 @@ def get_TCIA_instances_per_series_with_hashes(dicom, series):
     dirname = "{}/{}".format(dicom, series.uuid)
 
     url = f'{NBIA_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series.series_instance_uid}'
-    with requests.get(url, stream=True) as r:
+    with request_slot(), get_session().get(url, stream=True) as r:
         r.raise_for_status()
         with open(filename, 'wb') as f:
             for chunk in r.iter_content(chunk_size=8192):
@@ -313,17 +494,85 @@ def get_TCIA_instances_per_series_with_hashes(dicom, series):
     return hashes
 
 
+# Bytes of the start of each instance kept in memory from which to read its DICOM IDs
+DICOM_HEADER_BYTES = 256*1024
+DICOM_ID_TAGS = ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID']
+
+def read_dicom_ids(header, file_name):
+    # Try to get the IDs from the in-memory header. If the header is longer than we kept,
+    # fall back to reading the file that was just written.
+    try:
+        reader = pydicom.dcmread(BytesIO(header), stop_before_pixels=True, specific_tags=DICOM_ID_TAGS)
+        return {tag: getattr(reader, tag) for tag in DICOM_ID_TAGS}
+    except InvalidDicomError:
+        raise
+    except Exception:
+        reader = pydicom.dcmread(file_name, stop_before_pixels=True, specific_tags=DICOM_ID_TAGS)
+        return {tag: getattr(reader, tag) for tag in DICOM_ID_TAGS}
+
+
+# Stream the zip of a series from NBIA, writing each member to dicom/<series.uuid>/ as it arrives.
+# Each member is hashed as it is written, and its DICOM IDs are read from its in-memory header,
+# so no intermediate zip is written and no file is reread to hash it.
+# Returns a dictionary, indexed by member file name, of
+#   {'hash':<md5>, 'size':<bytes>, 'expected_hash':<md5 from md5hashes.csv>, 'ids':<DICOM IDs or None if not DICOM>}
+def stream_TCIA_instances_per_series_with_hashes(dicom, series, server="NBIA"):
+    dirname = "{}/{}".format(dicom, series.uuid)
+    os.makedirs(f"{dirname}", exist_ok=True)
+
+    if server == "NLST":
+        url = f'{NLST_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series.series_instance_uid}'
+        headers = get_token_manager(NLST_AUTH_URL).headers()
+    else:
+        url = f'{NBIA_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series.series_instance_uid}'
+        headers = ''
+
+    members = {}
+    expected_hashes = {}
+    with request_slot(), get_session().get(url, headers=headers, stream=True) as r:
+        r.raise_for_status()
+        # Every member's chunks must be consumed before stream_unzip will yield the next member
+        for member_name, member_size, member_chunks in stream_unzip(r.iter_content(chunk_size=CHUNK_SIZE)):
+            member_name = member_name.decode()
+            if member_name == 'md5hashes.csv':
+                for line in b''.join(member_chunks).decode().splitlines()[1:]:
+                    file_name, hash = line.split(',')
+                    expected_hashes[file_name] = hash
+                continue
+            md5 = hashlib.md5()
+            size = 0
+            header = bytearray()
+            file_name = f'{dirname}/{member_name}'
+            with open(file_name, 'wb') as f:
+                for chunk in member_chunks:
+                    md5.update(chunk)
+                    size += len(chunk)
+                    if len(header) < DICOM_HEADER_BYTES:
+                        header.extend(chunk[:DICOM_HEADER_BYTES - len(header)])
+                    f.write(chunk)
+            try:
+                ids = read_dicom_ids(bytes(header), file_name)
+            except InvalidDicomError:
+                ids = None
+            members[member_name] = dict(
+                hash = md5.hexdigest(),
+                size = size,
+                ids = ids
+            )
+
+    for member_name in members:
+        members[member_name]['expected_hash'] = expected_hashes.get(member_name, '')
+    return members
+
+
 # Get NBIAs internal ID for all the series in a collection/patient
 def get_internal_series_ids(collection, patient, third_party="yes", size=100000, server="" ):
     if server == "NLST":
         server_url = NLST_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
+        token_manager = get_token_manager(NLST_AUTH_URL)
     else:
         server_url = NBIA_URL
-        access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
-    headers = dict(
-        Authorization=f'Bearer {access_token}'
-    )
+        token_manager = get_token_manager(NBIA_AUTH_URL)
     url = f'{server_url}/getSimpleSearchWithModalityAndBodyPartPaged'
     if not patient=="":
         data = dict(
@@ -348,9 +597,8 @@ def get_internal_series_ids(collection, patient, third_party="yes", size=100000,
             start=0,
             size=size)
 
-    result = requests.post(
+    result = token_manager.post(
         url,
-        headers=headers,
         data=data
     )
     return result.json()
@@ -377,10 +625,7 @@ def series_drill_down(series_ids, server="" ):
 
 def get_collection_descriptions_and_licenses(collection=None):
     if collection == 'NLST':
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-        headers = dict(
-            Authorization=f'Bearer {access_token}'
-        )
+        headers = get_token_manager(NLST_AUTH_URL).headers()
         url = f'https://nlst.cancerimagingarchive.net/nbia-api/services/getCollectionDescriptions?collectionName=NLST'
     else:
 
@@ -393,7 +638,7 @@ def get_collection_descriptions_and_licenses(collection=None):
             Authorization=f'Bearer {access_token}'
         )
 
-    result = requests.get(
+    result = http_get(
         url,
         headers=headers
     )
@@ -414,7 +659,7 @@ def get_license_info():
     headers = dict(
         Authorization=f'Bearer {access_token}'
     )
-    result = requests.get(
+    result = http_get(
         url='https://public.cancerimagingarchive.net/nbia-api/services/getLicenses',
         headers=headers
     )
@@ -463,13 +708,13 @@ def get_tcia_collection_manager_data(type, query_param=''):
         url = f"https://cancerimagingarchive.net/api/v1/{type}/?per_page=100&{query_param}"
     else:
         url = f"https://cancerimagingarchive.net/api/v1/{type}/?per_page=100"
-    response = requests.get(url)
+    response = http_get(url)
     if response.status_code == 200:
         # Parse the JSON response
         data = response.json()
         while 'next' in response.links.keys():
             next_url = response.links['next']['url']
-            response = requests.get(next_url)
+            response = http_get(next_url)
             if response.status_code == 200:
                 next_data = response.json()
                 data.extend(next_data)
@@ -490,7 +735,7 @@ def et_tcia_collection_manager_data_v2(type, query_param=''):
             url = f"https://cancerimagingarchive.net/api/v2/{type}/?per_page=100&page={page}&{query_param}"
         else:
             url = f"https://cancerimagingarchive.net/api/v2/{type}/?per_page=100&page={page}"
-        response = requests.get(url)
+        response = http_get(url)
         if response.status_code == 200:
             # Parse the JSON response
             result = response.json()
@@ -16,106 +16,187 @@
 
 # This script compares our hierarchical hashes with those generated by NBIA. This is
 # mostly to test NBIA progress.
+# Hashes are compared level by level, and the comparison only descends into the subtrees
+# whose hashes differ, unless --expand_all is set. Every mismatch is also written as a line
+# of JSON to the --report file, so that a comparison can be processed by other tools.
 
 import sys
 import os
 import argparse
 import hashlib
+import io
+import json
+import tempfile
+from contextlib import nullcontext
 from logging import INFO
-from utilities.tcia_helpers_v4 import get_hash, get_images_with_md5_hash,\
+from utilities.tcia_helpers import get_hash, get_session, request_slot, \
     get_TCIA_patients_per_collection, get_TCIA_studies_per_patient, get_TCIA_series_per_study, \
-    get_TCIA_instances_per_series_with_hashes
+    NBIA_V1_URL, CHUNK_SIZE, DICOM_HEADER_BYTES
 from ingestion.utilities.utils import get_merkle_hash
 from utilities.logging_config import successlogger, progresslogger, errlogger
 import settings
 from google.cloud import bigquery
 import zipfile
-import io
 import pydicom
+from pydicom.errors import InvalidDicomError
 
 from idc.models import Base, Version, All_Collections
 from sqlalchemy.orm import Session
 
-
-from python_settings import settings
-
 from sqlalchemy import create_engine
 from sqlalchemy_utils import register_composites
 
 
-# Get a list of instance md5 hashes from NBIA
-def get_instance_hashes(series_instance_uid, collection_id):
-    zip_file = io.BytesIO(get_images_with_md5_hash(series_instance_uid).content)
-    zipfile_obj = zipfile.ZipFile(zip_file)
-    try:
-        md5_hashes = [row.decode().split(',')  for row in zipfile_obj.open("md5hashes.csv").read().splitlines()[1:]]
-    except KeyError as exc:
-        print(exc)
-        return
+# Append a mismatch to the report. ids is a dictionary of the ids of the object
+# and of its ancestors. kind is one of 'hash', 'count', 'only_idc', 'only_tcia', 'no_md5hashes'.
+def report_mismatch(args, level, kind, ids, idc=None, nbia=None):
+    if args.report_file:
+        args.report_file.write(json.dumps(dict(level=level, kind=kind, **ids, idc=idc, nbia=nbia)) + '\n')
+        args.report_file.flush()
+
+
+def report_differing_sets(args, level, kind, ids, id_name, id_values):
+    for id_value in sorted(id_values):
+        report_mismatch(args, level, kind, {**ids, id_name: id_value})
+
+
+def collection_ids(collection):
+    return dict(collection_id=collection.collection_id)
 
-    for instance in md5_hashes:
-        with zipfile_obj.open(instance[0]) as dcm_obj:
-            instance.append(pydicom.dcmread(dcm_obj, stop_before_pixels=True).SOPInstanceUID)
 
-    return (md5_hashes, zipfile_obj)
+def patient_ids(collection, patient):
+    return dict(collection_id=collection.collection_id, submitter_case_id=patient.submitter_case_id)
+
+
+def study_ids(collection, patient, study):
+    return dict(**patient_ids(collection, patient), study_instance_uid=study.study_instance_uid)
+
+
+def series_ids(collection, patient, study, series):
+    return dict(**study_ids(collection, patient, study), series_instance_uid=series.series_instance_uid)
+
+
+# Get the SOPInstanceUID of a zip member from the start of it. If the header is longer than we kept,
+# fall back to parsing the member again.
+def read_sop_instance_uid(zipfile_obj, file_name, header):
+    try:
+        return pydicom.dcmread(io.BytesIO(header), stop_before_pixels=True,
+                               specific_tags=['SOPInstanceUID']).SOPInstanceUID
+    except InvalidDicomError:
+        raise
+    except Exception:
+        with zipfile_obj.open(file_name) as dcm_obj:
+            return pydicom.dcmread(dcm_obj, stop_before_pixels=True,
+                                   specific_tags=['SOPInstanceUID']).SOPInstanceUID
+
+
+# Get the instance md5 hashes of a series from NBIA.
+# The zip of the series is streamed to a spool file in args.spool_dir, and each member is read from
+# it once, in chunks, so that memory use does not depend on the size of the series or its instances. Returns a dictionary, indexed by SOPInstanceUID, of
+#   {'file_name':<member name>, 'nbia_hash':<md5 from md5hashes.csv>, 'hash':<md5 of the member>}
+# or None if the zip has no md5hashes.csv.
+def get_instance_hashes(args, series_instance_uid):
+    url = f'{NBIA_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series_instance_uid}'
+    with tempfile.TemporaryFile(dir=args.spool_dir) as spool:
+        with request_slot(), get_session().get(url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                spool.write(chunk)
+        spool.seek(0)
+
+        with zipfile.ZipFile(spool) as zipfile_obj:
+            try:
+                with zipfile_obj.open("md5hashes.csv") as f:
+                    md5_hashes = dict(row.decode().strip().split(',') for row in f.readlines()[1:] if row.strip())
+            except KeyError as exc:
+                errlogger.error('No md5hashes.csv in series %s: %s', series_instance_uid, exc)
+                return None
+
+            instances = {}
+            for file_name, nbia_hash in md5_hashes.items():
+                # Hash every chunk, and keep just the start of the member to parse
+                md5 = hashlib.md5()
+                header = bytearray()
+                with zipfile_obj.open(file_name) as dcm_obj:
+                    for chunk in iter(lambda: dcm_obj.read(CHUNK_SIZE), b''):
+                        md5.update(chunk)
+                        if len(header) < DICOM_HEADER_BYTES:
+                            header.extend(chunk[:DICOM_HEADER_BYTES - len(header)])
+                sop_instance_uid = read_sop_instance_uid(zipfile_obj, file_name, bytes(header))
+                instances[sop_instance_uid] = dict(file_name=file_name, nbia_hash=nbia_hash, hash=md5.hexdigest())
+    return instances
+
 
 def compare_instance_hashes(cur, args, collection, patient, study, series):
-    idc_instances = series.instances
-    nbia_instances, zipfile_obj = get_instance_hashes(series.series_instance_uid, collection.collection_id)
+    ids = series_ids(collection, patient, study, series)
+    idc_instances = {instance.sop_instance_uid: instance for instance in series.instances}
+    nbia_instances = get_instance_hashes(args, series.series_instance_uid)
+    if nbia_instances is None:
+        report_mismatch(args, 'series', 'no_md5hashes', ids)
+        return
 
     if len(nbia_instances) != len(idc_instances):
         progresslogger.info('            %-32s Differing instance count for series: IDC: %s, NBIA: %s',
                             series.series_instance_uid,
                             len(idc_instances), len(nbia_instances))
+        report_mismatch(args, 'series', 'count', ids, len(idc_instances), len(nbia_instances))
 
-    only_idc = []
-    only_tcia = []
-    if not set([instance.sop_instance_uid for instance in idc_instances]) == \
-           set([instance[2] for instance in nbia_instances]):
+    only_idc = idc_instances.keys() - nbia_instances.keys()
+    only_tcia = nbia_instances.keys() - idc_instances.keys()
+    if only_idc or only_tcia:
         progresslogger.info("i>>           Different set of instances")
-        if only_idc := set([instance.sop_instance_uid for instance in idc_instances]) - set([instance[2] for instance in nbia_instances]):
+        if only_idc:
             progresslogger.info("i>>             Instances that are only in IDC")
             for instance in only_idc:
                 progresslogger.info(f"i>>              {instance}")
-        if only_tcia := set([instance[2] for instance in nbia_instances]) - set([instance.sop_instance_uid for instance in idc_instances]):
+            report_differing_sets(args, 'instance', 'only_idc', ids, 'sop_instance_uid', only_idc)
+        if only_tcia:
             progresslogger.info("i>>             Instances that are only in TCIA")
             for instance in only_tcia:
                 progresslogger.info(f"i>>              {instance}")
+            report_differing_sets(args, 'instance', 'only_tcia', ids, 'sop_instance_uid', only_tcia)
 
-    for idc_instance in [ idc_instance for idc_instance in idc_instances if idc_instance.sop_instance_uid not in only_tcia]:
-        nbia_instance = next(nbia_instance for nbia_instance in nbia_instances if nbia_instance[2]==idc_instance.sop_instance_uid)
-        md5 = hashlib.md5()
-        md5.update(zipfile_obj.open(nbia_instance[0]).read())
-        pyhash = md5.hexdigest()
+    for sop_instance_uid in sorted(idc_instances.keys() & nbia_instances.keys()):
+        idc_instance = idc_instances[sop_instance_uid]
+        nbia_instance = nbia_instances[sop_instance_uid]
+        pyhash = nbia_instance['hash']
         idc_hash = idc_instance.hash
-        nbia_hash = nbia_instance[1]
+        nbia_hash = nbia_instance['nbia_hash']
 
         if not args.only_mismatches or pyhash != idc_hash:
-            progresslogger.info('i:                %-32s IDC: %s, NBIA: %s; %s', idc_instance.sop_instance_uid, idc_instance.hash,
-                            nbia_instance[1], idc_hash == nbia_hash)
+            progresslogger.info('i:                %-32s IDC: %s, NBIA: %s; %s', sop_instance_uid, idc_hash,
+                            nbia_hash, idc_hash == nbia_hash)
+        if idc_hash != nbia_hash or pyhash != idc_hash:
+            report_mismatch(args, 'instance', 'hash', dict(**ids, sop_instance_uid=sop_instance_uid,
+                            file_name=nbia_instance['file_name'], computed=pyhash), idc_hash, nbia_hash)
 
 
 def compare_series_hashes(cur, args, collection, patient, study):
     tcia_series = get_TCIA_series_per_study(collection.collection_id, patient.submitter_case_id, study.study_instance_uid)
+    ids = study_ids(collection, patient, study)
 
     idc_series = study.seriess
-    only_idc = []
+    only_idc = set()
     if args.series:
         idc_series = [ series for series in idc_series if series.series_instance_uid in args.series]
     else:
-        if not set([series.series_instance_uid for series in idc_series]) == set([series['SeriesInstanceUID'] for series in tcia_series]):
+        idc_series_ids = set(series.series_instance_uid for series in idc_series)
+        tcia_series_ids = set(series['SeriesInstanceUID'] for series in tcia_series)
+        if not idc_series_ids == tcia_series_ids:
             progresslogger.info("st>>           Different set of series")
-            if only_idc := set([series.series_instance_uid for series in idc_series]) - set([series['SeriesInstanceUID'] for series in tcia_series]):
+            if only_idc := idc_series_ids - tcia_series_ids:
                 progresslogger.info("st>>             Series that are only in IDC")
                 for series in only_idc:
                     progresslogger.info(f"st>>              {series}")
-            if only_tcia := set([series['SeriesInstanceUID'] for series in tcia_series]) - set([series.series_instance_uid for series in idc_series]):
+                report_differing_sets(args, 'series', 'only_idc', ids, 'series_instance_uid', only_idc)
+            if only_tcia := tcia_series_ids - idc_series_ids:
                 progresslogger.info("st>>             Series that are only in TCIA")
                 for series in only_tcia:
                     progresslogger.info(f"st>>              {series}")
+                report_differing_sets(args, 'series', 'only_tcia', ids, 'series_instance_uid', only_tcia)
 
-    tcia_series = sorted(tcia_series, key=lambda id: id['SeriesInstanceUID'])
-    for series in [series for series in idc_series if series.series_instance_uid not in only_idc]:
+    for series in sorted([series for series in idc_series if series.series_instance_uid not in only_idc],
+                         key=lambda series: series.series_instance_uid):
         try:
             result = get_hash({'SeriesInstanceUID': series.series_instance_uid})
 
@@ -128,14 +209,15 @@ def compare_series_hashes(cur, args, collection, patient, study):
             if 'series' in args.log_level:
                 if not args.only_mismatches or idc_hash != nbia_hash:
                     progresslogger.info('se:            %-32s IDC: %s, NBIA: %s; %s', study.study_instance_uid, series.series_instance_uid, nbia_hash, idc_hash==nbia_hash)
+            if idc_hash != nbia_hash:
+                report_mismatch(args, 'series', 'hash', series_ids(collection, patient, study, series), idc_hash, nbia_hash)
             if not args.stop_expansion == 'series':
                 if idc_hash != nbia_hash or args.expand_all:
                     if args.stop and (nbia_hash == 'd41d8cd98f00b204e9800998ecf8427e' or nbia_hash == ""):
                         if 'series' in args.log_level:
                             progresslogger.info('se:        %-32s Skip expansion', "")
                     else:
-                        if series.series_instance_uid not in only_idc:
-                            compare_instance_hashes(cur, args, collection, patient, study, series)
+                        compare_instance_hashes(cur, args, collection, patient, study, series)
 
         except TimeoutError as esc:
             progresslogger.info('se:%-32s IDC: %s, error: %s, reason: %s', study.study_instance_uid, series.series_instance_uid, result.status_code, result.reason)
@@ -143,43 +225,49 @@ def compare_series_hashes(cur, args, collection, patient, study):
 
 def compare_study_hashes(sess, args, collection, patient):
     tcia_studies = get_TCIA_studies_per_patient(collection.collection_id, patient.submitter_case_id)
+    ids = patient_ids(collection, patient)
     idc_studies = [study for study in patient.studies if study.sources.tcia==True]
-    only_idc = []
+    only_idc = set()
     if args.studies:
         idc_studies = [study for study in idc_studies if study.study_instance_uid in args.studies]
     else:
-        only_tcia = []
-        if not set([study.study_instance_uid for study in idc_studies]) == set([study['StudyInstanceUID'] for study in tcia_studies]):
+        idc_study_ids = set(study.study_instance_uid for study in idc_studies)
+        tcia_study_ids = set(study['StudyInstanceUID'] for study in tcia_studies)
+        if not idc_study_ids == tcia_study_ids:
             progresslogger.info("p>>         Different set of studies")
-            if only_idc := set([study.study_instance_uid for study in idc_studies]) - set([study['StudyInstanceUID'] for study in tcia_studies]):
+            if only_idc := idc_study_ids - tcia_study_ids:
                 progresslogger.info("p>>           Studies that are only in IDC")
                 for study in only_idc:
                     progresslogger.info(f"p>>            {study}")
-            if only_tcia := set([study['StudyInstanceUID'] for study in tcia_studies]) - set([study.study_instance_uid for study in idc_studies]):
+                report_differing_sets(args, 'study', 'only_idc', ids, 'study_instance_uid', only_idc)
+            if only_tcia := tcia_study_ids - idc_study_ids:
                 progresslogger.info("p>>           Studies that are only in TCIA")
                 for study in only_tcia:
                     progresslogger.info(f"p>>            {study}")
+                report_differing_sets(args, 'study', 'only_tcia', ids, 'study_instance_uid', only_tcia)
 
-    for study in [study for study in idc_studies if study.study_instance_uid not in only_idc]:
+    for study in sorted([study for study in idc_studies if study.study_instance_uid not in only_idc],
+                        key=lambda study: study.study_instance_uid):
         try:
             result = get_hash({'StudyInstanceUID': study.study_instance_uid})
             if result.status_code == 504:
-                progresslogger.info('st:        %-32s IDC: %s, error: %s, reason: %s', patient.submitter_uid, study.study_instance_uid, result.status_code,
+                progresslogger.info('st:        %-32s IDC: %s, error: %s, reason: %s', patient.submitter_case_id, study.study_instance_uid, result.status_code,
                                 result.reason)
 
             nbia_hash = result.text
             idc_hash = study.hashes.tcia
             if 'study' in args.log_level:
                 if not args.only_mismatches or idc_hash != nbia_hash:
-                    progresslogger.info('st:        %-32s IDC: %s, NBIA: %s; %s', study.study_instance_uid, nbia_hash, idc_hash, idc_hash==nbia_hash)
+                    progresslogger.info('st:        %-32s IDC: %s, NBIA: %s; %s', study.study_instance_uid, idc_hash, nbia_hash, idc_hash==nbia_hash)
+            if idc_hash != nbia_hash:
+                report_mismatch(args, 'study', 'hash', study_ids(collection, patient, study), idc_hash, nbia_hash)
             if not args.stop_expansion == 'study':
                 if idc_hash != nbia_hash or args.expand_all:
                     if args.stop and (nbia_hash == 'd41d8cd98f00b204e9800998ecf8427e' or nbia_hash == ""):
                         if 'study' in args.log_level:
                             progresslogger.info('st:        %-32s Skip expansion', "")
                     else:
-                        if study.study_instance_uid not in only_idc:
-                            compare_series_hashes(sess, args, collection, patient, study)
+                        compare_series_hashes(sess, args, collection, patient, study)
         except TimeoutError as esc:
             progresslogger.info('st:%-32s IDC: %s, error: %s, reason: %s', patient.submitter_case_id, study.study_instance_uid, result.status_code, result.reason)
 
@@ -193,27 +281,30 @@ def validate_idc_collection_hash(collection):
 
 def compare_patient_hashes(sess, args, collection):
     tcia_patients = get_TCIA_patients_per_collection(collection.collection_id)
+    ids = collection_ids(collection)
 
-    idc_patients = [patient for patient in collection.patients if patient.sources.tcia==True]
-    only_idc = []
+    idc_patients = {patient.submitter_case_id: patient for patient in collection.patients if patient.sources.tcia==True}
+    only_idc = set()
     if args.patients:
-        idc_patients = [patient for patient in idc_patients if patient.submitter_case_id in args.patients]
+        idc_patients = {patient_id: patient for patient_id, patient in idc_patients.items() if patient_id in args.patients}
     else:
-        only_tcia = []
-        if not set([patient.submitter_case_id for patient in idc_patients]) == set([patient['PatientId'] for patient in tcia_patients]):
+        tcia_patient_ids = set(patient['PatientId'] for patient in tcia_patients)
+        if not idc_patients.keys() == tcia_patient_ids:
             progresslogger.info("c>>       Different set of patients")
-            if only_idc := set([patient.submitter_case_id for patient in idc_patients]) - set([patient['PatientId'] for patient in tcia_patients]):
+            if only_idc := idc_patients.keys() - tcia_patient_ids:
                 progresslogger.info("c>>         Patients that are only in IDC")
                 for patient in only_idc:
                     progresslogger.info(f"c>>         {patient}")
-            if only_tcia := set([patient['PatientId'] for patient in tcia_patients]) - set([patient.submitter_case_id for patient in idc_patients]):
+                report_differing_sets(args, 'patient', 'only_idc', ids, 'submitter_case_id', only_idc)
+            if only_tcia := tcia_patient_ids - idc_patients.keys():
                 progresslogger.info("p>>         Patients that are only in TCIA")
                 for patient in only_tcia:
                     progresslogger.info(f"c>>         {patient}")
+                report_differing_sets(args, 'patient', 'only_tcia', ids, 'submitter_case_id', only_tcia)
 
-    sorted_patient_ids = sorted([patient.submitter_case_id for patient in idc_patients if patient.submitter_case_id not in only_idc])
+    sorted_patient_ids = sorted(patient_id for patient_id in idc_patients if patient_id not in only_idc)
     for patient_id in sorted_patient_ids:
-        patient = next(patient for patient in idc_patients if patient.submitter_case_id == patient_id)
+        patient = idc_patients[patient_id]
         try:
             # progresslogger.info('{}    {:32}'.format(n, patient.submitter_case_id))
             result = get_hash(
@@ -227,14 +318,15 @@ def compare_patient_hashes(sess, args, collection):
             if 'patient' in args.log_level:
                 if not args.only_mismatches or idc_hash != nbia_hash:
                     progresslogger.info('p:     {:32} IDC: {}, NBIA: {}; {}'.format(patient.submitter_case_id, idc_hash, nbia_hash, idc_hash==nbia_hash))
+            if idc_hash != nbia_hash:
+                report_mismatch(args, 'patient', 'hash', patient_ids(collection, patient), idc_hash, nbia_hash)
             if not args.stop_expansion == 'patient':
                 if idc_hash != nbia_hash or args.expand_all:
                     if args.stop:
                         if 'patient' in args.log_level:
                             progresslogger.info('p:    %-32s Skip expansion', "")
                     else:
-                        if patient.submitter_case_id not in only_idc:
-                            compare_study_hashes(sess, args, collection, patient)
+                        compare_study_hashes(sess, args, collection, patient)
         except TimeoutError as esc:
             progresslogger.info('p:%-32s error: %s, reason: %s', patient.submitter_case_id, result.status_code, result.reason)
 
@@ -283,6 +375,8 @@ def compare_collection_hashes(sess, args):
                 except:
                     idc_hash = ''
                     progresslogger.info('c:{:32} No IDC hash'.format(collection_id) )
+                if idc_hash != nbia_hash:
+                    report_mismatch(args, 'collection', 'hash', collection_ids(collection), idc_hash, nbia_hash)
 
                 if not args.stop_expansion == 'collection':
                     if idc_hash != nbia_hash or args.expand_all:
@@ -308,7 +402,8 @@ def compare_hashes(args):
     conn = sql_engine.connect()
     register_composites(conn)
 
-    with Session(sql_engine) as sess:
+    with Session(sql_engine) as sess, open(args.report, 'w') if args.report else nullcontext() as report_file:
+        args.report_file = report_file
         compare_collection_hashes(sess, args)
         pass
 
@@ -338,7 +433,7 @@ if __name__ == '__main__':
     parser.add_argument('--suffix', default="")
     parser.add_argument('--stop_expansion', default="Pa", help="Level at which to stop expansion")
     parser.add_argument('--stop', default=False, help='Stop expansion if no hash returned by NBIA')
-    parser.add_argument('--expand_all', default=True, help="Expand regardless of whether hashes match.")
+    parser.add_argument('--expand_all', default=False, help="Expand regardless of whether hashes match.")
     parser.add_argument('--ignore_differing_patient_counts', default=True)
     parser.add_argument('--only_mismatches', default=False, help='Only log mismatching hashes')
     parser.add_argument('--log_level', default=("collection, patient, study, series, instance"),
@@ -352,6 +447,10 @@ if __name__ == '__main__':
     parser.add_argument('--series', default = [],
                         help='List of series to compare. If empty, compare all series')
     parser.add_argument('--skips', default=[])
+    parser.add_argument('--report', default=f'{settings.LOG_DIR}/compare_hashes_v{version}_mismatches.jsonl',
+                        help='File to which mismatches are written as JSON lines. If empty, no report is written')
+    parser.add_argument('--spool_dir', default=None,
+                        help='Directory in which series zips are spooled. Defaults to the system temp directory')
 
     args = parser.parse_args()
     args.version = version
@@ -17,6 +17,10 @@
 # Validate a that a DICOMstore has expected instances in some version
 # We only validate that the DICOMstore has instances with expected SOPInstanceUIDs
 # We don't validate instance hashes
+# The expected SOPInstanceUIDs of a collection are streamed from the DB in a single query, and
+# the parent enqueues each patient as its rows arrive. Workers search the DICOM store once per
+# study, and compare the set of SOPInstanceUIDs of the study in bulk. Each worker keeps one
+# authorized session, and all workers share a limit on the rate of DICOMweb requests.
 
 import sys
 import os
@@ -24,10 +28,11 @@ import argparse
 import time
 from datetime import timedelta
 import json
+from itertools import groupby
 from logging import INFO
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Value
 from utilities.tcia_helpers import  get_TCIA_patients_per_collection, \
-    get_collection_values_and_counts, get_TCIA_studies_per_collection, get_TCIA_series_per_collection
+    get_collection_values_and_counts, get_TCIA_series_per_collection
 import logging
 from python_settings import settings
 import settings as etl_settings
@@ -43,214 +48,232 @@ from psycopg2.extras import DictCursor
 
 _BASE_URL = "https://healthcare.googleapis.com/v1"
 
+# Rows fetched per round trip when streaming the expected instances of a collection
+DB_ITERSIZE = 100000
+
+_sessions = {}
+
 
 def get_session():
-    """Creates an authorized Requests Session."""
+    """Returns the authorized Requests Session of this process, creating it if necessary."""
     # credentials = service_account.Credentials.from_service_account_file(
     #     filename=os.environ["GOOGLE_APPLICATION_CREDENTIALS"],
     #     scopes=["https://www.googleapis.com/auth/cloud-platform"],
     # )
 
-    # Create a requests Session object with the credentials.
-    credentials, project = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    session = requests.AuthorizedSession(credentials)
-    return session
+    # Sessions are not shared across processes; a forked process gets its own.
+    # An AuthorizedSession refreshes its credentials as needed.
+    pid = os.getpid()
+    if not pid in _sessions:
+        credentials, project = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        _sessions[pid] = requests.AuthorizedSession(credentials)
+    return _sessions[pid]
+
+
+class Rate_Limiter:
+    """Limits the rate of requests across all the processes that share it."""
+    def __init__(self, rate):
+        # Must be created before worker processes are forked. A rate of 0 removes the limit.
+        self.interval = 1.0/rate if rate else 0
+        # Time at which the next request may be made
+        self.next = Value('d', 0.0)
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.next.get_lock():
+            now = time.time()
+            slot = max(now, self.next.value)
+            self.next.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
 
 PATIENT_TRIES=3
 
-def dicomweb_search_instances(
-    base_url, project_id, cloud_region, dataset_id, dicom_store_id, series
-):
-    """Handles the GET requests specified in DICOMweb standard."""
-    url = "{}/projects/{}/locations/{}".format(base_url, project_id, cloud_region)
+def dicomweb_search_instances(args, study):
+    """Returns a dictionary, indexed by SOPInstanceUID, of the SeriesInstanceUID of each instance of a study."""
+    url = "{}/projects/{}/locations/{}".format(_BASE_URL, args.project, args.cloud_region)
 
-    dicomweb_path = "{}/datasets/{}/dicomStores/{}/dicomWeb/instances".format(
-        url, dataset_id, dicom_store_id
+    dicomweb_path = "{}/datasets/{}/dicomStores/{}/dicomWeb/studies/{}/instances".format(
+        url, args.gchdataset, args.gchstore, study
     )
-    # dicomweb_path = "{}/datasets/{}/dicomStores/{}/dicomWeb/studies".format(
-    #     url, dataset_id, dicom_store_id
-    # )
-    # params = {"StudyInstanceUID" : '1.3.6.1.4.1.14519.5.2.1.2452.1800.117324429538754496356479065003'}
-    # params = {"PatientName" : 'LUNG1-001'}
 
-    # Make an authenticated API request
     session = get_session()
 
     headers = {"Content-Type": "application/dicom+json; charset=utf-8"}
 
     offset = 0
-    limit = 1000
-    all_instances = []
+    all_instances = {}
     while True:
-        params = {"SeriesInstanceUID": series,
+        params = {"includefield": ["0020000E", "00080018"],
                   "offset": offset,
-                  "limit": limit
+                  "limit": args.qido_limit
                 }
 
+        args.rate_limiter.wait()
         response = session.get(dicomweb_path, headers=headers, params=params)
-        # response = session.get(dicomweb_path, headers=headers)
-        # response = session.get(dicomweb_path, params=params)
         if response.status_code == 204 and response.reason == 'No Content':
             break
 
         response.raise_for_status()
 
-        instances = [i['00080018']['Value'][0] for i in response.json()]
-        all_instances.extend(instances)
+        instances = response.json()
+        all_instances.update({i['00080018']['Value'][0]: i['0020000E']['Value'][0] for i in instances})
         offset += len(instances)
+        if len(instances) < args.qido_limit:
+            break
 
-    return set(all_instances)
+    return all_instances
 
-def validate_series(cur, validated, args, version, collection, patient, study, series, index):
-    result = 0
-    begin = time.time()
-    query = (f"""
-     SELECT DISTINCT sop_instance_uid
-     FROM {args.all_table} as at
-     WHERE at.series_instance_uid = '{series}'
-     """)
-    cur.execute(query)
-    idc_instance_uids = set([i['sop_instance_uid'] for i in cur.fetchall()])
-    rootlogger.info('      p%s: Series %s, %s, %s instances', args.id, series, index, len(idc_instance_uids))
-
-    gch_instance_uids = dicomweb_search_instances(_BASE_URL, args.project, args.cloud_region, args.gchdataset,
-                                                  args.gchstore, series)
+
+def validate_study(args, collection, patient, study, idc_instance_uids, index):
+    gch_instances = dicomweb_search_instances(args, study)
+    gch_instance_uids = gch_instances.keys()
 
     if idc_instance_uids != gch_instance_uids:
-        errlogger.error('      p%s: Instance mismatch; %s/%s/%s/%s',
+        only_idc = idc_instance_uids - gch_instance_uids
+        only_gch = gch_instance_uids - idc_instance_uids
+        errlogger.error('    p%s: Instance mismatch; %s/%s/%s: %s only in IDC, %s only in DICOM store',
                     args.id,
                     collection,
                     patient,
                     study,
-                    series)
+                    len(only_idc),
+                    len(only_gch))
+        for sop_instance_uid in sorted(only_gch):
+            errlogger.error('    p%s:   Only in DICOM store: %s/%s', args.id, gch_instances[sop_instance_uid], sop_instance_uid)
+        for sop_instance_uid in sorted(only_idc):
+            errlogger.error('    p%s:   Only in IDC: %s', args.id, sop_instance_uid)
+        return -1
 
-    duration = str(timedelta(seconds=(time.time() - begin)))
-    rootlogger.info('      p%s: Series %s, %s, completed in %s', args.id, series, index, duration)
+    rootlogger.info('    p%s: Study %s, %s, %s instances', args.id, study, index, len(idc_instance_uids))
+    return 0
 
-def validate_study(cur, validated, args, version, collection, patient, study, index):
-    result = 0
-    begin = time.time()
-
-    query = (f"""
-     SELECT DISTINCT series_instance_uid
-     FROM {args.all_table} as at
-     WHERE at.study_instance_uid = '{study}'
-     """)
-    cur.execute(query)
-    seriess = [series[0] for series in cur.fetchall()]
-    rootlogger.info('    p%s: Study %s, %s, %s series', args.id, study, index, len(seriess))
-
-    for series in seriess:
-        series_index = f'{seriess.index(series) + 1}|{len(seriess)}'
-        validate_series(cur, validated, args, version, collection, patient, study, series, series_index)
-
-    duration = str(timedelta(seconds=(time.time() - begin)))
-    rootlogger.info('    p%s: Study %s, %s, completed in %s', args.id, study, index, duration)
-    return result
 
-def validate_patient(cur, args, validated, version, collection, patient, index):
+def validate_patient(args, collection, patient, studies, index):
     result = 0
     begin = time.time()
 
-    query = (f"""
-     SELECT DISTINCT study_instance_uid
-     FROM {args.all_table} AS at
-     WHERE at.submitter_case_id = '{patient}'
-     """)
-    cur.execute(query)
-    studies = [study[0] for study in cur.fetchall()]
-
     rootlogger.info('  p%s: Patient %s, %s, %s studies', args.id, patient, index, len(studies))
 
-    for study in studies:
-        study_index = f'{studies.index(study) + 1}|{len(studies)}'
-
-        result = validate_study(cur, validated, args, version, collection, patient, study, study_index)
+    for study_index, study in enumerate(sorted(studies)):
+        if validate_study(args, collection, patient, study, studies[study],
+                          f'{study_index + 1}|{len(studies)}'):
+            result = -1
 
     duration = str(timedelta(seconds=(time.time() - begin)))
     rootlogger.info('  p%s: Patient %s, %s, completed in %s', args.id, patient, index, duration)
     return result
 
 
-def worker(input, output, conn, args):
-    rootlogger.debug('p%s: Worker starting: args: %s', args.id, args)
-    conn = psycopg2.connect(dbname=args.db, user=settings.DATABASE_USERNAME,
-                            password=settings.DATABASE_PASSWORD, host=settings.DATABASE_HOST)
-    with conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-
-            for more_args in iter(input.get, 'STOP'):
-                result = 0
-                with conn.cursor(cursor_factory=DictCursor) as cur:
-                    for attempt in range(PATIENT_TRIES):
-                        try:
-                            validated, version, collection, patient, index = more_args
-                            result = validate_patient(cur, args, validated, version, collection, patient,index)
-                            break
-                        except Exception as exc:
-                            errlogger.error("p%s: Worker p%s, exception %s; reattempt %s on %s/%s", args.id, exc, attempt, collection, patient)
+def validate_patient_with_retries(args, collection, patient, studies, index):
+    for attempt in range(PATIENT_TRIES):
+        try:
+            time.sleep((2**attempt)-1)
+            return validate_patient(args, collection, patient, studies, index)
+        except Exception as exc:
+            errlogger.error("p%s: exception %s; reattempt %s on %s/%s", args.id, exc, attempt, collection, patient)
+    errlogger.error("p%s, Failed to process %s/%s", args.id, collection, patient)
+    return -1
 
-                    if attempt == PATIENT_TRIES:
-                        errlogger.error("p%s, Failed to process %s/%s", args.id, collection, patient)
-                        result = -1
 
-                    donepatientlogger.info('%s%s', '' if result == 0 else '-', patient)
-                    output.put(patient)
-
-
-def validate_collection(cur, validated, args, version, collection, index):
+def worker(input, output, args):
+    rootlogger.debug('p%s: Worker starting: args: %s', args.id, args)
+    for more_args in iter(input.get, 'STOP'):
+        collection, patient, studies, index = more_args
+        result = validate_patient_with_retries(args, collection, patient, studies, index)
+        # Only a patient that validated is recorded as done, so that a rerun retries the others
+        if result == 0:
+            donepatientlogger.info('%s', patient)
+        output.put((patient, result))
+
+
+def read_done(file_name):
+    try:
+        return set(open(file_name).read().splitlines())
+    except FileNotFoundError:
+        return set()
+
+
+# Yield (patient, {study: set of SOPInstanceUIDs}) for each patient of a collection, streamed
+# from a server side cursor so that the expected instances of a collection need not fit in memory
+def expected_instances(conn, args, collection):
+    with conn.cursor(name=f'expected_{os.getpid()}') as cur:
+        cur.itersize = DB_ITERSIZE
+        cur.execute(f"""
+         SELECT submitter_case_id, study_instance_uid, sop_instance_uid
+         FROM {args.all_table} as at
+         WHERE at.tcia_api_collection_id = %s
+         AND at.idc_version_number = %s
+         ORDER BY submitter_case_id, study_instance_uid
+         """, (collection, args.version))
+        for patient, rows in groupby(cur, key=lambda row: row[0]):
+            studies = {}
+            for _, study, sop_instance_uid in rows:
+                studies.setdefault(study, set()).add(sop_instance_uid)
+            yield patient, studies
+
+
+def validate_collection(conn, args, collection, index):
     begin = time.time()
-    query = (f"""
-     SELECT DISTINCT submitter_case_id
-     FROM {args.all_table} as at
-     WHERE at.tcia_api_collection_id = '{collection}'
-     """)
-    cur.execute(query)
-    patients = [patient[0] for patient in cur.fetchall()]
-    rootlogger.info('p%s: Collection %s, %s, %s, patients' , args.id, collection, index, len(patients))
-    done_patients = open(args.done_patients).read().splitlines()
-
+    with conn.cursor() as cur:
+        cur.execute(f"""
+         SELECT COUNT(DISTINCT submitter_case_id)
+         FROM {args.all_table} as at
+         WHERE at.tcia_api_collection_id = %s
+         AND at.idc_version_number = %s
+         """, (collection, args.version))
+        patient_count = cur.fetchone()[0]
+    rootlogger.info('p%s: Collection %s, %s, %s, patients' , args.id, collection, index, patient_count)
+    done_patients = read_done(args.done_patients)
+
+    results = {}
     if args.num_processes == 0:
         args.id=0
-        for patient in patients:
-            patient_index = f'{patients.index(patient) + 1}|{len(patients)}'
+        for patient_index, (patient, studies) in enumerate(expected_instances(conn, args, collection)):
+            patient_index = f'{patient_index + 1}|{patient_count}'
             if not patient in done_patients:
-                result = validate_patient(cur, args, validated, version, collection, patient, patient_index)
+                results[patient] = validate_patient_with_retries(args, collection, patient, studies, patient_index)
+                if results[patient] == 0:
+                    donepatientlogger.info('%s', patient)
             else:
-                rootlogger.info('  p%s: Patient %s, %s, previously validated', args.id, patient, index)
+                rootlogger.info('  p%s: Patient %s, %s, previously validated', args.id, patient, patient_index)
 
     else:
         processes = []
-        # Create queues
-        task_queue = Queue()
+        # Create queues. The task queue is bounded so that the parent only streams
+        # the expected instances of a collection as fast as the workers consume them.
+        task_queue = Queue(maxsize=2 * args.num_processes)
         done_queue = Queue()
 
-        # List of patients enqueued
-        enqueued_patients = []
-
         # Start worker processes
         for process in range(args.num_processes):
             args.id = process + 1
             processes.append(
                 Process(target=worker,
-                        args=(task_queue, done_queue, cur.connection, args)))
+                        args=(task_queue, done_queue, args)))
             processes[-1].start()
+        args.id = 0
 
         # Enqueue each patient in the the task queue
-        for patient in patients:
-            patient_index = f'{patients.index(patient) + 1}|{len(patients)}'
+        enqueued = 0
+        for patient_index, (patient, studies) in enumerate(expected_instances(conn, args, collection)):
+            patient_index = f'{patient_index + 1}|{patient_count}'
             if not patient in done_patients:
-                task_queue.put((validated, version, collection, patient, patient_index))
-                enqueued_patients.append(patient)
+                task_queue.put((collection, patient, studies, patient_index))
+                enqueued += 1
             else:
                 rootlogger.info('  p%s: Patient %s, %s, previously validated', args.id, patient, patient_index)
+            # Collect results as they arrive, so the done queue does not grow without bound
+            while not done_queue.empty():
+                patient_id, result = done_queue.get()
+                results[patient_id] = result
 
         # Collect the results for each patient
-        while not enqueued_patients == []:
-            # Timeout if waiting too long
-            results = done_queue.get(True,)
-            enqueued_patients.remove(results)
+        while len(results) < enqueued:
+            patient_id, result = done_queue.get(True)
+            results[patient_id] = result
 
         # Tell child processes to stop
         for process in processes:
@@ -261,51 +284,39 @@ def validate_collection(cur, validated, args, version, collection, index):
             process.join()
 
     duration = str(timedelta(seconds=(time.time() - begin)))
-    done_patients = set(open(args.done_patients).read().splitlines())
-    if set(patients).issubset(done_patients):
+    if all(result == 0 for result in results.values()):
         rootlogger.info('p%s: Collection %s, %s, completed in %s', args.id, collection, index, duration)
         donecollectionlogger.info(collection)
     else:
-        errlogger.error('p%s: Collection %s, %s, not completed in %s', args.id, collection, index, duration)
+        errlogger.error('p%s: Collection %s, %s, not completed in %s; %s patients failed', args.id, collection, index, duration,
+                        len([result for result in results.values() if result]))
 
 
 
 def validate_version(args):
-    validated = open(args.done_collections).read().splitlines()
-    skips = open(args.skips).read().splitlines()
+    validated = read_done(args.done_collections)
+    skips = read_done(args.skips)
+    args.rate_limiter = Rate_Limiter(args.max_requests_per_second)
     conn = psycopg2.connect(dbname=args.db, user=settings.DATABASE_USERNAME,
                             password=settings.DATABASE_PASSWORD, host=settings.DATABASE_HOST)
     with conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            # cur.execute("""
-            # # SELECT *
-            # # FROM version
-            # # WHERE idc_version_number = (%s)""", (args.version,))
-
-            version = args.version
-            # cur.execute("""
-            # SELECT * FROM collection
-            # WHERE version_id = (%s)""", (version['id'],))
             query = (f"""
             SELECT DISTINCT tcia_api_collection_id 
             FROM {args.all_table} as at
-            WHERE at.idc_version_number = {args.version}
+            WHERE at.idc_version_number = %s
+            ORDER BY tcia_api_collection_id
             """)
-            cur.execute(query)
+            cur.execute(query, (args.version,))
             collections = [collection[0] for collection in cur.fetchall()]
-            # if not len(tcia_collections) == len(collections):
-            #     errlogger.error('Different number of collections; NBIA: %s, IDC: %s in', len(tcia_collections),
-            #                     len(collections),
-            #                     version['idc_version_number'])
-            for collection in collections:
-                # if collection['tcia_api_collection_id'] not in validated and collection['tcia_api_collection_id'] not in skips:
-                collection_index = f'{collections.index(collection) + 1} of {len(collections)}'
-                if collection not in validated:
-                    if collection not in skips:
-                        result = validate_collection(cur, validated, args, version, collection, collection_index)
-                else:
-                    rootlogger.info('p%s: Collection %s %s previously validated', args.id,
-                                    collection, collection_index)
+        for index, collection in enumerate(collections):
+            collection_index = f'{index + 1} of {len(collections)}'
+            if collection not in validated:
+                if collection not in skips:
+                    validate_collection(conn, args, collection, collection_index)
+            else:
+                rootlogger.info('p%s: Collection %s %s previously validated', args.id,
+                                collection, collection_index)
 
 
 if __name__ == '__main__':
@@ -320,7 +331,10 @@ if __name__ == '__main__':
     parser.add_argument('--gchdataset', default='idc')
     parser.add_argument('--gchstore', default='v2')
     parser.add_argument('--cloud_region', default='us-central1', help='GCH dataset region')
-    parser.add_argument('--num_processes', default=8, help="Number of concurrent processes")
+    parser.add_argument('--num_processes', type=int, default=8, help="Number of concurrent processes")
+    parser.add_argument('--max_requests_per_second', type=float, default=20, \
+                        help='Maximum rate of DICOMweb requests across all processes. 0 for no limit')
+    parser.add_argument('--qido_limit', type=int, default=5000, help='Maximum number of instances returned per DICOMweb search')
     parser.add_argument('--skips', default='./logs/val_gch_dicomstore_skips.log' )
     parser.add_argument('--done_collections', default='./logs/val_gch_dicomstore_dones.log' )
     parser.add_argument('--done_patients', default='./logs/val_gch_dicomstore_patients.log' )